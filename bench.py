@@ -0,0 +1,566 @@
+"""
+bench.py
+
+Offline benchmark for the downloader: serves synthetic media from a local
+origin and drives the Flask app with concurrent clients.
+
+The origin serves a progressive MP4, a DASH manifest with separate video
+and audio streams, and an HLS playlist with fragments, all generated once
+with ffmpeg and reached through yt-dlp's generic extractor. Any file name
+may carry a ``~token`` before its extension (``prog~17.mp4``); the origin
+ignores it, but yt-dlp derives the video id from it, so every request in a
+cold scenario misses the probe and result caches.
+
+Scenarios:
+  probe     GET /probe for a fresh URL each time
+  audio     audio-only download converted to mp3
+  merge     bestvideo+bestaudio from DASH, merged by ffmpeg
+  hls       fragmented HLS download
+  cache     repeated download of one URL (served from the result cache)
+  idle      many open progress streams that never finish (memory and
+            threads per idle connection)
+
+Each scenario runs against every server given with ``--servers``: the
+threaded Werkzeug server in front of the Flask app (``sync``) and uvicorn
+in front of download_asgi (``async``), so the two can be compared side by
+side in one report.
+
+Requirements:
+  - everything download.py needs, including ffmpeg on PATH
+  - uvicorn for the async server
+
+Run:
+  python bench.py --requests 20 --concurrency 4 --output bench_output.json
+  python bench.py --scenarios probe,cache --duration 30 --video-bitrate 2M
+  python bench.py --scenarios probe,idle --servers sync,async --connections 500
+"""
+
+import os
+import sys
+import json
+import time
+import re
+import argparse
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import itertools
+import socket
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+SCENARIOS = ('probe', 'audio', 'merge', 'hls', 'cache', 'idle')
+SERVERS = ('sync', 'async')
+
+CONTENT_TYPES = {
+    '.mp4': 'video/mp4',
+    '.m4s': 'video/iso.segment',
+    '.mpd': 'application/dash+xml',
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+}
+
+# ``name~token.ext`` is served as ``name.ext``
+TOKEN_RE = re.compile(r'~[^/.]*(?=\.[^/.]+$)')
+
+# Shared by every scenario and server so cold requests never repeat a URL
+_tokens = itertools.count()
+
+
+def generate_media(root, duration, video_bitrate, audio_bitrate, size):
+    """Render the synthetic sources once per parameter set; returns their dir."""
+    tag = f'{duration}s-{video_bitrate}-{audio_bitrate}-{size}'
+    out = os.path.join(root, tag)
+    if os.path.exists(os.path.join(out, 'done')):
+        return out
+    shutil.rmtree(out, ignore_errors=True)
+    os.makedirs(os.path.join(out, 'dash'))
+    os.makedirs(os.path.join(out, 'hls'))
+    inputs = [
+        '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate=25',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100',
+        '-t', str(duration),
+    ]
+    encode = [
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', video_bitrate, '-g', '50',
+        '-c:a', 'aac', '-b:a', audio_bitrate,
+    ]
+    ffmpeg = ['ffmpeg', '-loglevel', 'error', '-y']
+    print(f"Generating {tag} media in {out}")
+    subprocess.run(ffmpeg + inputs + encode + ['-movflags', '+faststart', os.path.join(out, 'prog.mp4')],
+                   check=True)
+    subprocess.run(ffmpeg + inputs + encode + [
+        '-map', '0:v', '-map', '1:a', '-f', 'dash', '-seg_duration', '2',
+        '-use_template', '1', '-use_timeline', '0',
+        '-adaptation_sets', 'id=0,streams=v id=1,streams=a',
+        os.path.join(out, 'dash', 'manifest.mpd'),
+    ], check=True)
+    subprocess.run(ffmpeg + inputs + encode + [
+        '-f', 'hls', '-hls_time', '2', '-hls_playlist_type', 'vod',
+        '-hls_segment_filename', os.path.join(out, 'hls', 'seg%03d.ts'),
+        os.path.join(out, 'hls', 'index.m3u8'),
+    ], check=True)
+    open(os.path.join(out, 'done'), 'w').close()
+    return out
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """Static files with Range support and an optional per-connection rate cap."""
+
+    protocol_version = 'HTTP/1.1'
+    root = None
+    rate = 0  # bytes/second per connection, 0 = unlimited
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        rel = TOKEN_RE.sub('', self.path.split('?', 1)[0]).lstrip('/')
+        path = os.path.realpath(os.path.join(self.root, rel))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES.get(os.path.splitext(path)[1], 'application/octet-stream'))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if head:
+            return
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            try:
+                while left > 0:
+                    chunk = f.read(min(64 * 1024, left))
+                    self.wfile.write(chunk)
+                    left -= len(chunk)
+                    if self.rate:
+                        time.sleep(len(chunk) / self.rate)
+            except OSError:
+                pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # yt-dlp drops keep-alive connections freely; only report real errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_origin(root, rate):
+    handler = type('Origin', (OriginHandler,), {'root': os.path.realpath(root), 'rate': rate})
+    server = OriginServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, name='origin', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+class AsyncServer:
+    """uvicorn serving download_asgi from a background thread."""
+
+    def __init__(self):
+        import uvicorn
+        import download_asgi
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        config = uvicorn.Config(download_asgi.app, host='127.0.0.1', port=self.port,
+                                log_level='warning', access_log=False,
+                                timeout_keep_alive=5, backlog=4096)
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, name='app', daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError('uvicorn failed to start')
+            time.sleep(0.05)
+
+    def shutdown(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=30)
+
+
+def start_app(server, server_threads):
+    """Import the app with benchmark-friendly settings and serve it in-process."""
+    import download
+    if server == 'async':
+        handle = AsyncServer()
+        return download, handle, f'http://127.0.0.1:{handle.port}'
+    from werkzeug.serving import make_server
+    handle = make_server('127.0.0.1', 0, download.app, threaded=server_threads)
+    threading.Thread(target=handle.serve_forever, name='app', daemon=True).start()
+    return download, handle, f'http://127.0.0.1:{handle.server_port}'
+
+
+class ResourceSampler:
+    """Polls process RSS and scratch disk usage while a scenario runs."""
+
+    def __init__(self, download, interval=0.05):
+        self.download = download
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_scratch = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def rss():
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def sample(self):
+        try:
+            self.peak_rss = max(self.peak_rss, self.rss())
+        except OSError:
+            pass
+        self.peak_scratch = max(self.peak_scratch, self.download.scratch.used())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name='sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * pct // 100))
+    return values[int(rank) - 1]
+
+
+def http_call(method, url, body=None, timeout=600):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method)
+    if data is not None:
+        req.add_header('Content-Type', 'application/json')
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        size = 0
+        while True:
+            chunk = resp.read(256 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+        return resp.status, size
+
+
+def scenario_requests(name, origin, app_url):
+    """Callable building the (method, url, body) of request ``i``."""
+    def unique():
+        return f'{os.getpid()}x{next(_tokens)}'
+
+    if name == 'probe':
+        return lambda: ('GET', f'{app_url}/probe?url={origin}/prog~{unique()}.mp4', None)
+    if name == 'audio':
+        return lambda: ('POST', f'{app_url}/download', {
+            'url': f'{origin}/prog~{unique()}.mp4', 'format': 'bestaudio',
+            'is_audio_only': True, 'audio_format': 'mp3'})
+    if name == 'merge':
+        return lambda: ('POST', f'{app_url}/download', {
+            'url': f'{origin}/dash/manifest~{unique()}.mpd', 'format': 'bestvideo+bestaudio'})
+    if name == 'hls':
+        return lambda: ('POST', f'{app_url}/download', {
+            'url': f'{origin}/hls/index~{unique()}.m3u8', 'format': 'best'})
+    if name == 'cache':
+        body = {'url': f'{origin}/prog~cached.mp4', 'format': 'best'}
+        return lambda: ('POST', f'{app_url}/download', body)
+    raise ValueError(f'Unknown scenario: {name}')
+
+
+def run_scenario(name, download, origin, app_url, requests, concurrency):
+    make_request = scenario_requests(name, origin, app_url)
+    if name == 'cache':
+        # Prime the result cache so every measured request is a hit
+        http_call(*make_request())
+
+    latencies = []
+    errors = []
+    total_bytes = 0
+    lock = threading.Lock()
+
+    def one(_):
+        nonlocal total_bytes
+        method, url, body = make_request()
+        start = time.perf_counter()
+        try:
+            status, size = http_call(method, url, body)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            total_bytes += size
+
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    with ResourceSampler(download) as sampler:
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one, range(requests)))
+        wall = time.perf_counter() - wall_start
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 2) if v is not None else None
+    return {
+        'scenario': name,
+        'requests': requests,
+        'concurrency': concurrency,
+        'ok': len(latencies),
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'wall_seconds': round(wall, 3),
+        'requests_per_second': round(len(latencies) / wall, 3) if wall else None,
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'max': ms(latencies[-1] if latencies else None),
+        },
+        'bytes_served': total_bytes,
+        'mb_per_second': round(total_bytes / wall / 1e6, 3) if wall else None,
+        # ffmpeg runs as a child of this process and is waited for by yt-dlp
+        'ffmpeg_cpu_seconds': round(
+            (children_after.ru_utime - children_before.ru_utime)
+            + (children_after.ru_stime - children_before.ru_stime), 3),
+        'app_cpu_seconds': round(
+            (self_after.ru_utime - self_before.ru_utime)
+            + (self_after.ru_stime - self_before.ru_stime), 3),
+        'peak_rss_mb': round(sampler.peak_rss / 1e6, 1),
+        'peak_scratch_mb': round(sampler.peak_scratch / 1e6, 3),
+    }
+
+
+def open_stream(host, port, path, timeout):
+    """Open an SSE connection and wait for its first event."""
+    sock = socket.create_connection((host, port), timeout=timeout)
+    try:
+        sock.sendall(f'GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\n'
+                     f'Accept: text/event-stream\r\n\r\n'.encode())
+        received = b''
+        while b'\n\n' not in received.partition(b'\r\n\r\n')[2]:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError('closed before the first event')
+            received += chunk
+        if not received.startswith(b'HTTP/1.1 200'):
+            raise ConnectionError(received.split(b'\r\n', 1)[0].decode(errors='replace'))
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def run_idle(download, app_url, connections, hold):
+    """Hold ``connections`` progress streams open and measure their cost.
+
+    Each stream watches a progress id registered to a download that never
+    reports, so the server keeps it open and only sends heartbeats (an id
+    nobody registered is answered at once with a reconnect hint). The
+    trackers are finished afterwards. RSS and threads are sampled
+    for the whole process, so they include this client's side of the
+    sockets; that overhead is small and the same for both servers.
+    """
+    host, port = app_url.rsplit('//', 1)[1].split(':')
+    port = int(port)
+    ms = lambda v: round(v * 1000, 2) if v is not None else None
+    sockets = []
+    connect_times = []
+    errors = []
+    rss_before = ResourceSampler.rss()
+    threads_before = threading.active_count()
+    wall_start = time.perf_counter()
+    trackers = []
+    for i in range(connections):
+        progress_id = f'bench-idle-{next(_tokens)}'
+        trackers.append(download.progress_registry.tracker(progress_id))
+        download.progress_registry.alias(progress_id, progress_id)
+        start = time.perf_counter()
+        try:
+            sockets.append(open_stream(host, port, f'/progress/{progress_id}/events', 30))
+        except Exception as e:
+            errors.append(str(e))
+            continue
+        connect_times.append(time.perf_counter() - start)
+    wall = time.perf_counter() - wall_start
+    time.sleep(hold)
+    rss_after = ResourceSampler.rss()
+    threads_after = threading.active_count()
+    for sock in sockets:
+        sock.close()
+    for tracker in trackers:
+        tracker.finish()
+
+    connect_times.sort()
+    opened = len(sockets)
+    return {
+        'scenario': 'idle',
+        'connections': connections,
+        'ok': opened,
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'wall_seconds': round(wall, 3),
+        'connect_ms': {
+            'p50': ms(percentile(connect_times, 50)),
+            'p95': ms(percentile(connect_times, 95)),
+            'max': ms(connect_times[-1] if connect_times else None),
+        },
+        'rss_added_mb': round((rss_after - rss_before) / 1e6, 2),
+        'rss_per_connection_kb': round((rss_after - rss_before) / opened / 1e3, 1) if opened else None,
+        'threads_added': threads_after - threads_before,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--servers', default='sync',
+                        help='comma separated subset of: ' + ', '.join(SERVERS))
+    parser.add_argument('--requests', type=int, default=20, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='parallel clients')
+    parser.add_argument('--connections', type=int, default=200,
+                        help='open streams in the idle scenario')
+    parser.add_argument('--hold', type=float, default=2,
+                        help='seconds the idle streams stay open before measuring')
+    parser.add_argument('--duration', type=int, default=20, help='media length in seconds')
+    parser.add_argument('--video-bitrate', default='1M')
+    parser.add_argument('--audio-bitrate', default='128k')
+    parser.add_argument('--size', default='640x360', help='video frame size')
+    parser.add_argument('--origin-rate', type=int, default=0,
+                        help='per-connection origin bandwidth in bytes/s (0 = unlimited)')
+    parser.add_argument('--media-dir', default=os.path.join(tempfile.gettempdir(), 'downloader_bench_media'),
+                        help='where generated media is kept between runs')
+    parser.add_argument('--single-threaded', action='store_true',
+                        help='serve the sync app from one thread instead of one per request')
+    # The app logs to stdout, so the report goes to a file
+    parser.add_argument('--output', default='bench_output.json', help='JSON report path')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenario(s): {', '.join(unknown)}")
+    servers = [s.strip() for s in args.servers.split(',') if s.strip()]
+    unknown = [s for s in servers if s not in SERVERS]
+    if unknown:
+        sys.exit(f"Unknown server(s): {', '.join(unknown)}")
+    if 'async' in servers:
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            sys.exit('The async server needs uvicorn: pip install uvicorn')
+
+    media = generate_media(args.media_dir, args.duration, args.video_bitrate,
+                           args.audio_bitrate, args.size)
+
+    # Keep benchmark runs away from the real cache and scratch space and,
+    # unless asked, unthrottled
+    scratch = tempfile.mkdtemp(prefix='downloader_bench_')
+    os.environ['RESULT_CACHE_DIR'] = os.path.join(scratch, 'cache')
+    os.environ['SCRATCH_DIR'] = os.path.join(scratch, 'work')
+    for name in ('CLIENT_PROBE_RATE', 'CLIENT_DOWNLOAD_RATE', 'CLIENT_MAX_ACTIVE', 'BANDWIDTH_LIMIT'):
+        os.environ.setdefault(name, '0')
+
+    origin_server, origin = start_origin(media, args.origin_rate)
+    import download
+    import yt_dlp.version
+
+    report = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'yt_dlp': yt_dlp.version.__version__,
+        },
+        'config': {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'media': {
+                'duration': args.duration,
+                'video_bitrate': args.video_bitrate,
+                'audio_bitrate': args.audio_bitrate,
+                'size': args.size,
+            },
+            'origin_rate': args.origin_rate,
+            'servers': servers,
+            'server_threads': not args.single_threaded,
+            'idle_connections': args.connections,
+        },
+        'scenarios': [],
+    }
+    try:
+        for server in servers:
+            _, app_server, app_url = start_app(server, not args.single_threaded)
+            try:
+                for name in scenarios:
+                    if name == 'idle':
+                        print(f"Running {name} on {server}: {args.connections} connections", file=sys.stderr)
+                        result = run_idle(download, app_url, args.connections, args.hold)
+                        print(f"  {result['ok']} open, {result['rss_per_connection_kb']} KB and "
+                              f"{result['threads_added']} threads added, {result['errors']} errors",
+                              file=sys.stderr)
+                    else:
+                        print(f"Running {name} on {server}: {args.requests} requests, "
+                              f"concurrency {args.concurrency}", file=sys.stderr)
+                        result = run_scenario(name, download, origin, app_url, args.requests, args.concurrency)
+                        print(f"  p50 {result['latency_ms']['p50']} ms, p95 {result['latency_ms']['p95']} ms, "
+                              f"{result['mb_per_second']} MB/s, {result['errors']} errors", file=sys.stderr)
+                    report['scenarios'].append({'server': server, **result})
+            finally:
+                app_server.shutdown()
+    finally:
+        origin_server.shutdown()
+        report['result_cache'] = download.result_cache.stats()
+        report['startup'] = download.stats_snapshot()['startup']
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+    print(f"Wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
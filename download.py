@@ -14,12 +14,47 @@ Run:
 """
 
 import os
+import re
+import json
+import time
 import tempfile
 import shutil
 import threading
+import queue
+import uuid
+import subprocess
+import hashlib
+import gzip
+import io
+import zipfile
+import heapq
+import itertools
+import math
+import select
+import signal
+import fcntl
+import types
+import socket
+import sqlite3
+import importlib
+import urllib.request
+from contextlib import contextmanager
+from functools import wraps
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from pathlib import Path
-from flask import Flask, request, jsonify, render_template_string, send_file
-from yt_dlp import YoutubeDL
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote
+from flask import Flask, Response, request, jsonify, send_file, url_for, redirect
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 
@@ -29,166 +64,231 @@ YDL_PROBE_OPTS = {
     'skip_download': True,
 }
 
-INDEX_HTML = r"""
-<!doctype html>
-<html lang="en">
-<head>
-    <meta charset="utf-8" />
-    <meta name="viewport" content="width=device-width, initial-scale=1" />
-    <title>Universal Downloader</title>
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
-    <style>
-        .format-option {
-            padding: 10px;
-            margin: 5px 0;
-            border: 1px solid #dee2e6;
-            border-radius: 5px;
-            cursor: pointer;
-            transition: all 0.2s;
-        }
-        .format-option:hover {
-            background-color: #f8f9fa;
-            border-color: #0d6efd;
-        }
-        .format-option.selected {
-            background-color: #e7f1ff;
-            border-color: #0d6efd;
-            border-width: 2px;
-        }
-        .format-badge {
-            display: inline-block;
-            padding: 2px 8px;
-            margin: 2px;
-            border-radius: 3px;
-            font-size: 0.85em;
-        }
-        .quality-badge { background-color: #d1ecf1; color: #0c5460; }
-        .size-badge { background-color: #d4edda; color: #155724; }
-        .codec-badge { background-color: #fff3cd; color: #856404; }
-        .has-audio-badge { background-color: #d1e7dd; color: #0f5132; }
-        .no-audio-badge { background-color: #f8d7da; color: #842029; }
-        .spinner { display: inline-block; width: 1rem; height: 1rem; border: 2px solid currentColor; border-right-color: transparent; border-radius: 50%; animation: spin 0.75s linear infinite; }
-        @keyframes spin { to { transform: rotate(360deg); } }
-        .quick-btn {
-            border: 2px solid;
-            font-weight: 500;
-        }
-    </style>
-</head>
-<body class="bg-light">
-    <div class="container py-4" style="max-width: 1000px;">
-        <h1 class="mb-3">🎬 Universal Downloader</h1>
-        <p class="text-muted">Download videos and audio from any supported platform with quality selection.</p>
+# Pool of reusable YoutubeDL instances for probing
+YDL_POOL_SIZE = int(os.environ.get('YDL_POOL_SIZE', 4))
+YDL_POOL_MAX_USES = int(os.environ.get('YDL_POOL_MAX_USES', 500))
+YDL_POOL_WARM = os.environ.get('YDL_POOL_WARM', '1') != '0'
+# Comma separated extractor keys to load up front, e.g. "Youtube,Vimeo,Generic"
+YDL_PRELOAD_EXTRACTORS = [k.strip() for k in os.environ.get('YDL_PRELOAD_EXTRACTORS', '').split(',') if k.strip()]
+# Import yt-dlp and warm the probe pool on a background thread once the app
+# has loaded (0 = both wait for the first request that needs them)
+YTDLP_PRELOAD = os.environ.get('YTDLP_PRELOAD', '1') != '0'
 
-        <div class="card mb-4">
-            <div class="card-body">
-                <label for="urlInput" class="form-label fw-bold">Enter URL</label>
-                <div class="input-group mb-3">
-                    <input id="urlInput" class="form-control" placeholder="https://www.youtube.com/watch?v=..." />
-                    <button id="probeBtn" class="btn btn-primary">
-                        <span id="probeBtnText">Analyze</span>
-                        <span id="probeSpinner" style="display:none;" class="spinner ms-2"></span>
-                    </button>
-                </div>
-            </div>
-        </div>
+# Browser cache lifetime of the UI page; its assets are cached for a year
+# and renamed by content hash whenever they change
+INDEX_MAX_AGE = int(os.environ.get('INDEX_MAX_AGE', 300))
+ASSET_MAX_AGE = 365 * 24 * 3600
 
-        <div id="errorArea" class="alert alert-danger" style="display:none;" role="alert"></div>
+# Probe metadata cache (shared by /probe and the /download audio check)
+PROBE_CACHE_TTL = float(os.environ.get('PROBE_CACHE_TTL', 600))
+PROBE_CACHE_MAX_ENTRIES = int(os.environ.get('PROBE_CACHE_MAX_ENTRIES', 512))
+PROBE_CACHE_MAX_BYTES = int(os.environ.get('PROBE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
 
-        <div id="resultArea" style="display:none">
-            <div class="card mb-4">
-                <div class="card-body">
-                    <h5 class="card-title" id="videoTitle"></h5>
-                    <p class="text-muted mb-0" id="videoDuration"></p>
-                </div>
-            </div>
+# Background download jobs
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_MAX = int(os.environ.get('JOB_QUEUE_MAX', 32))
+JOB_RETENTION = float(os.environ.get('JOB_RETENTION', 3600))
+JOB_RETRY_AFTER = int(os.environ.get('JOB_RETRY_AFTER', 30))
 
-            <div class="card mb-4">
-                <div class="card-header bg-info text-white">
-                    <strong>⚡ Quick Download Options</strong>
-                </div>
-                <div class="card-body">
-                    <div class="d-flex gap-2 flex-wrap">
-                        <button id="bestVideoBtn" class="btn btn-primary quick-btn">
-                            📹 Best Quality Video (with audio)
-                        </button>
-                        <button id="bestAudioBtn" class="btn btn-success quick-btn">
-                            🎵 Best Quality Audio Only
-                        </button>
-                        <button id="quickMP4Btn" class="btn btn-outline-primary quick-btn">
-                            🎬 Best MP4 (compatible)
-                        </button>
-                    </div>
-                    <p class="text-muted small mt-2 mb-0">
-                        💡 <strong>Recommended:</strong> Use quick options above for best results. Manual selection below is for advanced users.
-                    </p>
-                </div>
-            </div>
+# Progress events (Server-Sent Events)
+PROGRESS_INTERVAL = float(os.environ.get('PROGRESS_INTERVAL', 0.5))
+# Reconnect delay suggested to clients whose download has not registered yet
+PROGRESS_PENDING_RETRY_MS = int(os.environ.get('PROGRESS_PENDING_RETRY_MS', 1000))
+PROGRESS_HEARTBEAT = float(os.environ.get('PROGRESS_HEARTBEAT', 15))
+PROGRESS_RETENTION = float(os.environ.get('PROGRESS_RETENTION', 300))
 
-            <div class="row mb-4">
-                <div class="col-12">
-                    <div class="card">
-                        <div class="card-header bg-secondary text-white">
-                            <strong>🎯 Advanced: Manual Format Selection</strong>
-                        </div>
-                        <div class="card-body">
-                            <div class="row">
-                                <div class="col-md-6 mb-3">
-                                    <h6>📹 Video Formats</h6>
-                                    <div id="videoOptions" style="max-height: 300px; overflow-y: auto;">
-                                    </div>
-                                </div>
-                                <div class="col-md-6 mb-3">
-                                    <h6>🎵 Audio Formats</h6>
-                                    <div id="audioOptions" style="max-height: 300px; overflow-y: auto;">
-                                    </div>
-                                </div>
-                            </div>
-                            <div class="alert alert-warning small mb-0" role="alert">
-                                ⚠️ <strong>Note:</strong> Most video formats don't include audio. Select both video AND audio format, or use quick options above.
-                            </div>
-                        </div>
-                    </div>
-                </div>
-            </div>
+# How often waiting requests are checked for a hung-up client
+DISCONNECT_POLL_INTERVAL = float(os.environ.get('DISCONNECT_POLL_INTERVAL', 1))
 
-            <div class="card">
-                <div class="card-body">
-                    <h6 class="card-title">Download Settings</h6>
-                    
-                    <div class="mb-3">
-                        <label class="form-label">Custom Filename (optional)</label>
-                        <input id="filename" class="form-control" placeholder="Leave blank to use video title"/>
-                    </div>
+# Streaming delivery (bytes relayed while they are produced)
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 64 * 1024))
+STREAMABLE_PROTOCOLS = {'http', 'https', 'm3u8', 'm3u8_native'}
 
-                    <div class="mb-3">
-                        <label class="form-label">Audio Format (for audio-only downloads)</label>
-                        <select id="audioFormat" class="form-select" style="max-width:200px">
-                            <option value="mp3">MP3</option>
-                            <option value="m4a">M4A</option>
-                            <option value="opus">OPUS</option>
-                            <option value="wav">WAV</option>
-                        </select>
-                    </div>
+# ffmpeg output arguments per streamed container / audio format
+STREAM_CONTAINERS = {
+    'mp4': ['-c', 'copy', '-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof'],
+    'mkv': ['-c', 'copy', '-f', 'matroska'],
+}
+STREAM_AUDIO_CODECS = {
+    'mp3': ['-vn', '-c:a', 'libmp3lame', '-b:a', '192k', '-f', 'mp3'],
+    'm4a': ['-vn', '-c:a', 'aac', '-b:a', '192k', '-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov'],
+    'opus': ['-vn', '-c:a', 'libopus', '-b:a', '192k', '-f', 'opus'],
+    'wav': ['-vn', '-c:a', 'pcm_s16le', '-f', 'wav'],
+}
 
-                    <button id="downloadBtn" class="btn btn-success btn-lg">
-                        <span id="downloadBtnText">⬇️ Download</span>
-                        <span id="downloadSpinner" style="display:none;" class="spinner ms-2"></span>
-                    </button>
+# Where downloads run (one ydl_* dir each), e.g. a fast NVMe or tmpfs mount.
+# Every dir reserves its expected size first; new downloads wait for room
+# once SCRATCH_MAX_BYTES (0 = no byte limit) is reserved or the filesystem
+# is down to SCRATCH_MIN_FREE_BYTES. Must not be shared between hosts.
+SCRATCH_DIR = os.environ.get('SCRATCH_DIR', tempfile.gettempdir())
+SCRATCH_MAX_BYTES = int(os.environ.get('SCRATCH_MAX_BYTES', 0))
+SCRATCH_MIN_FREE_BYTES = int(os.environ.get('SCRATCH_MIN_FREE_BYTES', 512 * 1024 ** 2))
+# Reserved when the probe gives neither sizes nor bitrates to estimate from
+SCRATCH_DEFAULT_RESERVE = int(os.environ.get('SCRATCH_DEFAULT_RESERVE', 256 * 1024 ** 2))
+# Margin on estimates, which are often approximate
+SCRATCH_HEADROOM = float(os.environ.get('SCRATCH_HEADROOM', 1.25))
+# Seconds a download waits for room: direct requests, then background jobs
+SCRATCH_WAIT = float(os.environ.get('SCRATCH_WAIT', 10))
+SCRATCH_JOB_WAIT = float(os.environ.get('SCRATCH_JOB_WAIT', 600))
+SCRATCH_RETRY_AFTER = int(os.environ.get('SCRATCH_RETRY_AFTER', 30))
+# ydl_* dirs without an owner marker (older versions) are swept after this long
+SCRATCH_ORPHAN_AGE = float(os.environ.get('SCRATCH_ORPHAN_AGE', 3600))
+# Admission re-measures a dir's bytes on disk at most this often
+SCRATCH_USAGE_TTL = float(os.environ.get('SCRATCH_USAGE_TTL', 1.0))
 
-                    <div id="downloadStatus" class="mt-3 alert alert-info" style="display:none;"></div>
-                </div>
-            </div>
-        </div>
+# On-disk cache of finished downloads (0 bytes disables it)
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ydl_cache'))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+RESULT_CACHE_POLICY = os.environ.get('RESULT_CACHE_POLICY', 'lru')  # 'lru' or 'lfu'
+# Finished files stay downloadable (and resumable) this long after their last use
+RESULT_RETENTION = float(os.environ.get('RESULT_RETENTION', 24 * 3600))
+RESULT_MIN_FREE_BYTES = int(os.environ.get('RESULT_MIN_FREE_BYTES', 1024 ** 3))
+RESULT_JANITOR_INTERVAL = float(os.environ.get('RESULT_JANITOR_INTERVAL', 60))
+# Temp and sidecar-less files younger than this may be a sibling worker's
+# publish in progress, so recovery leaves them alone
+RESULT_TMP_GRACE = float(os.environ.get('RESULT_TMP_GRACE', 3600))
 
-        <hr class="my-4"/>
-        <p class="text-muted small">
-            <strong>Note:</strong> Requires ffmpeg for merging video+audio. 
-            Only download content you have rights to use.
-        </p>
-    </div>
+# How finished files leave the process: 'sendfile' (wsgi.file_wrapper, which
+# gunicorn turns into a kernel sendfile), or hand-off to a fronting proxy with
+# 'x-accel' (nginx X-Accel-Redirect) or 'x-sendfile' (Apache/lighttpd)
+DELIVERY_BACKEND = os.environ.get('DELIVERY_BACKEND', 'sendfile')
+# nginx `internal` location that aliases RESULT_CACHE_DIR
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/_artifacts/')
+# RESULT_CACHE_DIR as the proxy sees it, if it is mounted elsewhere there
+X_SENDFILE_ROOT = os.environ.get('X_SENDFILE_ROOT', RESULT_CACHE_DIR)
+# The proxy keeps reading a handed-off file after the worker lets go of it,
+# so the cache leaves it alone for this long
+RESULT_OFFLOAD_GRACE = float(os.environ.get('RESULT_OFFLOAD_GRACE', 600))
+
+# State shared between workers and nodes: 'local' (in-process only) or
+# 'sqlite' (a database file every worker can open, e.g. on a shared volume)
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'local')
+# Kept beside, not inside, the cache dir: the cache deletes files it does not know
+STATE_DB = os.environ.get('STATE_DB', RESULT_CACHE_DIR.rstrip(os.sep) + '-state.db')
+# This worker's identity and the base URL siblings can reach it at
+NODE_ID = os.environ.get('NODE_ID', f'{socket.gethostname()}:{os.getpid()}')
+NODE_URL = os.environ.get('NODE_URL', '').rstrip('/')
+# A claimed job is taken over by another worker if its lease is not renewed
+JOB_LEASE = float(os.environ.get('JOB_LEASE', 30))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+
+# Audio codecs that can be stream-copied into each output format
+AUDIO_CODEC_FAMILIES = {
+    'mp3': {'mp3'},
+    'm4a': {'mp4a', 'aac'},
+    'opus': {'opus'},
+    'wav': {'pcm_s16le'},
+}
+
+# ffmpeg concurrency: stream-copy work (merge/remux) and re-encodes queue separately
+CPU_COUNT = os.cpu_count() or 2
+FFMPEG_COPY_SLOTS = int(os.environ.get('FFMPEG_COPY_SLOTS', CPU_COUNT))
+FFMPEG_TRANSCODE_SLOTS = int(os.environ.get('FFMPEG_TRANSCODE_SLOTS', max(1, CPU_COUNT // 2)))
+# Request priorities are clamped to [-MAX_PRIORITY, MAX_PRIORITY]
+MAX_PRIORITY = int(os.environ.get('MAX_PRIORITY', 10))
+
+# Postprocessors that never start ffmpeg
+NON_FFMPEG_POSTPROCESSORS = {'MoveFiles', 'MoveFilesAfterDownload'}
+
+# Parallel fetching: fragments per stream, and a per-process cap on fragment threads
+FRAGMENT_CONCURRENCY = int(os.environ.get('FRAGMENT_CONCURRENCY', 4))
+FRAGMENT_THREADS_MAX = int(os.environ.get('FRAGMENT_THREADS_MAX', 16))
+PARALLEL_STREAMS = os.environ.get('PARALLEL_STREAMS', '1') != '0'
+
+# Fields of each format sent to the UI by /probe
+PROBE_RESPONSE_FIELDS = (
+    'format_id', 'ext', 'protocol', 'resolution', 'height', 'fps', 'vcodec', 'acodec',
+    'abr', 'tbr', 'vbr', 'filesize', 'filesize_approx', 'has_audio',
+)
+
+# Protocols where a clip is fetched without downloading the rest: ffmpeg seeks
+# with HTTP Range requests, or only the covering fragments are requested
+CLIP_PROTOCOLS = {'http', 'https', 'm3u8', 'm3u8_native', 'http_dash_segments'}
 
-<script>
+# Batch and playlist probing
+BATCH_PROBE_WORKERS = int(os.environ.get('BATCH_PROBE_WORKERS', 8))
+BATCH_MAX_URLS = int(os.environ.get('BATCH_MAX_URLS', 200))
+PLAYLIST_PAGE_SIZE = int(os.environ.get('PLAYLIST_PAGE_SIZE', 50))
+
+# Bulk (multi-item) ZIP downloads
+BULK_WORKERS = int(os.environ.get('BULK_WORKERS', 3))
+# Threads shared by every bulk request; each request keeps BULK_WORKERS in flight
+BULK_POOL_WORKERS = int(os.environ.get('BULK_POOL_WORKERS', 8))
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 100))
+
+# Per-client admission control: requests/second and burst per kind (0 disables)
+CLIENT_PROBE_RATE = float(os.environ.get('CLIENT_PROBE_RATE', 2))
+CLIENT_PROBE_BURST = int(os.environ.get('CLIENT_PROBE_BURST', 20))
+CLIENT_DOWNLOAD_RATE = float(os.environ.get('CLIENT_DOWNLOAD_RATE', 0.2))
+CLIENT_DOWNLOAD_BURST = int(os.environ.get('CLIENT_DOWNLOAD_BURST', 5))
+# Downloads (requests, queued or running jobs, bulk archives) a client may have at once
+CLIENT_MAX_ACTIVE = int(os.environ.get('CLIENT_MAX_ACTIVE', 3))
+CLIENT_RETRY_AFTER = int(os.environ.get('CLIENT_RETRY_AFTER', 10))
+CLIENT_TRACK_MAX = int(os.environ.get('CLIENT_TRACK_MAX', 10000))
+# Clients sending this header are keyed by it instead of their address
+CLIENT_KEY_HEADER = os.environ.get('CLIENT_KEY_HEADER', 'X-API-Key')
+# Only trust X-Forwarded-For when running behind a proxy that sets it
+TRUST_FORWARDED_FOR = os.environ.get('TRUST_FORWARDED_FOR', '0') != '0'
+
+# Outbound bandwidth shared by all running downloads, bytes/second (0 = unlimited)
+BANDWIDTH_LIMIT = int(os.environ.get('BANDWIDTH_LIMIT', 0))
+
+# Upper bounds (seconds) of the /metrics phase histogram buckets
+PHASE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Responses smaller than this are not worth compressing
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+
+# Query parameters that never change what a URL points to
+TRACKING_PARAMS = {'si', 'feature', 'fbclid', 'gclid', 'igshid', 'ref', 'ref_src'}
+
+# Only these format fields are kept in the probe cache
+COMPACT_FORMAT_FIELDS = (
+    'format_id', 'format_note', 'ext', 'protocol', 'resolution', 'width', 'height',
+    'fps', 'vcodec', 'acodec', 'abr', 'tbr', 'vbr', 'asr', 'filesize',
+    'filesize_approx', 'language',
+)
+
+INDEX_CSS = r"""
+.format-option {
+    padding: 10px;
+    margin: 5px 0;
+    border: 1px solid #dee2e6;
+    border-radius: 5px;
+    cursor: pointer;
+    transition: all 0.2s;
+}
+.format-option:hover {
+    background-color: #f8f9fa;
+    border-color: #0d6efd;
+}
+.format-option.selected {
+    background-color: #e7f1ff;
+    border-color: #0d6efd;
+    border-width: 2px;
+}
+.format-badge {
+    display: inline-block;
+    padding: 2px 8px;
+    margin: 2px;
+    border-radius: 3px;
+    font-size: 0.85em;
+}
+.quality-badge { background-color: #d1ecf1; color: #0c5460; }
+.size-badge { background-color: #d4edda; color: #155724; }
+.codec-badge { background-color: #fff3cd; color: #856404; }
+.has-audio-badge { background-color: #d1e7dd; color: #0f5132; }
+.no-audio-badge { background-color: #f8d7da; color: #842029; }
+.spinner { display: inline-block; width: 1rem; height: 1rem; border: 2px solid currentColor; border-right-color: transparent; border-radius: 50%; animation: spin 0.75s linear infinite; }
+@keyframes spin { to { transform: rotate(360deg); } }
+.quick-btn {
+    border: 2px solid;
+    font-weight: 500;
+}
+"""
+
+INDEX_JS = r"""
 let currentInfo = null;
 let selectedVideo = null;
 let selectedAudio = null;
@@ -219,16 +319,17 @@ function formatDuration(seconds) {
 }
 
 async function probeUrl(url) {
-    const res = await fetch('/probe', {
-        method: 'POST',
-        headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify({url})
-    });
+    // GET so the browser cache can revalidate with If-None-Match
+    const res = await fetch('/probe?url=' + encodeURIComponent(url));
     if (!res.ok) {
         const text = await res.text();
         throw new Error(text);
     }
-    return res.json();
+    const info = await res.json();
+    // Formats are sent once; video/audio are index lists into them
+    info.video_formats = info.video.map(i => info.formats[i]);
+    info.audio_formats = info.audio.map(i => info.formats[i]);
+    return info;
 }
 
 function createFormatOption(format, type) {
@@ -306,9 +407,22 @@ function estimateSize(format, duration) {
     return Math.round((bitrate * 1000 / 8) * duration);
 }
 
+function renderChapters(chapters) {
+    const select = document.getElementById('clipChapter');
+    select.innerHTML = '<option value="">Whole video</option>';
+    (chapters || []).forEach(ch => {
+        const opt = document.createElement('option');
+        opt.value = ch.title;
+        opt.textContent = `${ch.title} (${formatDuration(ch.start_time) || '0:00'} - ${formatDuration(ch.end_time)})`;
+        select.appendChild(opt);
+    });
+    select.style.display = chapters && chapters.length ? '' : 'none';
+}
+
 function renderFormats(info) {
     currentInfo = info;
     document.getElementById('videoTitle').textContent = info.title || 'Unknown Title';
+    renderChapters(info.chapters);
     
     const duration = info.duration;
     let durationText = duration ? `Duration: ${formatDuration(duration)}` : '';
@@ -451,6 +565,23 @@ document.getElementById('quickMP4Btn').addEventListener('click', () => {
     showDownloadStatus('✓ Best MP4 format selected (maximum compatibility)');
 });
 
+function formatProgress(p) {
+    if (p.postprocessor && p.postprocessor_status === 'started') {
+        return `Processing (${p.postprocessor})...`;
+    }
+    if (p.status !== 'downloading') return null;
+    let text = 'Downloading';
+    if (p.total_bytes) {
+        text += ` ${Math.floor(100 * p.downloaded_bytes / p.total_bytes)}%`;
+    } else if (p.downloaded_bytes) {
+        text += ` ${formatFilesize(p.downloaded_bytes)}`;
+    }
+    if (p.fragment_count) text += ` (fragment ${p.fragment_index}/${p.fragment_count})`;
+    if (p.speed) text += ` • ${formatFilesize(p.speed)}/s`;
+    if (p.eta) text += ` • ${formatDuration(p.eta)} left`;
+    return text + '...';
+}
+
 function showDownloadStatus(msg) {
     const status = document.getElementById('downloadStatus');
     status.textContent = msg;
@@ -486,6 +617,9 @@ document.getElementById('downloadBtn').addEventListener('click', async () => {
     const url = document.getElementById('urlInput').value.trim();
     const filename = document.getElementById('filename').value.trim();
     const audioFormat = document.getElementById('audioFormat').value;
+    const clipStart = document.getElementById('clipStart').value.trim();
+    const clipEnd = document.getElementById('clipEnd').value.trim();
+    const chapter = document.getElementById('clipChapter').value;
     
     const btn = document.getElementById('downloadBtn');
     const btnText = document.getElementById('downloadBtnText');
@@ -495,8 +629,11 @@ document.getElementById('downloadBtn').addEventListener('click', async () => {
     btnText.textContent = 'Downloading & Processing...';
     spinner.style.display = 'inline-block';
     
+    let events = null;
+    
     try {
-        const resp = await fetch('/download', {
+        // Queue the download as a job; the file itself is fetched with a plain GET
+        const resp = await fetch('/jobs', {
             method: 'POST',
             headers: {'Content-Type': 'application/json'},
             body: JSON.stringify({
@@ -504,37 +641,59 @@ document.getElementById('downloadBtn').addEventListener('click', async () => {
                 format,
                 filename,
                 audio_format: audioFormat,
-                is_audio_only: quickMode === 'bestaudio'
+                is_audio_only: quickMode === 'bestaudio',
+                start: clipStart || null,
+                end: clipEnd || null,
+                chapters: chapter ? [chapter] : []
             })
         });
         
         if (!resp.ok) {
             const text = await resp.text();
-            throw new Error(text);
+            const retry = resp.headers.get('Retry-After');
+            throw new Error(retry ? `${text} (retry in ${retry}s)` : text);
         }
         
-        const blob = await resp.blob();
-        const cd = resp.headers.get('Content-Disposition') || '';
-        let outName = 'download';
-        const match = cd.match(/filename\*=UTF-8''(.+)$|filename="?([^";]+)"?/);
-        if (match) {
-            outName = decodeURIComponent(match[1] || match[2] || outName);
+        const job = await resp.json();
+        // Closing the tab abandons the job so the server stops working on it
+        const abandon = () => navigator.sendBeacon(`/jobs/${job.id}/cancel`);
+        window.addEventListener('pagehide', abandon);
+        events = new EventSource(`/jobs/${job.id}/events`);
+        await new Promise((resolve) => {
+            events.onmessage = (e) => {
+                const text = formatProgress(JSON.parse(e.data));
+                if (text) btnText.textContent = text;
+            };
+            events.addEventListener('done', resolve);
+            // Fall back to polling the status below if the stream breaks
+            events.onerror = () => { if (events.readyState === EventSource.CLOSED) resolve(); };
+        });
+        events.close();
+        
+        let status = await (await fetch(job.status_url)).json();
+        while (status.state === 'queued' || status.state === 'running') {
+            await new Promise(r => setTimeout(r, 1000));
+            status = await (await fetch(job.status_url)).json();
+        }
+        window.removeEventListener('pagehide', abandon);
+        if (status.state !== 'finished') {
+            throw new Error(status.error || `Job ${status.state}`);
         }
         
-        const urlBlob = URL.createObjectURL(blob);
+        // Let the browser's download manager stream the attachment straight to disk
         const a = document.createElement('a');
-        a.href = urlBlob;
-        a.download = outName;
+        a.href = status.artifact_url || job.file_url;
+        a.download = status.filename || '';
         document.body.appendChild(a);
         a.click();
         a.remove();
-        URL.revokeObjectURL(urlBlob);
         
-        showDownloadStatus('✅ Download complete! Check your downloads folder.');
+        showDownloadStatus('✅ Ready! Your browser is saving the file.');
     } catch (err) {
         showError('Download failed: ' + err.message);
         console.error(err);
     } finally {
+        if (events) events.close();
         btn.disabled = false;
         btnText.textContent = '⬇️ Download';
         spinner.style.display = 'none';
@@ -547,208 +706,4546 @@ document.getElementById('urlInput').addEventListener('keypress', (e) => {
         document.getElementById('probeBtn').click();
     }
 });
-</script>
-</body>
-</html>
 """
 
+INDEX_HTML = r"""
+<!doctype html>
+<html lang="en">
+<head>
+    <meta charset="utf-8" />
+    <meta name="viewport" content="width=device-width, initial-scale=1" />
+    <title>Universal Downloader</title>
+    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
+    <link href="__INDEX_CSS__" rel="stylesheet">
+</head>
+<body class="bg-light">
+    <div class="container py-4" style="max-width: 1000px;">
+        <h1 class="mb-3">🎬 Universal Downloader</h1>
+        <p class="text-muted">Download videos and audio from any supported platform with quality selection.</p>
 
-def probe_info(url):
-    """Use yt-dlp to fetch metadata and formats for a URL."""
-    with YoutubeDL(YDL_PROBE_OPTS) as ydl:
-        info = ydl.extract_info(url, download=False)
-    return info
-
-
-def classify_formats(formats):
-    """Separate formats into video and audio categories."""
-    video_formats = []
-    audio_formats = []
-    
-    for fmt in formats:
-        vcodec = fmt.get('vcodec', 'none')
-        acodec = fmt.get('acodec', 'none')
-        
-        # Video format: has video codec and is not 'none'
-        if vcodec and vcodec != 'none':
-            # Mark if it actually has audio included
-            fmt['has_audio'] = acodec and acodec != 'none'
-            video_formats.append(fmt)
-        # Audio-only format: has audio but no video
-        elif acodec and acodec != 'none' and (not vcodec or vcodec == 'none'):
-            audio_formats.append(fmt)
-    
-    return video_formats, audio_formats
-
-
-@app.route('/')
-def index():
-    return render_template_string(INDEX_HTML)
-
+        <div class="card mb-4">
+            <div class="card-body">
+                <label for="urlInput" class="form-label fw-bold">Enter URL</label>
+                <div class="input-group mb-3">
+                    <input id="urlInput" class="form-control" placeholder="https://www.youtube.com/watch?v=..." />
+                    <button id="probeBtn" class="btn btn-primary">
+                        <span id="probeBtnText">Analyze</span>
+                        <span id="probeSpinner" style="display:none;" class="spinner ms-2"></span>
+                    </button>
+                </div>
+            </div>
+        </div>
 
-@app.route('/probe', methods=['POST'])
-def probe():
-    data = request.get_json() or {}
-    url = data.get('url')
-    if not url:
-        return 'Missing url', 400
-    
-    try:
-        info = probe_info(url)
-        formats = info.get('formats', [])
-        
-        video_formats, audio_formats = classify_formats(formats)
-        
-        return jsonify({
-            'title': info.get('title'),
-            'duration': info.get('duration'),
-            'formats': formats,
-            'video_formats': video_formats,
-            'audio_formats': audio_formats,
-        })
-    except Exception as e:
-        return f'Probe failed: {str(e)}', 500
+        <div id="errorArea" class="alert alert-danger" style="display:none;" role="alert"></div>
 
+        <div id="resultArea" style="display:none">
+            <div class="card mb-4">
+                <div class="card-body">
+                    <h5 class="card-title" id="videoTitle"></h5>
+                    <p class="text-muted mb-0" id="videoDuration"></p>
+                </div>
+            </div>
 
-@app.route('/download', methods=['POST'])
-def download():
-    data = request.get_json() or {}
-    url = data.get('url')
-    fmt = data.get('format')
-    audio_format = data.get('audio_format', 'mp3')
-    filename_hint = data.get('filename', '').strip()
-    is_audio_only = data.get('is_audio_only', False)
+            <div class="card mb-4">
+                <div class="card-header bg-info text-white">
+                    <strong>⚡ Quick Download Options</strong>
+                </div>
+                <div class="card-body">
+                    <div class="d-flex gap-2 flex-wrap">
+                        <button id="bestVideoBtn" class="btn btn-primary quick-btn">
+                            📹 Best Quality Video (with audio)
+                        </button>
+                        <button id="bestAudioBtn" class="btn btn-success quick-btn">
+                            🎵 Best Quality Audio Only
+                        </button>
+                        <button id="quickMP4Btn" class="btn btn-outline-primary quick-btn">
+                            🎬 Best MP4 (compatible)
+                        </button>
+                    </div>
+                    <p class="text-muted small mt-2 mb-0">
+                        💡 <strong>Recommended:</strong> Use quick options above for best results. Manual selection below is for advanced users.
+                    </p>
+                </div>
+            </div>
 
-    if not url or not fmt:
-        return 'Missing url or format', 400
+            <div class="row mb-4">
+                <div class="col-12">
+                    <div class="card">
+                        <div class="card-header bg-secondary text-white">
+                            <strong>🎯 Advanced: Manual Format Selection</strong>
+                        </div>
+                        <div class="card-body">
+                            <div class="row">
+                                <div class="col-md-6 mb-3">
+                                    <h6>📹 Video Formats</h6>
+                                    <div id="videoOptions" style="max-height: 300px; overflow-y: auto;">
+                                    </div>
+                                </div>
+                                <div class="col-md-6 mb-3">
+                                    <h6>🎵 Audio Formats</h6>
+                                    <div id="audioOptions" style="max-height: 300px; overflow-y: auto;">
+                                    </div>
+                                </div>
+                            </div>
+                            <div class="alert alert-warning small mb-0" role="alert">
+                                ⚠️ <strong>Note:</strong> Most video formats don't include audio. Select both video AND audio format, or use quick options above.
+                            </div>
+                        </div>
+                    </div>
+                </div>
+            </div>
+
+            <div class="card">
+                <div class="card-body">
+                    <h6 class="card-title">Download Settings</h6>
+                    
+                    <div class="mb-3">
+                        <label class="form-label">Custom Filename (optional)</label>
+                        <input id="filename" class="form-control" placeholder="Leave blank to use video title"/>
+                    </div>
+
+                    <div class="mb-3">
+                        <label class="form-label">Clip (optional)</label>
+                        <div class="d-flex gap-2 flex-wrap">
+                            <input id="clipStart" class="form-control" style="max-width:140px" placeholder="Start, e.g. 1:00"/>
+                            <input id="clipEnd" class="form-control" style="max-width:140px" placeholder="End, e.g. 1:30"/>
+                            <select id="clipChapter" class="form-select" style="max-width:260px; display:none">
+                                <option value="">Whole video</option>
+                            </select>
+                        </div>
+                        <div class="form-text">Only the selected part is fetched.</div>
+                    </div>
+
+                    <div class="mb-3">
+                        <label class="form-label">Audio Format (for audio-only downloads)</label>
+                        <select id="audioFormat" class="form-select" style="max-width:200px">
+                            <option value="mp3">MP3</option>
+                            <option value="m4a">M4A</option>
+                            <option value="opus">OPUS</option>
+                            <option value="wav">WAV</option>
+                        </select>
+                    </div>
+
+                    <button id="downloadBtn" class="btn btn-success btn-lg">
+                        <span id="downloadBtnText">⬇️ Download</span>
+                        <span id="downloadSpinner" style="display:none;" class="spinner ms-2"></span>
+                    </button>
+
+                    <div id="downloadStatus" class="mt-3 alert alert-info" style="display:none;"></div>
+                </div>
+            </div>
+        </div>
+
+        <hr class="my-4"/>
+        <p class="text-muted small">
+            <strong>Note:</strong> Requires ffmpeg for merging video+audio. 
+            Only download content you have rights to use.
+        </p>
+    </div>
+
+<script src="__INDEX_JS__"></script>
+</body>
+</html>
+"""
+
+
+class YtDlpLoader:
+    """yt-dlp, imported on first use instead of when this module loads.
+
+    Importing yt-dlp pulls in its extractor registry, networking stack and
+    their dependencies, which used to be most of a worker's boot time.
+    Names are looked up as attributes (``ytdlp.YoutubeDL``); the first
+    lookup imports the package, or waits for the background import started
+    once the app is ready. Subclasses of yt-dlp classes are registered with
+    ``extend`` and built right after the import.
+    """
+
+    NAMES = {
+        'YoutubeDL': ('yt_dlp', 'YoutubeDL'),
+        'PostProcessor': ('yt_dlp.postprocessor.common', 'PostProcessor'),
+        'DownloadError': ('yt_dlp.utils', 'DownloadError'),
+        'DownloadCancelled': ('yt_dlp.utils', 'DownloadCancelled'),
+        'download_range_func': ('yt_dlp.utils', 'download_range_func'),
+        'parse_duration': ('yt_dlp.utils', 'parse_duration'),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = None
+        self._builders = []
+        self.seconds = None
+        # Never fork while another thread is part-way through the import:
+        # the child would inherit its module locks and block on them forever
+        os.register_at_fork(before=self._lock.acquire, after_in_parent=self._lock.release,
+                            after_in_child=self._lock.release)
+
+    @property
+    def loaded(self):
+        return self._names is not None
+
+    def load(self):
+        names = self._names
+        if names is not None:
+            return names
+        with self._lock:
+            if self._names is None:
+                started = time.perf_counter()
+                names = {name: getattr(importlib.import_module(module), attr)
+                         for name, (module, attr) in self.NAMES.items()}
+                for build in self._builders:
+                    cls = build(types.SimpleNamespace(**names))
+                    names[cls.__name__] = cls
+                self._names = names
+                self.seconds = time.perf_counter() - started
+                startup.mark('yt_dlp_loaded')
+            return self._names
+
+    def extend(self, build):
+        """Register ``build(yt)``, returning a class derived from yt-dlp's."""
+        with self._lock:
+            self._builders.append(build)
+            if self._names is not None:
+                cls = build(types.SimpleNamespace(**self._names))
+                self._names[cls.__name__] = cls
+        return build
+
+    def __getattr__(self, name):
+        try:
+            return self.load()[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def stats(self):
+        return {
+            'loaded': self.loaded,
+            'import_seconds': round(self.seconds, 3) if self.seconds is not None else None,
+        }
+
+
+def process_start_ticks(pid='self'):
+    """Start time of a process in clock ticks since boot, or None (no such
+    process, or no /proc). With the pid it names a process uniquely."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return int(f.read().rpartition(')')[2].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def process_age():
+    """Seconds since this process started, or None where /proc is unavailable."""
+    start_ticks = process_start_ticks()
+    try:
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    if start_ticks is None:
+        return None
+    return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+
+
+class StartupClock:
+    """Seconds from process start to each boot milestone of this worker.
+
+    Milestones are ``ready`` (module loaded, accepting requests),
+    ``yt_dlp_loaded`` (import finished) and ``first_response``; each is recorded
+    and printed once. Without /proc the clock starts when this module does.
+    """
+
+    def __init__(self):
+        self.origin = time.monotonic() - (process_age() or 0.0)
+        self.marks = {}
+        self._lock = threading.Lock()
+
+    def mark(self, name):
+        if name in self.marks:
+            return
+        with self._lock:
+            if name in self.marks:
+                return
+            self.marks[name] = round(time.monotonic() - self.origin, 3)
+        print(f"Startup: {name} after {self.marks[name]:.3f}s")
+
+    def stats(self):
+        return dict(self.marks)
+
+
+startup = StartupClock()
+ytdlp = YtDlpLoader()
+
+
+class PhaseTimer:
+    """Wall-clock seconds spent in each named phase of one request or job.
+
+    Phases are either wrapped with ``phase()`` or, for the parts yt-dlp
+    runs, derived from its stages: ``extract`` lasts until DownloadStartPP
+    runs right before the transfer, ``download`` until the first
+    postprocessor starts, and each postprocessor is its own ``pp-<name>``.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.started = time.perf_counter()
+        self._marks = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def begin(self, name):
+        self._marks.setdefault(name, time.perf_counter())
+
+    def end(self, name):
+        start = self._marks.pop(name, None)
+        if start is not None:
+            self.add(name, time.perf_counter() - start)
+
+    def postprocessor_hook(self, d):
+        # yt-dlp reports nested started/finished pairs; the first pair wins
+        name = f"pp-{d.get('postprocessor')}"
+        if d['status'] == 'started':
+            self.end('download')
+            self.begin(name)
+        elif d['status'] == 'finished':
+            self.end(name)
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def header(self):
+        """Server-Timing value, durations in milliseconds."""
+        items = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.phases.items()]
+        items.append(f'total;dur={self.total() * 1000:.1f}')
+        return ', '.join(items)
+
+
+_timing = threading.local()
+
+
+@ytdlp.extend
+def _download_start_pp(yt):
+    class DownloadStartPP(yt.PostProcessor):
+        """Marks the end of extraction on a PhaseTimer (runs at ``before_dl``).
+
+        It keeps the postprocessor hooks off itself, so neither the ffmpeg
+        scheduler nor progress reporting ever sees it.
+        """
+
+        def __init__(self, timer):
+            super().__init__()
+            self.timer = timer
+
+        def set_downloader(self, downloader):
+            self._downloader = downloader
+
+        def run(self, info):
+            self.timer.end('extract')
+            self.timer.begin('download')
+            return [], info
+
+    return DownloadStartPP
+
+
+@ytdlp.extend
+def _ffmpeg_download_pp(yt):
+    class FFmpegDownloadPP(yt.PostProcessor):
+        """Takes an ffmpeg scheduler slot right before yt-dlp hands the
+        download to ffmpeg (clip sections; runs at ``before_dl``).
+
+        Like DownloadStartPP it keeps the postprocessor hooks off itself. The
+        first postprocessor, or the end of the run, releases the slot.
+        """
+
+        def __init__(self, session, kind):
+            super().__init__()
+            self.session = session
+            self.kind = kind
+
+        def set_downloader(self, downloader):
+            self._downloader = downloader
+
+        def run(self, info):
+            self.session.hold('download', self.kind)
+            return [], info
+
+    return FFmpegDownloadPP
+
+
+def current_timer():
+    return getattr(_timing, 'timer', None)
+
+
+def set_timer(timer):
+    _timing.timer = timer
+
+
+@contextmanager
+def timed(name):
+    """Attribute the enclosed block to ``name`` on this thread's timer, if any."""
+    timer = current_timer()
+    if timer is None:
+        yield
+        return
+    with timer.phase(name):
+        yield
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram keyed by label values."""
+
+    def __init__(self, name, help_text, labels, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._series.items()}
+        for label_values, series in sorted(snapshot.items()):
+            labels = ','.join(f'{k}="{v}"' for k, v in zip(self.labels, label_values))
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-2]}')
+            lines.append(f'{self.name}_count{{{labels}}} {series[-2]}')
+            lines.append(f'{self.name}_sum{{{labels}}} {series[-1]:.6f}')
+        return lines
+
+
+class Metrics:
+    """Phase histograms and byte counters exported on /metrics."""
+
+    def __init__(self, buckets):
+        self.phases = Histogram(
+            'ydl_phase_seconds', 'Time spent per request phase.', ('endpoint', 'phase'), buckets)
+        self.bytes_downloaded = 0
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, timer, total=True):
+        for name, seconds in list(timer.phases.items()):
+            self.phases.observe((endpoint, name), seconds)
+        if total:
+            self.phases.observe((endpoint, 'total'), timer.total())
+
+    def downloaded(self, count):
+        with self._lock:
+            self.bytes_downloaded += count
+
+    def served(self, count):
+        with self._lock:
+            self.bytes_served += count
+
+
+metrics = Metrics(PHASE_BUCKETS)
+
+
+class LocalState:
+    """State backend for a single process: nothing is shared, every hook is a no-op."""
+
+    shared = False
+
+    def probe_get(self, key):
+        return None
+
+    def probe_put(self, key, record, ttl):
+        pass
+
+    def put_artifact(self, key, path, name, size):
+        pass
+
+    def alias_artifact(self, alias, key):
+        pass
+
+    def remove_artifact(self, key):
+        pass
+
+    def find_artifacts(self, key=None, alias=None):
+        return []
+
+    def stats(self):
+        return {'backend': 'local', 'node': NODE_ID}
+
+
+class SqliteState:
+    """Probe metadata, job records and the artifact index in one SQLite file.
+
+    Every thread gets its own connection. WAL mode lets readers carry on
+    while a writer commits, and job claims run in IMMEDIATE transactions so
+    two workers never take the same job. This suits the workers of one host,
+    or a few nodes whose shared volume has working POSIX locks; bigger
+    fleets want a server-backed class with the same methods.
+    """
+
+    shared = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS probes (
+            key TEXT PRIMARY KEY, record TEXT NOT NULL, expires_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, state TEXT NOT NULL, priority INTEGER NOT NULL,
+            params TEXT NOT NULL, owner TEXT, owner_url TEXT, lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0, cancel_requested INTEGER NOT NULL DEFAULT 0,
+            error TEXT, out_name TEXT, artifact_key TEXT, plan TEXT, timings TEXT, size INTEGER,
+            created_at REAL NOT NULL, started_at REAL, finished_at REAL);
+        CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, priority, created_at);
+        CREATE TABLE IF NOT EXISTS artifacts (
+            key TEXT NOT NULL, node TEXT NOT NULL, node_url TEXT, path TEXT NOT NULL,
+            name TEXT NOT NULL, size INTEGER NOT NULL, created_at REAL NOT NULL,
+            PRIMARY KEY (key, node));
+        CREATE TABLE IF NOT EXISTS artifact_aliases (alias TEXT PRIMARY KEY, key TEXT NOT NULL);
+    """
+
+    JOB_COLUMNS = ('id', 'state', 'priority', 'params', 'error', 'out_name', 'artifact_key',
+                   'plan', 'timings', 'size', 'created_at', 'started_at', 'finished_at')
+    FINISH_COLUMNS = ('state', 'error', 'out_name', 'artifact_key', 'plan', 'timings', 'size',
+                      'finished_at')
+
+    def __init__(self, path, node, node_url):
+        self.path = path
+        self.node = node
+        self.node_url = node_url
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db().executescript(self.SCHEMA)
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    @staticmethod
+    def _job(row):
+        if row is None:
+            return None
+        record = dict(row)
+        for field in ('params', 'plan', 'timings'):
+            if record[field] is not None:
+                record[field] = json.loads(record[field])
+        return record
+
+    # Probe metadata
+
+    def probe_get(self, key):
+        row = self._db().execute('SELECT record, expires_at FROM probes WHERE key = ?', (key,)).fetchone()
+        if row is None or row['expires_at'] < time.time():
+            return None
+        return json.loads(row['record'])
+
+    def probe_put(self, key, record, ttl):
+        self._db().execute('INSERT OR REPLACE INTO probes VALUES (?, ?, ?)',
+                           (key, json.dumps(record, default=str), time.time() + ttl))
+
+    # Jobs
+
+    def put_job(self, record, max_queued):
+        """Queue a job record; False when the shared queue is full."""
+        values = [json.dumps(record[c]) if c in ('params', 'plan', 'timings') else record[c]
+                  for c in self.JOB_COLUMNS]
+        with self._transaction() as db:
+            queued = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+            if queued >= max_queued:
+                return False
+            db.execute(f"INSERT INTO jobs ({', '.join(self.JOB_COLUMNS)}) "
+                       f"VALUES ({', '.join('?' * len(values))})", values)
+        return True
+
+    def get_job(self, job_id):
+        return self._job(self._db().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+    def claim_job(self, lease, max_attempts):
+        """Take the most urgent queued job, or one whose owner stopped renewing its lease."""
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET state = 'failed', error = 'Download failed: worker lost', "
+                       "finished_at = ? WHERE state = 'running' AND lease_until < ? AND attempts >= ?",
+                       (now, now, max_attempts))
+            row = db.execute("SELECT id FROM jobs WHERE state = 'queued' "
+                             "OR (state = 'running' AND lease_until < ?) "
+                             "ORDER BY priority DESC, created_at LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'running', owner = ?, owner_url = ?, lease_until = ?, "
+                       "attempts = attempts + 1, started_at = COALESCE(started_at, ?) WHERE id = ?",
+                       (self.node, self.node_url, now + lease, now, row['id']))
+        return self.get_job(row['id'])
+
+    def renew_job(self, job_id, lease):
+        """Extend our lease; returns (still ours, cancellation requested)."""
+        db = self._db()
+        cur = db.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND state = 'running'",
+                         (time.time() + lease, job_id, self.node))
+        if cur.rowcount == 0:
+            return False, False
+        row = db.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return True, bool(row and row['cancel_requested'])
+
+    def finish_job(self, record):
+        """Record a job's outcome, unless another worker has taken it over meanwhile."""
+        values = [json.dumps(record[c]) if c in ('plan', 'timings') else record[c]
+                  for c in self.FINISH_COLUMNS]
+        self._db().execute(
+            f"UPDATE jobs SET {', '.join(f'{c} = ?' for c in self.FINISH_COLUMNS)} "
+            f"WHERE id = ? AND owner = ?", values + [record['id'], self.node])
+
+    def cancel_job(self, job_id):
+        """Cancel a queued job outright, or flag a running one for its owner."""
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET state = 'cancelled', error = 'cancelled by client', finished_at = ? "
+                       "WHERE id = ? AND state = 'queued'", (time.time(), job_id))
+            db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND state = 'running'", (job_id,))
+        return self.get_job(job_id)
+
+    def expire(self, cutoff):
+        """Forget jobs finished before ``cutoff`` and probe records past their TTL."""
+        db = self._db()
+        db.execute('DELETE FROM jobs WHERE finished_at < ?', (cutoff,))
+        db.execute('DELETE FROM probes WHERE expires_at < ?', (time.time(),))
+
+    def job_states(self):
+        rows = self._db().execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        return {state: count for state, count in rows}
+
+    # Artifact index
+
+    def put_artifact(self, key, path, name, size):
+        self._db().execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (key, self.node, self.node_url, str(path), name, size, time.time()))
+
+    def alias_artifact(self, alias, key):
+        self._db().execute('INSERT OR REPLACE INTO artifact_aliases VALUES (?, ?)', (alias, key))
+
+    def remove_artifact(self, key):
+        self._db().execute('DELETE FROM artifacts WHERE key = ? AND node = ?', (key, self.node))
+
+    def find_artifacts(self, key=None, alias=None):
+        """Copies of an artifact held by any worker, newest first."""
+        db = self._db()
+        if key is None:
+            row = db.execute('SELECT key FROM artifact_aliases WHERE alias = ?', (alias,)).fetchone()
+            if row is None:
+                return []
+            key = row['key']
+        rows = db.execute('SELECT * FROM artifacts WHERE key = ? ORDER BY created_at DESC', (key,))
+        return [dict(r) for r in rows]
+
+    def stats(self):
+        db = self._db()
+        return {
+            'backend': 'sqlite',
+            'node': self.node,
+            'jobs': self.job_states(),
+            'artifacts': db.execute('SELECT COUNT(*) FROM artifacts').fetchone()[0],
+            'probes': db.execute('SELECT COUNT(*) FROM probes').fetchone()[0],
+        }
+
+
+def open_state(backend):
+    if backend == 'sqlite':
+        return SqliteState(STATE_DB, NODE_ID, NODE_URL)
+    if backend != 'local':
+        raise ValueError(f'Unknown STATE_BACKEND: {backend!r}')
+    return LocalState()
+
+
+state_store = open_state(STATE_BACKEND)
+
+
+def normalize_url(url):
+    """Canonical form of a URL used as a cache key."""
+    parts = urlsplit(url.strip())
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in TRACKING_PARAMS and not k.startswith('utm_')
+    )
+    return urlunsplit((
+        parts.scheme.lower(),
+        parts.netloc.lower(),
+        parts.path or '/',
+        urlencode(query),
+        '',
+    ))
+
+
+def compact_format(fmt):
+    """Reduce a yt-dlp format dict to the fields we actually use."""
+    record = {key: fmt[key] for key in COMPACT_FORMAT_FIELDS if fmt.get(key) is not None}
+    acodec = fmt.get('acodec', 'none')
+    record['has_audio'] = bool(acodec and acodec != 'none')
+    return record
+
+
+def compact_info(info):
+    """Reduce a yt-dlp info dict to a small, cacheable record."""
+    return {
+        'id': info.get('id'),
+        'extractor_key': info.get('extractor_key'),
+        'webpage_url': info.get('webpage_url'),
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'chapters': [
+            {'title': c.get('title'), 'start_time': c.get('start_time'), 'end_time': c.get('end_time')}
+            for c in info.get('chapters') or []
+        ],
+        'formats': [compact_format(f) for f in info.get('formats') or []],
+    }
+
+
+class ProbeCache:
+    """Thread-safe in-process TTL + LRU cache of compact probe results."""
+
+    def __init__(self, ttl, max_entries, max_bytes):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, size, value = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+probe_cache = ProbeCache(PROBE_CACHE_TTL, PROBE_CACHE_MAX_ENTRIES, PROBE_CACHE_MAX_BYTES)
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into a single execution.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight block and receive the same result (or exception). Results
+    with a ``retain(n)`` method get one extra reference per follower.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.followers += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+                leader = True
+        
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                followers = call.followers
+            if call.error is None and followers and hasattr(call.result, 'retain'):
+                call.result.retain(followers)
+            call.event.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'executions': self.executions,
+                'coalesced': self.coalesced,
+            }
+
+
+probe_flight = SingleFlight()
+download_flight = SingleFlight()
+
+
+class YoutubeDLPool:
+    """Thread-safe pool of pre-built YoutubeDL instances for metadata extraction.
+
+    Reusing an instance keeps its option state, instantiated extractors and
+    HTTP sessions (keep-alive connections with the ``requests`` handler)
+    across requests. Each instance is handed to one thread at a time and
+    replaced after ``max_uses`` checkouts so per-instance state cannot grow
+    without bound.
+    """
+
+    def __init__(self, size, opts, max_uses):
+        self.size = size
+        self.opts = opts
+        self.max_uses = max_uses
+        self._idle = queue.LifoQueue()  # most recently used first: warmest connections
+        self._created = 0
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.recycled = 0
+
+    def _create(self, preload=()):
+        ydl = ytdlp.YoutubeDL(self.opts)
+        for key in preload:
+            try:
+                ydl.get_info_extractor(key)
+            except Exception as e:
+                print(f"Could not preload extractor {key}: {e}")
+        return [ydl, 0]
+
+    def warm(self, preload=()):
+        """Build every instance now so the first requests skip the cold start."""
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                if self._created >= self.size:
+                    break
+                self._created += 1
+            self._idle.put(self._create(preload))
+        print(f"YoutubeDL pool warmed: {self.size} instances in {time.monotonic() - started:.2f}s")
+
+    @contextmanager
+    def acquire(self):
+        slot = None
+        try:
+            slot = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                grow = self._created < self.size
+                if grow:
+                    self._created += 1
+            if grow:
+                slot = self._create(YDL_PRELOAD_EXTRACTORS)
+            else:
+                self.waits += 1
+                slot = self._idle.get()
+        self.checkouts += 1
+        try:
+            yield slot[0]
+        finally:
+            slot[1] += 1
+            if slot[1] >= self.max_uses:
+                slot[0].close()
+                slot = self._create(YDL_PRELOAD_EXTRACTORS)
+                self.recycled += 1
+            self._idle.put(slot)
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'created': self._created,
+            'idle': self._idle.qsize(),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'recycled': self.recycled,
+        }
+
+
+ydl_pool = YoutubeDLPool(YDL_POOL_SIZE, YDL_PROBE_OPTS, YDL_POOL_MAX_USES)
+
+
+def probe_info(url):
+    """Use yt-dlp to fetch metadata and formats for a URL."""
+    with ydl_pool.acquire() as ydl:
+        info = ydl.extract_info(url, download=False)
+    return info
+
+
+def get_probe(url):
+    """Return compact probe data for a URL, served from the cache when fresh."""
+    key = normalize_url(url)
+    cached = probe_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    def fetch():
+        # A sibling worker may have probed it already
+        record = state_store.probe_get(key)
+        if record is None:
+            record = compact_info(probe_info(url))
+            state_store.probe_put(key, record, PROBE_CACHE_TTL)
+        probe_cache.put(key, record)
+        return record
+    
+    with timed('probe'):
+        return probe_flight.do(key, fetch)
+
+
+def classify_formats(formats):
+    """Separate formats into video and audio categories (as indices into formats)."""
+    video_formats = []
+    audio_formats = []
+    
+    for i, fmt in enumerate(formats):
+        vcodec = fmt.get('vcodec', 'none')
+        acodec = fmt.get('acodec', 'none')
+        
+        # Video format: has video codec and is not 'none'
+        if vcodec and vcodec != 'none':
+            video_formats.append(i)
+        # Audio-only format: has audio but no video
+        elif acodec and acodec != 'none' and (not vcodec or vcodec == 'none'):
+            audio_formats.append(i)
+    
+    return video_formats, audio_formats
+
+
+def probe_payload(info):
+    """Client view of compact probe data: projected formats plus group indices."""
+    formats = [
+        {key: f[key] for key in PROBE_RESPONSE_FIELDS if key in f}
+        for f in info.get('formats', [])
+    ]
+    
+    video_formats, audio_formats = classify_formats(formats)
+    
+    return {
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'chapters': info.get('chapters') or [],
+        # Indices of formats a clip can be cut from without fetching the whole file
+        'clippable': [i for i, f in enumerate(formats) if f.get('protocol') in CLIP_PROTOCOLS],
+        'formats': formats,
+        'video': video_formats,
+        'audio': audio_formats,
+    }
+
+
+# Shared, bounded pool for batch and playlist probing
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_PROBE_WORKERS, thread_name_prefix='probe')
+bulk_executor = ThreadPoolExecutor(max_workers=BULK_POOL_WORKERS, thread_name_prefix='bulk')
+
+
+def playlist_listing(url, page, page_size):
+    """One page of a playlist's entries without resolving their formats.
+
+    ``process=False`` leaves ``entries`` as the extractor produced them
+    (a list, a generator or a lazily paged list), so only the requested
+    page is fetched from the site.
+    """
+    with ydl_pool.acquire() as ydl:
+        result = ydl.extract_info(url, download=False, process=False)
+        if result.get('_type') not in ('playlist', 'multi_video'):
+            return {
+                'type': 'video', 'id': result.get('id'), 'title': result.get('title'),
+                'page': 1, 'page_size': 1, 'has_more': False,
+                'entries': [{'index': 0, 'id': result.get('id'), 'title': result.get('title'),
+                             'duration': result.get('duration'), 'url': url}],
+            }
+        
+        start = (page - 1) * page_size
+        entries = result.get('entries') or []
+        if hasattr(entries, 'getslice'):
+            window = entries.getslice(start, start + page_size + 1)
+        elif isinstance(entries, list):
+            window = entries[start:start + page_size + 1]
+        else:
+            window = list(itertools.islice(entries, start, start + page_size + 1))
+    
+    return {
+        'type': 'playlist',
+        'id': result.get('id'),
+        'title': result.get('title'),
+        'entry_count': result.get('playlist_count'),
+        'page': page,
+        'page_size': page_size,
+        'has_more': len(window) > page_size,
+        'entries': [
+            {
+                'index': start + i,
+                'id': entry.get('id'),
+                'title': entry.get('title'),
+                'duration': entry.get('duration'),
+                'url': entry.get('url') or entry.get('webpage_url'),
+            }
+            for i, entry in enumerate(window[:page_size])
+        ],
+    }
+
+
+def ndjson_line(item):
+    return dumps_json(item) + b'\n'
+
+
+def ndjson_response(lines):
+    return Response(lines, mimetype='application/x-ndjson', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def dumps_json(payload):
+    """Compact JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+
+def _accepted_encodings(header):
+    accepted = set()
+    for part in header.split(','):
+        token, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(token.strip().lower())
+    return accepted
+
+
+def cached_json_response(payload):
+    """JSON response with a strong ETag, revalidation and gzip/brotli encoding.
+
+    Each content encoding gets its own strong validator (the body digest
+    plus an encoding suffix); If-None-Match matches on the digest, so a
+    client holding any representation can be answered with 304.
+    """
+    if_none_match = request.if_none_match.as_set() if request.method in ('GET', 'HEAD') else ()
+    status, body, headers = encode_json(
+        payload, request.headers.get('Accept-Encoding', ''), if_none_match)
+    if status == 304:
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+def encode_json(payload, accept_encoding, if_none_match=()):
+    """Negotiated JSON representation of ``payload``: (status, body, headers).
+
+    ``if_none_match`` holds the unquoted entity tags the client sent.
+    """
+    body = dumps_json(payload)
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    
+    encoding = None
+    if len(body) >= COMPRESS_MIN_BYTES:
+        accepted = _accepted_encodings(accept_encoding)
+        if brotli is not None and 'br' in accepted:
+            encoding = 'br'
+        elif 'gzip' in accepted:
+            encoding = 'gzip'
+    etag = f'{digest}-{encoding}' if encoding else digest
+    
+    headers = {
+        'ETag': f'"{etag}"',
+        'Vary': 'Accept-Encoding',
+        'Cache-Control': 'no-cache',
+    }
+    for candidate in if_none_match:
+        if candidate.split('-')[0] == digest:
+            return 304, b'', headers
+    
+    if encoding == 'br':
+        body = brotli.compress(body, quality=5)
+    elif encoding == 'gzip':
+        body = gzip.compress(body, compresslevel=6)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return 200, body, headers
+
+
+class StaticAsset:
+    """A fixed response body, compressed at most once per content encoding.
+
+    Validators follow ``encode_json``: a strong ETag per encoding and 304
+    for any representation of the same body. Encoded bodies are built on
+    the first request that asks for them and kept for the process lifetime.
+    """
+
+    def __init__(self, body, content_type, cache_control):
+        self.body = body.encode() if isinstance(body, str) else body
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.digest = hashlib.sha256(self.body).hexdigest()[:32]
+        self._encoded = {}
+
+    def encoded(self, encoding):
+        body = self._encoded.get(encoding)
+        if body is None:
+            if encoding == 'br':
+                body = brotli.compress(self.body, quality=11)
+            else:
+                body = gzip.compress(self.body, compresslevel=9, mtime=0)
+            self._encoded[encoding] = body
+        return body
+
+    def negotiate(self, accept_encoding, if_none_match=(), cache_control=None):
+        """(status, body, headers) for a request, like ``encode_json``."""
+        encoding = None
+        if len(self.body) >= COMPRESS_MIN_BYTES:
+            accepted = _accepted_encodings(accept_encoding)
+            if brotli is not None and 'br' in accepted:
+                encoding = 'br'
+            elif 'gzip' in accepted:
+                encoding = 'gzip'
+        headers = {
+            'ETag': f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"',
+            'Vary': 'Accept-Encoding',
+            'Cache-Control': cache_control or self.cache_control,
+        }
+        for candidate in if_none_match:
+            if candidate.split('-')[0] == self.digest:
+                return 304, b'', headers
+        if encoding is None:
+            return 200, self.body, headers
+        headers['Content-Encoding'] = encoding
+        return 200, self.encoded(encoding), headers
+
+    def response(self, cache_control=None):
+        if_none_match = request.if_none_match.as_set() if request.method in ('GET', 'HEAD') else ()
+        status, body, headers = self.negotiate(
+            request.headers.get('Accept-Encoding', ''), if_none_match, cache_control)
+        if status == 304:
+            return Response(status=304, headers=headers)
+        return Response(body, content_type=self.content_type, headers=headers)
+
+
+# The UI's script and styles are separate assets so browsers keep them for
+# good; the page links them with their content hash as a version
+ASSETS = {
+    'app.css': StaticAsset(INDEX_CSS, 'text/css; charset=utf-8',
+                           f'public, max-age={ASSET_MAX_AGE}, immutable'),
+    'app.js': StaticAsset(INDEX_JS, 'text/javascript; charset=utf-8',
+                          f'public, max-age={ASSET_MAX_AGE}, immutable'),
+}
+index_page = StaticAsset(
+    INDEX_HTML
+    .replace('__INDEX_CSS__', f"assets/app.css?v={ASSETS['app.css'].digest[:12]}")
+    .replace('__INDEX_JS__', f"assets/app.js?v={ASSETS['app.js'].digest[:12]}"),
+    'text/html; charset=utf-8', f'public, max-age={INDEX_MAX_AGE}')
+
+
+class ProgressTracker:
+    """Latest progress of one download, as reported by yt-dlp hooks.
+
+    The hooks run on the download thread for every chunk, so they only
+    store a reference to the status dict yt-dlp already built and bump a
+    counter: no locks and no allocations. Readers sample it at a fixed rate.
+    """
+
+    __slots__ = ('status', 'phase', 'version', 'finished_at', 'error')
+
+    def __init__(self):
+        self.status = None
+        self.phase = None
+        self.version = 0
+        self.finished_at = None
+        self.error = None
+
+    def progress_hook(self, d):
+        self.status = d
+        self.version += 1
+
+    def postprocessor_hook(self, d):
+        self.phase = d
+        self.version += 1
+
+    def finish(self, error=None):
+        self.error = error
+        self.finished_at = time.monotonic()
+        self.version += 1
+
+    def snapshot(self):
+        status = self.status or {}
+        phase = self.phase or {}
+        return {
+            'status': status.get('status'),
+            'downloaded_bytes': status.get('downloaded_bytes'),
+            'total_bytes': status.get('total_bytes') or status.get('total_bytes_estimate'),
+            'speed': status.get('speed'),
+            'eta': status.get('eta'),
+            'fragment_index': status.get('fragment_index'),
+            'fragment_count': status.get('fragment_count'),
+            'postprocessor': phase.get('postprocessor'),
+            'postprocessor_status': phase.get('status'),
+            'done': self.finished_at is not None,
+            'error': self.error,
+        }
+
+
+class ProgressRegistry:
+    """Maps download keys and client-visible ids to progress trackers."""
+
+    def __init__(self, retention):
+        self.retention = retention
+        self._trackers = {}  # download key -> tracker
+        self._aliases = {}  # progress/job id -> download key
+        self._lock = threading.Lock()
+
+    def tracker(self, key):
+        with self._lock:
+            self._prune()
+            tracker = self._trackers.get(key)
+            if tracker is None or tracker.finished_at is not None:
+                tracker = self._trackers[key] = ProgressTracker()
+            return tracker
+
+    def alias(self, public_id, key):
+        with self._lock:
+            self._aliases[public_id] = key
+
+    def lookup(self, public_id):
+        with self._lock:
+            key = self._aliases.get(public_id)
+            return self._trackers.get(key) if key is not None else None
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.retention
+        stale = [k for k, t in self._trackers.items()
+                 if t.finished_at is not None and t.finished_at < cutoff]
+        for key in stale:
+            del self._trackers[key]
+        if stale:
+            self._aliases = {a: k for a, k in self._aliases.items() if k in self._trackers}
+
+
+progress_registry = ProgressRegistry(PROGRESS_RETENTION)
+
+
+def sse_event(data, event=None):
+    """Encode one Server-Sent Event."""
+    head = f'event: {event}\n' if event else ''
+    return f'{head}data: {json.dumps(data)}\n\n'
+
+
+class ProgressFeed:
+    """SSE progress events for one subscriber, produced by polling at a fixed rate.
+
+    ``get_tracker`` returns the current tracker (or None while the work is
+    still queued); ``get_state`` optionally reports an outer job state.
+    Each ``poll`` returns the events due now and sets ``done`` after the last.
+    """
+
+    def __init__(self, get_tracker, get_state=None):
+        self.get_tracker = get_tracker
+        self.get_state = get_state
+        self.done = False
+        self._last_version = None
+        self._last_sent = 0.0
+
+    def poll(self):
+        tracker = self.get_tracker()
+        state = self.get_state() if self.get_state else None
+        if tracker is None:
+            if state in (None, 'failed', 'finished', 'cancelled'):
+                self.done = True
+                return [sse_event({'state': state}, event='done')]
+            payload_version = ('state', state)
+            payload = {'state': state}
+        else:
+            payload_version = (tracker.version, state)
+            payload = None
+        
+        now = time.monotonic()
+        if payload_version != self._last_version:
+            if payload is None:
+                payload = tracker.snapshot()
+                if state is not None:
+                    payload['state'] = state
+            self._last_version = payload_version
+            self._last_sent = now
+            if (tracker is not None and tracker.finished_at is not None
+                    and state in (None, 'failed', 'finished', 'cancelled')):
+                self.done = True
+                return [sse_event(payload), sse_event(payload, event='done')]
+            return [sse_event(payload)]
+        if now - self._last_sent >= PROGRESS_HEARTBEAT:
+            self._last_sent = now
+            return [': keep-alive\n\n']
+        return []
+
+
+def job_feed(job_id):
+    """Progress feed of a background job, or None if the job is unknown."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return None
+    
+    def current():
+        # Re-read so jobs queued or run by another worker report their state
+        return job_manager.get(job_id) or job
+    
+    return ProgressFeed(lambda: current().tracker, lambda: current().state)
+
+
+def download_feed(progress_id):
+    """Progress feed of a /download request by its client-chosen progress_id,
+    or None while no download has registered it."""
+    if progress_registry.lookup(progress_id) is None:
+        return None
+    return ProgressFeed(lambda: progress_registry.lookup(progress_id))
+
+
+def pending_progress():
+    """Answer to a subscriber that arrived before its /download registered:
+    a single event telling EventSource when to reconnect, instead of holding
+    the connection while the download catches up."""
+    return f'retry: {PROGRESS_PENDING_RETRY_MS}\n' + sse_event({'state': 'pending'})
+
+
+def stream_progress(feed):
+    """Yield a feed's SSE events at a fixed rate until the download ends."""
+    while True:
+        yield from feed.poll()
+        if feed.done:
+            return
+        time.sleep(PROGRESS_INTERVAL)
+
+
+def sse_response(events):
+    return Response(events, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+class CancelScope:
+    """Cancellation state of one in-flight download, shared by all its waiters.
+
+    Every waiter (a request, job or bulk item) holds a CancelToken on the
+    scope, and the run is aborted only once all of them have cancelled:
+    the yt-dlp hooks then raise DownloadCancelled and the registered
+    callbacks kill any ffmpeg child still working for it.
+    """
+
+    def __init__(self, registry, key):
+        self.registry = registry
+        self.key = key
+        self.parties = 0
+        self.cancelled = False
+        self.reason = None
+        self._callbacks = []
+        self._progress = {}  # filename -> latest yt-dlp status dict
+        self._lock = threading.Lock()
+
+    def on_cancel(self, callback):
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def check(self):
+        if self.cancelled:
+            raise ytdlp.DownloadCancelled(self.reason)
+
+    def progress_hook(self, d):
+        # Per chunk, like ProgressTracker: keep yt-dlp's dict, build nothing
+        self._progress[d.get('filename')] = d
+        self.check()
+
+    def postprocessor_hook(self, d):
+        self.check()
+
+    def remaining_bytes(self):
+        remaining = 0
+        for d in list(self._progress.values()):
+            total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+            remaining += max(0, total - (d.get('downloaded_bytes') or 0))
+        return int(remaining)
+
+    def leave(self, reason=None):
+        with self._lock:
+            self.parties -= 1
+            abandon = reason is not None and self.parties == 0 and not self.cancelled
+            if abandon:
+                self.cancelled = True
+                self.reason = reason
+                callbacks, self._callbacks = self._callbacks, []
+        if abandon:
+            self.registry.record_abandoned(self)
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"Cancel callback failed: {e}")
+
+
+class CancelToken:
+    """One waiter's interest in a download; cancel() withdraws it."""
+
+    def __init__(self, registry, scope, public_id=None):
+        self.registry = registry
+        self.scope = scope
+        self.public_id = public_id
+        self.cancelled = False
+        self.closed = False
+
+    def cancel(self, reason='cancelled by client'):
+        if self.closed or self.cancelled:
+            return
+        self.cancelled = True
+        self.registry.record_cancel(self, reason)
+        self.scope.leave(reason)
+
+    def close(self):
+        """The waiter is done (or gave up already): stop tracking it."""
+        if self.closed:
+            return
+        self.closed = True
+        if not self.cancelled:
+            self.scope.leave()
+        self.registry.forget(self)
+
+
+class CancelRegistry:
+    """Cancel scopes per download key, and tokens per client-visible id."""
+
+    def __init__(self):
+        self._scopes = {}  # download key -> scope
+        self._tokens = {}  # progress/job id -> token
+        self._lock = threading.Lock()
+        self.cancelled_waiters = 0
+        self.disconnects = 0
+        self.aborted_runs = 0
+        self.bytes_avoided = 0
+        self.processes_killed = 0
+        self.streams_closed = 0
+
+    def join(self, key, public_id=None):
+        with self._lock:
+            scope = self._scopes.get(key)
+            if scope is None or scope.cancelled or scope.parties <= 0:
+                # A scope being abandoned cannot be revived; start fresh
+                scope = self._scopes[key] = CancelScope(self, key)
+            scope.parties += 1
+            token = CancelToken(self, scope, public_id)
+            if public_id is not None:
+                self._tokens[public_id] = token
+            return token
+
+    def cancel(self, public_id, reason='cancelled by client'):
+        with self._lock:
+            token = self._tokens.get(public_id)
+        if token is None:
+            return False
+        token.cancel(reason)
+        return True
+
+    def forget(self, token):
+        with self._lock:
+            if token.public_id is not None and self._tokens.get(token.public_id) is token:
+                del self._tokens[token.public_id]
+            scope = token.scope
+            if scope.parties <= 0 and self._scopes.get(scope.key) is scope:
+                del self._scopes[scope.key]
+
+    def record_cancel(self, token, reason):
+        with self._lock:
+            self.cancelled_waiters += 1
+            if reason == 'client disconnected':
+                self.disconnects += 1
+
+    def record_abandoned(self, scope):
+        with self._lock:
+            self.aborted_runs += 1
+            self.bytes_avoided += scope.remaining_bytes()
+
+    def record_killed(self, count):
+        with self._lock:
+            self.processes_killed += count
+
+    def record_stream_closed(self):
+        with self._lock:
+            self.streams_closed += 1
 
-    tempdir = tempfile.mkdtemp(prefix='ydl_')
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._scopes),
+                'cancelled_waiters': self.cancelled_waiters,
+                'disconnects': self.disconnects,
+                'aborted_runs': self.aborted_runs,
+                'bytes_avoided': self.bytes_avoided,
+                'processes_killed': self.processes_killed,
+                'streams_closed': self.streams_closed,
+            }
+
+
+cancel_registry = CancelRegistry()
+
+
+def kill_workdir_processes(workdir):
+    """Kill our child processes (ffmpeg) whose command line mentions workdir.
+
+    yt-dlp owns the Popen objects, so the children are found through /proc;
+    where that is unavailable the hooks alone stop the run between stages.
+    """
+    me = os.getpid()
+    needle = os.fsencode(workdir)
+    killed = 0
+    try:
+        pids = [int(p) for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat', 'rb') as f:
+                ppid = int(f.read().rsplit(b')', 1)[1].split()[1])
+            if ppid != me:
+                continue
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                cmdline = f.read()
+        except (OSError, ValueError, IndexError):
+            continue
+        if needle in cmdline:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                killed += 1
+            except OSError:
+                pass
+    return killed
+
+
+class DisconnectWatcher:
+    """Background poller that cancels tokens of clients that hung up.
+
+    A closed connection turns readable and a MSG_PEEK read returns no data.
+    The request body has been consumed by then, so bytes waiting on the
+    socket are a pipelined next request and the client is still there.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._watched = {}  # socket -> token
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def client_socket(environ):
+        return environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+
+    def watch(self, sock, token):
+        with self._lock:
+            self._watched[sock] = token
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='disconnect-watcher', daemon=True)
+                self._thread.start()
+
+    def unwatch(self, sock):
+        with self._lock:
+            self._watched.pop(sock, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                watched = dict(self._watched)
+            socks = [s for s in watched if s.fileno() >= 0]
+            try:
+                readable, _, _ = select.select(socks, [], [], 0) if socks else ([], [], [])
+            except (OSError, ValueError):
+                continue
+            for sock in readable:
+                try:
+                    alive = bool(sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT))
+                except BlockingIOError:
+                    alive = True
+                except OSError:
+                    alive = False
+                if not alive:
+                    self.unwatch(sock)
+                    watched[sock].cancel('client disconnected')
+
+
+disconnect_watcher = DisconnectWatcher(DISCONNECT_POLL_INTERVAL)
+
+
+@contextmanager
+def cancellation(key, public_id=None, environ=None):
+    """Token for one waiter on a download, cancelled if its client hangs up.
+
+    Pass ``environ`` for a request that blocks until the file is ready; the
+    token is closed (no longer counted as interested) when the block exits.
+    """
+    token = cancel_registry.join(key, public_id)
+    sock = DisconnectWatcher.client_socket(environ) if environ is not None else None
+    if sock is not None:
+        disconnect_watcher.watch(sock, token)
+    try:
+        yield token
+    finally:
+        if sock is not None:
+            disconnect_watcher.unwatch(sock)
+        token.close()
+
+
+class TokenBucket:
+    """Refills ``rate`` tokens per second, holding at most ``burst``."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """Spend one token; returns 0, or the seconds until one is available."""
+        # ``now`` is read before the caller's lock, so it can trail ``updated``
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Rejected(Exception):
+    """A request turned away by admission control."""
+
+    def __init__(self, message, retry_after, status=429):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status = status
+
+    def response(self):
+        return str(self), self.status, {'Retry-After': str(max(1, math.ceil(self.retry_after)))}
+
+
+class AdmissionControl:
+    """Per-client request rate and concurrent download limits.
+
+    Clients are keyed by API key when they send one, otherwise by address.
+    Over-limit requests are rejected straight away with a Retry-After hint
+    instead of queuing. Idle clients' buckets are forgotten LRU-first once
+    more than ``max_clients`` are tracked.
+    """
+
+    def __init__(self, rates, max_active, max_clients):
+        self.rates = rates  # kind -> (rate, burst)
+        self.max_active = max_active
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()  # (client, kind) -> bucket
+        self._active = {}  # client -> downloads in progress
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rate_limited = 0
+        self.concurrency_limited = 0
+
+    def check_rate(self, client, kind):
+        rate, burst = self.rates.get(kind, (0, 0))
+        if rate <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get((client, kind))
+            if bucket is None:
+                bucket = self._buckets[(client, kind)] = TokenBucket(rate, burst)
+                if len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end((client, kind))
+            wait = bucket.take(now)
+            if wait:
+                self.rate_limited += 1
+                raise Rejected('Too many requests, slow down', wait)
+            self.admitted += 1
+
+    def acquire(self, client):
+        """Take one of the client's download slots, or raise Rejected."""
+        with self._lock:
+            active = self._active.get(client, 0)
+            if self.max_active and active >= self.max_active:
+                self.concurrency_limited += 1
+                raise Rejected(f'At most {self.max_active} downloads at a time', CLIENT_RETRY_AFTER)
+            self._active[client] = active + 1
+
+    def release(self, client):
+        with self._lock:
+            active = self._active.get(client, 0) - 1
+            if active > 0:
+                self._active[client] = active
+            else:
+                self._active.pop(client, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tracked_buckets': len(self._buckets),
+                'active_clients': len(self._active),
+                'active_downloads': sum(self._active.values()),
+                'admitted': self.admitted,
+                'rate_limited': self.rate_limited,
+                'concurrency_limited': self.concurrency_limited,
+            }
+
+
+admission = AdmissionControl(
+    {'probe': (CLIENT_PROBE_RATE, CLIENT_PROBE_BURST),
+     'download': (CLIENT_DOWNLOAD_RATE, CLIENT_DOWNLOAD_BURST)},
+    CLIENT_MAX_ACTIVE, CLIENT_TRACK_MAX)
+
+
+def client_key(api_key, access_route, remote_addr):
+    """Admission key from a request's API key, forwarding chain and peer address."""
+    if api_key:
+        return 'key:' + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    if TRUST_FORWARDED_FOR and access_route:
+        return 'ip:' + access_route[0]
+    return 'ip:' + (remote_addr or '-')
+
+
+def client_id():
+    """Admission key of the current request."""
+    return client_key(request.headers.get(CLIENT_KEY_HEADER), request.access_route, request.remote_addr)
+
+
+def rate_limited(kind):
+    """Route decorator: spend one of the client's ``kind`` tokens or answer 429."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                admission.check_rate(client_id(), kind)
+            except Rejected as e:
+                return e.response()
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class BandwidthBudget:
+    """Splits a global download rate evenly across running yt-dlp downloads.
+
+    yt-dlp's HTTP downloader re-reads ``ratelimit`` from its params while it
+    throttles, so shares are rebalanced live as downloads start and finish.
+    The limit applies per connection, so each download's share is divided
+    across its parallel connections: one per stream, times the fragment
+    threads once the progress hook shows a fragmented download.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self._runs = {}  # id(ydl) -> [params, connections]
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def share(self, ydl, streams=1, fragments=1):
+        if not self.total:
+            yield
+            return
+        run = [ydl.params, max(1, streams)]
+        
+        def hook(d):
+            if d.get('fragment_count') and run[1] == max(1, streams):
+                with self._lock:
+                    run[1] = max(1, streams) * max(1, fragments)
+                    self._rebalance()
+        
+        ydl.add_progress_hook(hook)
+        with self._lock:
+            self._runs[id(ydl)] = run
+            self._rebalance()
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._runs[id(ydl)]
+                self._rebalance()
+
+    def _rebalance(self):
+        if not self._runs:
+            return
+        per_run = self.total / len(self._runs)
+        for params, connections in self._runs.values():
+            params['ratelimit'] = max(1024, int(per_run / connections))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': self.total,
+                'active': len(self._runs),
+                'per_download': int(self.total / len(self._runs)) if self.total and self._runs else None,
+            }
+
+
+bandwidth_budget = BandwidthBudget(BANDWIDTH_LIMIT)
+
+
+class PriorityGate:
+    """Counting semaphore that admits waiters by priority, then arrival order."""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.active = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def acquire(self, priority=0, cancel=None):
+        """Block until a slot is ours; raises if ``cancel`` fires while queued."""
+        with self._lock:
+            if self.active < self.slots and not self._waiters:
+                self.active += 1
+                return
+            event = threading.Event()
+            entry = (-priority, next(self._seq), event)
+            heapq.heappush(self._waiters, entry)
+        # release() hands its slot straight to us before setting the event
+        if cancel is None:
+            event.wait()
+            return
+        while not event.wait(DISCONNECT_POLL_INTERVAL):
+            if not cancel.cancelled:
+                continue
+            with self._lock:
+                granted = event.is_set()
+                if not granted:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+            if granted:
+                self.release()
+            cancel.check()
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                _, _, event = heapq.heappop(self._waiters)
+                event.set()
+            else:
+                self.active -= 1
+
+    def stats(self):
+        with self._lock:
+            return {'slots': self.slots, 'active': self.active, 'waiting': len(self._waiters)}
+
+
+class FFmpegScheduler:
+    """Caps concurrent ffmpeg processes across all downloads and streams.
+
+    yt-dlp calls postprocessor hooks with ``started`` right before a
+    postprocessor runs and ``finished`` after it, so blocking in the
+    ``started`` hook until a slot is free gates the ffmpeg process itself.
+    ffmpeg started elsewhere (streamed muxes and transcodes, clip sections
+    fetched by yt-dlp's FFmpegFD) takes its slot through ``hold``.
+    Stream-copy stages (merge, remux, metadata) and re-encodes use separate
+    gates so cheap work never queues behind expensive work.
+    """
+
+    def __init__(self, copy_slots, transcode_slots):
+        self.gates = {
+            'copy': PriorityGate(copy_slots),
+            'transcode': PriorityGate(transcode_slots),
+        }
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def session(self, plan=None, priority=0, cancel=None):
+        """Scheduler session of one download (its ``hook`` gates postprocessors);
+        releases any held slot on exit."""
+        session = _FFmpegSession(self, plan, priority, cancel)
+        try:
+            yield session
+        finally:
+            session.close()
+
+    def hold(self, kind, stage, priority=0, cancel=None):
+        """Block for a ``kind`` ('copy' or 'transcode') slot; returns the
+        session holding it, which the caller closes once ffmpeg has exited."""
+        session = _FFmpegSession(self, None, priority, cancel)
+        session.hold(stage, kind)
+        return session
+
+    def record(self, stage, waited, ran):
+        with self._lock:
+            st = self._stages.setdefault(stage, {
+                'runs': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0, 'run_seconds': 0.0})
+            st['runs'] += 1
+            st['wait_seconds'] += waited
+            st['max_wait_seconds'] = max(st['max_wait_seconds'], waited)
+            st['run_seconds'] += ran
+
+    def stats(self):
+        with self._lock:
+            stages = {k: dict(v) for k, v in self._stages.items()}
+        return {
+            'gates': {name: gate.stats() for name, gate in self.gates.items()},
+            'stages': stages,
+        }
+
+
+class _FFmpegSession:
+    def __init__(self, scheduler, plan, priority, cancel=None):
+        self.scheduler = scheduler
+        self.plan = plan or {}
+        self.priority = priority
+        self.cancel = cancel
+        self.held = None  # (gate, stage, acquired_at, waited)
+        self.depth = 0
+
+    def gate_for(self, stage):
+        if stage == 'ExtractAudio' and self.plan.get('path', 'transcode') == 'transcode':
+            return self.scheduler.gates['transcode']
+        return self.scheduler.gates['copy']
+
+    def hook(self, d):
+        stage = d.get('postprocessor')
+        if stage in NON_FFMPEG_POSTPROCESSORS:
+            return
+        if d['status'] == 'started':
+            # yt-dlp may report the same stage twice (nested run wrappers)
+            if self.held is not None and self.held[1] == stage:
+                self.depth += 1
+                return
+            self._take(self.gate_for(stage), stage)
+        elif d['status'] == 'finished':
+            self.depth -= 1
+            if self.depth <= 0:
+                self.close()
+
+    def hold(self, stage, kind):
+        """Take a slot for ffmpeg run outside the postprocessor hooks; the
+        next postprocessor, or close(), gives it back."""
+        self._take(self.scheduler.gates[kind], stage)
+
+    def _take(self, gate, stage):
+        self.close()
+        queued_at = time.monotonic()
+        gate.acquire(self.priority, self.cancel)
+        now = time.monotonic()
+        self.held = (gate, stage, now, now - queued_at)
+        self.depth = 1
+
+    def close(self):
+        if self.held is None:
+            return
+        gate, stage, acquired_at, waited = self.held
+        self.held = None
+        self.depth = 0
+        gate.release()
+        ran = time.monotonic() - acquired_at
+        self.scheduler.record(stage, waited, ran)
+        print(f"ffmpeg stage {stage}: waited {waited:.2f}s, ran {ran:.2f}s")
+
+
+ffmpeg_scheduler = FFmpegScheduler(FFMPEG_COPY_SLOTS, FFMPEG_TRANSCODE_SLOTS)
+
+
+class FragmentBudget:
+    """Per-process pool of fragment download threads shared by all jobs.
+
+    Grants never block: a job gets what it asked for if the pool allows,
+    otherwise what is left, and always at least one thread per stream so
+    it still progresses sequentially when the pool is exhausted.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, streams, per_stream):
+        with self._lock:
+            available = max(0, self.total - self.in_use)
+            per_stream = max(1, min(per_stream, available // streams))
+            self.in_use += per_stream * streams
+            return per_stream
+
+    def release(self, streams, per_stream):
+        with self._lock:
+            self.in_use -= per_stream * streams
+
+    def stats(self):
+        with self._lock:
+            return {'total': self.total, 'in_use': self.in_use}
+
+
+fragment_budget = FragmentBudget(FRAGMENT_THREADS_MAX)
+
+
+@ytdlp.extend
+def _parallel_streams_ydl(yt):
+    class ParallelStreamsYoutubeDL(yt.YoutubeDL):
+        """YoutubeDL that downloads the video and audio of a merged format at once.
+
+        yt-dlp fetches ``requested_formats`` one after the other. While such a
+        format is being processed, each component ``dl`` call is started on
+        its own thread and reported as successful; ``post_process`` (which runs
+        the merger) waits for all of them and fails if any did.
+        """
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._pending = None
+
+        def process_info(self, info_dict):
+            parallel = len(info_dict.get('requested_formats') or ()) > 1
+            self._pending = [] if parallel else None
+            try:
+                return super().process_info(info_dict)
+            finally:
+                # Never leave component downloads running past this video
+                pending, self._pending = self._pending, None
+                for thread, _ in pending or ():
+                    thread.join()
+
+        def dl(self, name, info, subtitle=False, test=False):
+            if self._pending is None or subtitle or test or name == '-' or info.get('requested_formats'):
+                return super().dl(name, info, subtitle, test)
+            
+            outcome = {}
+            
+            def fetch():
+                try:
+                    outcome['result'] = super(ParallelStreamsYoutubeDL, self).dl(name, info)
+                except BaseException as e:
+                    outcome['error'] = e
+            
+            thread = threading.Thread(target=fetch, name=f'stream-{info.get("format_id")}', daemon=True)
+            self._pending.append((thread, outcome))
+            thread.start()
+            return True, True
+
+        def post_process(self, filename, info, files_to_move=None):
+            pending = self._pending or []
+            if self._pending is not None:
+                self._pending = []
+            for thread, outcome in pending:
+                thread.join()
+            for _, outcome in pending:
+                if 'error' in outcome:
+                    raise outcome['error']
+                if not outcome.get('result', (False,))[0]:
+                    raise yt.DownloadError('unable to download one of the requested formats')
+            return super().post_process(filename, info, files_to_move)
+
+    return ParallelStreamsYoutubeDL
+
+
+class NotStreamable(Exception):
+    """The selected formats cannot be relayed while downloading."""
+
+
+def content_disposition(name):
+    """Content-Disposition header for an attachment, as send_file builds it."""
+    try:
+        name.encode('ascii')
+        simple = name.replace('"', '')
+        return f'attachment; filename="{simple}"'
+    except UnicodeEncodeError:
+        simple = name.encode('ascii', 'ignore').decode('ascii').replace('"', '') or 'download'
+        return f"attachment; filename=\"{simple}\"; filename*=UTF-8''{quote(name)}"
+
+
+def ffmpeg_input_args(fmt):
+    args = []
+    headers = fmt.get('http_headers') or {}
+    if headers:
+        args += ['-headers', ''.join(f'{k}: {v}\r\n' for k, v in headers.items())]
+    return args + ['-i', fmt['url']]
+
+
+def stream_command(formats, is_audio, audio_format):
+    """Build the ffmpeg command that muxes the selected formats to stdout."""
+    if not shutil.which('ffmpeg'):
+        raise NotStreamable('ffmpeg is not installed')
+    if is_audio and audio_format not in STREAM_AUDIO_CODECS:
+        raise NotStreamable(f'no streaming encoder for {audio_format}')
+    cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error']
+    for fmt in formats:
+        cmd += ffmpeg_input_args(fmt)
+    for i in range(len(formats)):
+        cmd += ['-map', str(i)]
+    
+    if is_audio:
+        container = audio_format
+        cmd += STREAM_AUDIO_CODECS[audio_format]
+    else:
+        # Fragmented MP4 when the codecs allow it, Matroska otherwise
+        exts = {f.get('ext') for f in formats}
+        container = 'mp4' if exts <= {'mp4', 'm4a'} else 'mkv'
+        cmd += STREAM_CONTAINERS[container]
+    return cmd + ['pipe:1'], container
+
+
+def relay_http(ydl, fmt):
+    """Open a single pre-muxed format upstream; returns (chunks, length)."""
+    from yt_dlp.networking import Request
+    upstream = ydl.urlopen(Request(fmt['url'], headers=fmt.get('http_headers') or {}))
+    length = upstream.headers.get('Content-Length')
+    
+    def chunks():
+        try:
+            while True:
+                chunk = upstream.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            upstream.close()
+    
+    return chunks(), length
+
+
+def stream_gate(cmd):
+    """Scheduler gate for a streaming ffmpeg command: 'copy' unless it encodes."""
+    codecs = [cmd[i + 1] for i, arg in enumerate(cmd[:-1]) if arg in ('-c', '-c:a', '-c:v')]
+    return 'copy' if all(codec == 'copy' for codec in codecs) else 'transcode'
+
+
+def relay_ffmpeg(cmd):
+    """Start ffmpeg writing to a pipe; returns chunks once output has started.
+
+    The process runs in an ffmpeg scheduler slot, held until it exits.
+    """
+    slot = ffmpeg_scheduler.hold(stream_gate(cmd), 'stream')
+    try:
+        errlog = tempfile.TemporaryFile()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errlog, bufsize=0)
+        first = proc.stdout.read(STREAM_CHUNK_SIZE)
+        if not first:
+            proc.wait()
+            errlog.seek(0)
+            message = errlog.read().decode('utf-8', 'replace').strip()
+            errlog.close()
+            raise RuntimeError(f'ffmpeg exited with code {proc.returncode}: {message}')
+    except BaseException:
+        slot.close()
+        raise
+    
+    def chunks():
+        try:
+            chunk = first
+            while chunk:
+                yield chunk
+                chunk = proc.stdout.read(STREAM_CHUNK_SIZE)
+        finally:
+            # Client went away or ffmpeg finished: never leave it running
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+            errlog.close()
+            slot.close()
+    
+    return chunks()
+
+
+def prepare_stream(url, opts, is_audio, audio_format, filename_hint):
+    """Work out how to stream a download; returns (ydl, out_name, fmt, cmd).
+
+    A single pre-muxed format that already matches the requested output is
+    proxied as-is (``fmt``); anything else goes through ``cmd``, an ffmpeg
+    command writing a streamable container to stdout. The caller closes
+    ``ydl``. Raises NotStreamable when the result has to go through a file.
+    """
+    if opts.get('download_ranges'):
+        raise NotStreamable('clips are cut by ffmpeg into a file')
+    ydl = ytdlp.YoutubeDL(dict(YDL_PROBE_OPTS, format=opts['format']))
+    try:
+        info = ydl.extract_info(url, download=False)
+        formats = info.get('requested_formats') or [info]
+        if any(f.get('protocol') not in STREAMABLE_PROTOCOLS for f in formats):
+            raise NotStreamable('format uses a protocol that cannot be streamed')
+        
+        single = formats[0]
+        passthrough = (
+            len(formats) == 1
+            and single.get('protocol') in ('http', 'https')
+            and (single.get('ext') == audio_format if is_audio else single.get('ext') == 'mp4')
+        )
+        fmt = cmd = None
+        if passthrough:
+            fmt = single
+            ext = single['ext']
+        else:
+            cmd, ext = stream_command(formats, is_audio, audio_format)
+    except BaseException:
+        ydl.close()
+        raise
+    title = info.get('title') or info.get('id') or 'download'
+    return ydl, f"{filename_hint or title}.{ext}", fmt, cmd
+
+
+def stream_download(url, opts, is_audio, audio_format, filename_hint):
+    """Relay the requested media to the client while it is being fetched.
+
+    Buffering is bounded by the ffmpeg pipe (or upstream socket) and one chunk.
+    """
+    ydl, out_name, fmt, cmd = prepare_stream(url, opts, is_audio, audio_format, filename_hint)
+    length = None
+    try:
+        if fmt is not None:
+            chunks, length = relay_http(ydl, fmt)
+        else:
+            chunks = relay_ffmpeg(cmd)
+    except BaseException:
+        ydl.close()
+        raise
+    
+    def body():
+        try:
+            for chunk in chunks:
+                metrics.served(len(chunk))
+                yield chunk
+        except GeneratorExit:
+            # Client went away mid-stream; closing chunks stops the upstream work
+            cancel_registry.record_stream_closed()
+            raise
+        finally:
+            chunks.close()
+            ydl.close()
+    
+    headers = {'Content-Disposition': content_disposition(out_name)}
+    if length:
+        headers['Content-Length'] = length
+    print(f"Streaming {out_name} ({'passthrough' if fmt is not None else 'ffmpeg'})")
+    return Response(body(), mimetype='application/octet-stream', headers=headers)
+
+
+class NoFileProduced(Exception):
+    """yt-dlp finished without leaving a file in the temp dir."""
+
+
+def build_download_opts(url, fmt, audio_format, is_audio_only, embed_metadata=False,
+                        clip=None, precise_cuts=False):
+    """Translate a /download request into yt-dlp options (without outtmpl).
+
+    ``clip`` is a ``(start, end)`` window from ``request_clip``; only that
+    range is fetched. Returns ``(opts, is_audio, plan)`` where plan
+    describes the postprocessing chain chosen by ``plan_postprocessing``.
+    """
+    opts = {
+        'quiet': False,
+        'no_warnings': False,
+    }
+    
+    # Check if this is audio-only based on format string or flag
+    is_audio = is_audio_only or fmt == 'bestaudio' or ('+' not in fmt and 'audio' in fmt.lower())
+    
+    if is_audio:
+        # Audio-only download; conversion is decided by the planner
+        opts['format'] = 'bestaudio/best'
+    else:
+        # Video download - ALWAYS ensure audio is included
+        # This is the critical fix
+        if '+' in fmt:
+            # User manually selected video+audio
+            opts['format'] = fmt
+        elif 'bestvideo' in fmt or 'best' in fmt:
+            # Quick select options - already have proper format strings
+            opts['format'] = fmt
+        else:
+            # Single video format selected - FORCE audio addition
+            # Check if the format actually has audio
+            with timed('audio-check'):
+                format_has_audio = _check_format_has_audio(url, fmt)
+            
+            if format_has_audio:
+                # Format already includes audio
+                opts['format'] = fmt
+            else:
+                # Video-only format - MUST add audio
+                opts['format'] = f"{fmt}+bestaudio/bestaudio*"
+                print(f"Selected format {fmt} has no audio, adding bestaudio")
+        
+        # Always merge to mp4 for maximum compatibility
+        opts['merge_output_format'] = 'mp4'
+        
+        # Additional options for better quality
+        opts['prefer_ffmpeg'] = True
+        opts['keepvideo'] = False
+    
+    try:
+        info = get_probe(url)
+        with timed('plan'):
+            selected = select_formats(info, opts['format'])
+    except Exception as e:
+        print(f"Could not resolve {opts['format']} for planning: {e}")
+        selected = None
+    postprocessors, plan = plan_postprocessing(selected, is_audio, audio_format, embed_metadata)
+    opts['postprocessors'] = postprocessors
+    if clip is not None:
+        # yt-dlp hands sections to ffmpeg, which seeks instead of reading from the start
+        opts['download_ranges'] = ytdlp.download_range_func(None, [clip])
+        opts['force_keyframes_at_cuts'] = precise_cuts
+        plan['clip'] = [clip[0], None if math.isinf(clip[1]) else clip[1]]
+        if precise_cuts:
+            # Cutting between keyframes means re-encoding around the cuts
+            plan['path'] = 'transcode'
+            plan['steps'].append('ForceKeyframes')
+    plan['scratch_bytes'] = estimate_scratch_bytes(info, selected, plan) if selected else None
+    print(f"Postprocessing plan: {plan['path']} ({', '.join(plan['steps']) or 'no ffmpeg'})")
+    return opts, is_audio, plan
+
+
+def estimate_scratch_bytes(info, selected, plan):
+    """Peak disk use expected for a download plan, or None if unknown.
+
+    Stream sizes come from the probe: ``filesize``, ``filesize_approx``, or
+    total bitrate × duration. Anything but a plain copy writes its output
+    next to the downloaded streams, so those plans count them twice.
+    """
+    duration = info.get('duration')
+    total = 0
+    for f in selected:
+        size = f.get('filesize') or f.get('filesize_approx')
+        if not size and f.get('tbr') and duration:
+            size = f['tbr'] * 1000 / 8 * duration
+        if not size:
+            return None
+        total += size
+    if plan.get('clip') and duration:
+        start, end = plan['clip']
+        total *= min(1.0, max(0.0, (duration if end is None else end) - start) / duration)
+    if plan['path'] != 'copy':
+        total *= 2
+    return int(total * SCRATCH_HEADROOM)
+
+
+def select_formats(info, spec):
+    """Run yt-dlp's format selector over cached probe data.
+
+    Returns the component formats that ``spec`` resolves to (one, or a
+    video+audio pair), or None if nothing matches.
+    """
+    formats = info.get('formats') or []
+    with ydl_pool.acquire() as ydl:
+        selector = ydl.build_format_selector(spec)
+        chosen = list(selector({
+            'formats': formats,
+            'has_merged_format': any('none' not in (f.get('acodec'), f.get('vcodec')) for f in formats),
+            'incomplete_formats': (all(f.get('vcodec') == 'none' for f in formats)
+                                   or all(f.get('acodec') == 'none' for f in formats)),
+        }))
+    if not chosen:
+        return None
+    return chosen[0].get('requested_formats') or [chosen[0]]
+
+
+def describe_plan(plan):
+    """Compact header form of a postprocessing plan."""
+    parts = [
+        plan['path'],
+        f"formats={'+'.join(plan['formats']) or 'unknown'}",
+        f"steps={','.join(plan['steps']) or 'none'}",
+    ]
+    if plan.get('clip'):
+        start, end = plan['clip']
+        parts.append(f"clip={start:g}-{'' if end is None else f'{end:g}'}")
+    return '; '.join(parts)
+
+
+def parse_timestamp(value):
+    """Seconds from a number or an ``[[HH:]MM:]SS`` string; None when empty."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        seconds = float(value)
+    else:
+        seconds = ytdlp.parse_duration(str(value).strip())
+    if seconds is None or seconds < 0 or math.isnan(seconds):
+        raise ValueError(f'Invalid time: {value!r}')
+    return seconds
+
+
+def request_clip(data, url):
+    """Time window asked for by a download request, or None for the whole media.
+
+    ``start``/``end`` are seconds or timestamps. ``chapters`` names chapters
+    from the probe data (case-insensitive); the window then runs from the
+    first selected chapter to the end of the last, and an explicit start
+    or end overrides that bound. Raises ValueError for a bad request,
+    including a URL whose chapters cannot be probed.
+    """
+    start = parse_timestamp(data.get('start'))
+    end = parse_timestamp(data.get('end'))
+    names = data.get('chapters') or []
+    if isinstance(names, str):
+        names = [names]
+    if names:
+        try:
+            info = get_probe(url)
+        except Exception as e:
+            raise ValueError(f'Probe failed: {str(e)}') from e
+        chapters = {(c.get('title') or '').casefold(): c for c in info.get('chapters') or []}
+        missing = [n for n in names if n.casefold() not in chapters]
+        if missing:
+            raise ValueError(f"Unknown chapter: {', '.join(missing)}")
+        picked = [chapters[n.casefold()] for n in names]
+        if start is None:
+            start = min(c['start_time'] for c in picked)
+        if end is None:
+            end = max(c['end_time'] for c in picked)
+    if not start and end is None:
+        return None
+    start = start or 0.0
+    end = float('inf') if end is None else end
+    if end <= start:
+        raise ValueError('Clip end must be after its start')
+    return (start, end)
+
+
+def request_priority(data):
+    """Scheduling priority asked for by a download request, clamped to the
+    configured range. Raises ValueError for a bad request."""
+    value = data.get('priority') or 0
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError('Priority must be an integer')
+    try:
+        priority = int(value)
+    except (ValueError, OverflowError):
+        raise ValueError('Priority must be an integer') from None
+    return max(-MAX_PRIORITY, min(MAX_PRIORITY, priority))
+
+
+def clip_ranges(opts):
+    """Requested download ranges as plain lists, for cache keys."""
+    ranges = getattr(opts.get('download_ranges'), 'ranges', None)
+    if not ranges:
+        return None
+    return [[start, None if math.isinf(end) else end] for start, end in ranges]
+
+
+def _codec_family(codec):
+    return (codec or 'none').split('.')[0].lower()
+
+
+def plan_postprocessing(selected, is_audio, audio_format, embed_metadata=False):
+    """Pick the cheapest postprocessor chain that yields the requested output.
+
+    ``copy`` keeps the downloaded file as-is, ``remux`` only rewrites the
+    container (stream copy), ``transcode`` re-encodes. Without selection
+    data the conservative chain is used.
+    """
+    plan = {
+        'path': 'transcode' if is_audio else 'remux',
+        'formats': [f.get('format_id') for f in selected or []],
+        'steps': [],
+    }
+    postprocessors = []
+    
+    if is_audio:
+        source = selected[0] if selected and len(selected) == 1 else None
+        source_codec = _codec_family(source.get('acodec')) if source else None
+        has_video = source is not None and source.get('vcodec') not in (None, 'none')
+        # Targets without a codec family here (flac, aac, ...) are always transcoded
+        families = AUDIO_CODEC_FAMILIES.get(audio_format, set())
+        if source and not has_video and source.get('ext') == audio_format and (
+                source_codec in families or source_codec == 'none'):
+            plan['path'] = 'copy'
+        else:
+            extract = {'key': 'FFmpegExtractAudio', 'preferredcodec': audio_format}
+            if source_codec in families:
+                # yt-dlp stream-copies the audio track when the codec already matches
+                plan['path'] = 'remux'
+            else:
+                extract['preferredquality'] = '192'
+            postprocessors.append(extract)
+    elif selected is None:
+        postprocessors.append({'key': 'FFmpegVideoRemuxer', 'preferedformat': 'mp4'})
+        plan['steps'].append('Merger')
+    elif len(selected) > 1:
+        # The merger writes merge_output_format directly with stream copy
+        plan['steps'].append('Merger')
+    elif selected[0].get('ext') == 'mp4':
+        plan['path'] = 'copy'
+    else:
+        postprocessors.append({'key': 'FFmpegVideoRemuxer', 'preferedformat': 'mp4'})
+    
+    if embed_metadata:
+        postprocessors.append({'key': 'FFmpegMetadata'})
+        if plan['path'] == 'copy':
+            plan['path'] = 'remux'
+    
+    plan['steps'] += [pp['key'] for pp in postprocessors]
+    return postprocessors, plan
+
+
+def download_key(url, opts):
+    """Identity of a download: URL, resolved format, postprocessing and clip."""
+    key = [
+        normalize_url(url),
+        opts.get('format'),
+        opts.get('merge_output_format'),
+        opts.get('postprocessors', []),
+    ]
+    if clip_ranges(opts):
+        key += [clip_ranges(opts), bool(opts.get('force_keyframes_at_cuts'))]
+    return json.dumps(key, sort_keys=True)
+
+
+def tree_size(path):
+    """Bytes in the files under ``path`` (vanishing files are skipped)."""
+    total = 0
+    for dirpath, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+class ScratchDir:
+    """One download's working directory and the bytes reserved for it."""
+
+    def __init__(self, space, reserved):
+        self.space = space
+        self.reserved = reserved
+        self.path = None
+        self._used = 0
+        self._measured_at = None
+
+    def used(self):
+        """Bytes written so far, walked at most every SCRATCH_USAGE_TTL seconds."""
+        if not self.path:
+            return 0
+        now = time.monotonic()
+        if self._measured_at is None or now - self._measured_at >= SCRATCH_USAGE_TTL:
+            self._used = tree_size(self.path)
+            self._measured_at = now
+        return self._used
+
+    def remove(self):
+        """Delete the directory and give its reservation back."""
+        if self.path:
+            shutil.rmtree(self.path, ignore_errors=True)
+        self.space._release(self)
+
+
+class ScratchSpace:
+    """Download working directories under one root, admitted against a disk budget.
+
+    A directory is only created once the bytes its download is expected to
+    need are reserved. Reservations are granted first come, first served
+    while this process's total stays within ``max_bytes`` and the
+    filesystem keeps ``min_free_bytes`` free after the unwritten part of
+    every reservation. Otherwise the caller waits, and is refused with 507
+    after ``wait`` seconds, or straight away if the download could never fit.
+
+    Directory names carry the owner's pid and start time (``ydl_PID.TICKS_*``),
+    so ``sweep`` can tell the leftovers of dead processes from the live
+    directories of sibling workers.
+    """
+
+    NAME_RE = re.compile(r'^ydl_(?:(\d+)\.(\d+)_)?[a-z0-9_]{8}$')
+
+    def __init__(self, root, max_bytes, min_free_bytes, default_reserve, orphan_age):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.default_reserve = default_reserve
+        self.orphan_age = orphan_age
+        os.makedirs(root, exist_ok=True)
+        self._cond = threading.Condition()
+        self._active = set()
+        self._reserved = 0
+        self._queue = deque()  # tickets of waiting callers, oldest first
+        self._tickets = itertools.count()
+        self.admitted = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.rejected = 0
+        self.peak_reserved = 0
+        self.swept_dirs = 0
+        self.swept_bytes = 0
+
+    def _unwritten(self):
+        return sum(max(0, d.reserved - d.used()) for d in self._active)
+
+    def _room(self, nbytes):
+        """Whether ``nbytes`` more can be reserved now (lock held)."""
+        if self.max_bytes and self._reserved + nbytes > self.max_bytes:
+            return False
+        free = shutil.disk_usage(self.root).free
+        return free - self._unwritten() - nbytes >= self.min_free_bytes
+
+    def _never_fits(self, nbytes):
+        """Whether ``nbytes`` would not fit even with every download here gone (lock held)."""
+        if self.max_bytes and nbytes > self.max_bytes:
+            return True
+        written = sum(d.used() for d in self._active)
+        return shutil.disk_usage(self.root).free + written - nbytes < self.min_free_bytes
+
+    def create(self, nbytes=None, wait=None, cancel=None):
+        """Reserve ``nbytes`` (a default when unknown) and make a directory for them.
+
+        ``cancel`` is the run's CancelScope; waiting ends once it is cancelled.
+        """
+        nbytes = self.default_reserve if nbytes is None else int(nbytes)
+        wait = SCRATCH_WAIT if wait is None else wait
+        started = time.monotonic()
+        queued = False
+        scratch_dir = ScratchDir(self, nbytes)
+        with self._cond:
+            ticket = next(self._tickets)
+            self._queue.append(ticket)
+            try:
+                while not (self._queue[0] == ticket and self._room(nbytes)):
+                    if self._never_fits(nbytes):
+                        self.rejected += 1
+                        raise Rejected(f'Download needs about {nbytes / 1024 ** 2:.0f} MiB of scratch '
+                                       f'space, more than this server has', SCRATCH_RETRY_AFTER, 507)
+                    remaining = wait - (time.monotonic() - started)
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise Rejected('Not enough scratch space, try again later', SCRATCH_RETRY_AFTER, 507)
+                    if cancel is not None:
+                        cancel.check()
+                    queued = True
+                    # Other processes free space too, so re-check now and then
+                    self._cond.wait(min(remaining, 1.0))
+                self._active.add(scratch_dir)
+                self._reserved += nbytes
+                self.peak_reserved = max(self.peak_reserved, self._reserved)
+                self.admitted += 1
+                if queued:
+                    self.waited += 1
+                    self.wait_seconds += time.monotonic() - started
+            finally:
+                self._queue.remove(ticket)
+                # The next caller in line may fit now
+                self._cond.notify_all()
+        try:
+            ticks = process_start_ticks() or 0
+            scratch_dir.path = tempfile.mkdtemp(prefix=f'ydl_{os.getpid()}.{ticks}_', dir=self.root)
+        except BaseException:
+            scratch_dir.remove()
+            raise
+        return scratch_dir
+
+    def _release(self, scratch_dir):
+        with self._cond:
+            if scratch_dir in self._active:
+                self._active.discard(scratch_dir)
+                self._reserved -= scratch_dir.reserved
+                self._cond.notify_all()
+
+    @staticmethod
+    def _alive(pid, ticks):
+        started = process_start_ticks(pid)
+        if started is not None:
+            # A different start time means the pid was reused
+            return not ticks or started == ticks
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def sweep(self):
+        """Remove directories left behind by processes that are gone."""
+        cache_root = os.path.realpath(RESULT_CACHE_DIR)
+        try:
+            entries = list(os.scandir(self.root))
+        except OSError as e:
+            print(f"Scratch sweep of {self.root} failed: {e}")
+            return
+        for entry in entries:
+            match = self.NAME_RE.match(entry.name)
+            if (match is None or not entry.is_dir(follow_symlinks=False)
+                    or os.path.realpath(entry.path) == cache_root):
+                continue
+            try:
+                if match.group(1) is not None:
+                    orphaned = not self._alive(int(match.group(1)), int(match.group(2)))
+                else:
+                    orphaned = time.time() - entry.stat().st_mtime > self.orphan_age
+            except OSError:
+                continue
+            if not orphaned:
+                continue
+            size = tree_size(entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
+            self.swept_dirs += 1
+            self.swept_bytes += size
+        print(f"Scratch space {self.root}: swept {self.swept_dirs} orphaned dirs ({self.swept_bytes} bytes)")
+
+    def used(self):
+        """Bytes written to this process's live dirs, as admission last measured them."""
+        with self._cond:
+            return sum(d.used() for d in self._active)
+
+    def stats(self):
+        with self._cond:
+            active = len(self._active)
+            waiting = len(self._queue)
+            reserved = self._reserved
+        try:
+            free = shutil.disk_usage(self.root).free
+        except OSError:
+            free = None
+        return {
+            'root': self.root,
+            'max_bytes': self.max_bytes,
+            'min_free_bytes': self.min_free_bytes,
+            'free_bytes': free,
+            'reserved_bytes': reserved,
+            'peak_reserved_bytes': self.peak_reserved,
+            'active': active,
+            'waiting': waiting,
+            'admitted': self.admitted,
+            'waited': self.waited,
+            'wait_seconds': round(self.wait_seconds, 3),
+            'rejected': self.rejected,
+            'swept_dirs': self.swept_dirs,
+            'swept_bytes': self.swept_bytes,
+        }
+
+
+scratch = ScratchSpace(SCRATCH_DIR, SCRATCH_MAX_BYTES, SCRATCH_MIN_FREE_BYTES,
+                       SCRATCH_DEFAULT_RESERVE, SCRATCH_ORPHAN_AGE)
+scratch.sweep()
+
+
+class DownloadResult:
+    """A finished download in its own scratch dir, deleted when the last user releases it."""
+
+    def __init__(self, scratch_dir, path):
+        self.scratch_dir = scratch_dir
+        self.path = path
+        self.name = path.name
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    def retain(self, count=1):
+        with self._lock:
+            self._refs += count
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+        self.scratch_dir.remove()
+
+
+def output_name(filename_hint, is_audio, audio_format, name):
+    """Name offered to the browser for a finished download."""
+    if filename_hint:
+        # Add appropriate extension
+        if is_audio:
+            return f"{filename_hint}.{audio_format}"
+        return f"{filename_hint}.mp4"
+    return name
+
+
+def on_response_close(response, callback):
+    """Run callback once the WSGI server is done sending the response body.
+
+    Werkzeug skips ``call_on_close`` for direct-passthrough (file) responses,
+    so for those the file wrapper's own ``close`` is chained instead, which
+    keeps the server's sendfile fast path intact. The callback runs just
+    before the file is closed, so it can still read how far it was sent.
+    """
+    if not response.direct_passthrough:
+        response.call_on_close(callback)
+        return response
+    body = response.response
+    if request.method == 'HEAD' or response.status_code == 304:
+        # No body will be sent, so the server never closes the file wrapper
+        body.close()
+        callback()
+        return response
+    inner_close = getattr(body, 'close', None)
+
+    def close():
+        try:
+            callback()
+        finally:
+            if inner_close is not None:
+                inner_close()
+
+    body.close = close
+    return response
+
+
+def file_bytes_sent(response):
+    """Bytes of a send_file response the server has sent, read off the file
+    position (iterating and sendfile both advance it)."""
+    body = getattr(response.response, 'iterable', response.response)
+    f = getattr(body, 'file', None) or getattr(body, 'filelike', None)
+    try:
+        sent = f.tell()
+    except (AttributeError, OSError, ValueError):
+        return 0
+    if response.status_code == 206 and response.content_range is not None:
+        sent -= response.content_range.start
+    return max(0, min(sent, response.content_length or sent))
+
+
+def offload_path(path):
+    """Location a fronting proxy should serve ``path`` from, or None.
+
+    Only files inside the result cache can be handed off: they outlive the
+    request, while uncached temp dirs are removed as soon as it closes. The
+    file's access time is refreshed, which shields it from eviction for
+    RESULT_OFFLOAD_GRACE while the proxy sends it.
+    """
+    if DELIVERY_BACKEND not in ('x-accel', 'x-sendfile'):
+        return None
+    try:
+        rel = Path(path).resolve().relative_to(Path(RESULT_CACHE_DIR).resolve())
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except (ValueError, OSError):
+        return None
+    if DELIVERY_BACKEND == 'x-accel':
+        return X_ACCEL_PREFIX.rstrip('/') + '/' + quote(rel.as_posix())
+    return os.path.join(X_SENDFILE_ROOT, str(rel))
+
+
+def deliver_file(result, download_name, **kwargs):
+    """Respond with a finished file through the configured delivery backend.
+
+    With a proxy backend the response carries only headers and the worker is
+    free immediately; otherwise send_file hands the open file to the WSGI
+    server's file_wrapper. ``result`` is released once the response closes.
+    Extra keyword arguments go to send_file (conditional, etag, max_age).
+    """
+    target = offload_path(result.path)
+    if target is None:
+        try:
+            response = send_file(
+                str(result.path),
+                as_attachment=True,
+                download_name=download_name,
+                mimetype='application/octet-stream',
+                **kwargs
+            )
+        except BaseException:
+            # e.g. 416 for an unsatisfiable Range: no response will close
+            result.release()
+            raise
+        if kwargs.get('conditional') and request.if_match:
+            etag, _ = response.get_etag()
+            if not request.if_match.contains(etag):
+                # werkzeug only evaluates If-None-Match and If-Range
+                response.close()
+                result.release()
+                return Response('Precondition Failed', 412)
+    else:
+        header = 'X-Accel-Redirect' if DELIVERY_BACKEND == 'x-accel' else 'X-Sendfile'
+        # The proxy answers Range and conditional requests from the file itself
+        response = Response(status=200, mimetype='application/octet-stream')
+        response.headers[header] = target
+        response.headers['Content-Disposition'] = content_disposition(download_name)
+        if kwargs.get('max_age') is not None:
+            response.cache_control.public = True
+            response.cache_control.max_age = kwargs['max_age']
+    endpoint = request.endpoint
+    head = request.method == 'HEAD'
+    sent_at = time.perf_counter()
+    
+    def closed():
+        # Sending happens after the headers (and Server-Timing) are out
+        metrics.phases.observe((endpoint, 'send'), time.perf_counter() - sent_at)
+        if not head:
+            # Handed-off files are sent by the proxy: count them whole
+            metrics.served(result.path.stat().st_size if target else file_bytes_sent(response))
+        result.release()
     
+    return on_response_close(response, closed)
+
+
+def count_downloaded(d):
+    """Progress hook adding each finished file's size to the download counter."""
+    if d.get('status') == 'finished':
+        metrics.downloaded(d.get('downloaded_bytes') or d.get('total_bytes') or 0)
+
+
+def run_download(url, opts, tracker=None, plan=None, priority=0, cancel=None, scratch_wait=None):
+    """Run the yt-dlp download + postprocessing pipeline into a fresh scratch dir.
+
+    ``cancel`` is the CancelScope of the run: once every waiter is gone the
+    hooks abort yt-dlp, ffmpeg children are killed and the scratch dir removed.
+    The dir waits up to ``scratch_wait`` seconds for room for the plan's
+    ``scratch_bytes`` estimate.
+    """
+    scratch_dir = None
+    timer = current_timer()
     try:
-        # Base output template
-        outtmpl = os.path.join(tempdir, '%(title)s.%(ext)s')
-        
-        opts = {
-            'quiet': False,
-            'no_warnings': False,
-            'outtmpl': outtmpl,
-        }
+        if cancel is not None:
+            cancel.check()
+        with timed('scratch'):
+            scratch_dir = scratch.create((plan or {}).get('scratch_bytes'), scratch_wait, cancel)
+        tempdir = scratch_dir.path
+        if cancel is not None:
+            cancel.on_cancel(lambda: cancel_registry.record_killed(kill_workdir_processes(tempdir)))
+        opts = dict(opts, outtmpl=os.path.join(tempdir, '%(title)s.%(ext)s'))
+        streams = len((plan or {}).get('formats') or ()) or 1
+        fragments = fragment_budget.acquire(streams, FRAGMENT_CONCURRENCY)
+        opts['concurrent_fragment_downloads'] = fragments
+        ydl_class = ytdlp.ParallelStreamsYoutubeDL if PARALLEL_STREAMS else ytdlp.YoutubeDL
+        try:
+            with ffmpeg_scheduler.session(plan, priority, cancel) as ffmpeg_session:
+                # The scheduler hook goes first so it blocks before ffmpeg starts
+                opts['postprocessor_hooks'] = [ffmpeg_session.hook]
+                opts['progress_hooks'] = []
+                if cancel is not None:
+                    opts['progress_hooks'].append(cancel.progress_hook)
+                    opts['postprocessor_hooks'].insert(0, cancel.postprocessor_hook)
+                if tracker is not None:
+                    opts['progress_hooks'].append(tracker.progress_hook)
+                    opts['postprocessor_hooks'].append(tracker.postprocessor_hook)
+                opts['progress_hooks'].append(count_downloaded)
+                if timer is not None:
+                    opts['postprocessor_hooks'].append(timer.postprocessor_hook)
+                    timer.begin('extract')
+                try:
+                    with ydl_class(opts) as ydl, bandwidth_budget.share(ydl, streams, fragments):
+                        if timer is not None:
+                            ydl.add_post_processor(ytdlp.DownloadStartPP(timer), when='before_dl')
+                        if opts.get('download_ranges'):
+                            # Sections are fetched by ffmpeg; precise cuts re-encode
+                            kind = 'transcode' if opts.get('force_keyframes_at_cuts') else 'copy'
+                            ydl.add_post_processor(ytdlp.FFmpegDownloadPP(ffmpeg_session, kind),
+                                                   when='before_dl')
+                        ydl.extract_info(url, download=True)
+                finally:
+                    if timer is not None:
+                        timer.end('extract')
+                        timer.end('download')
+        finally:
+            fragment_budget.release(streams, fragments)
         
-        # Check if this is audio-only based on format string or flag
-        is_audio = is_audio_only or fmt == 'bestaudio' or ('+' not in fmt and 'audio' in fmt.lower())
+        with timed('discover'):
+            # Find the downloaded file
+            files = list(Path(tempdir).glob('*'))
+            if not files:
+                raise NoFileProduced(tempdir)
+            
+            # Get the largest file (the actual download)
+            files_sorted = sorted(files, key=lambda p: p.stat().st_size, reverse=True)
+            chosen = files_sorted[0]
         
-        if is_audio:
-            # Audio-only download with conversion
-            opts['format'] = 'bestaudio/best'
-            opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': audio_format,
-                'preferredquality': '192',
-            }]
+        print(f"Downloaded file: {chosen.name} ({chosen.stat().st_size} bytes)")
+        if tracker is not None:
+            tracker.finish()
+        return DownloadResult(scratch_dir, chosen)
+    except BaseException as e:
+        if scratch_dir is not None:
+            scratch_dir.remove()
+        if cancel is not None and cancel.cancelled and not isinstance(e, ytdlp.DownloadCancelled):
+            # A killed ffmpeg surfaces as a postprocessing error
+            e = ytdlp.DownloadCancelled(cancel.reason)
+        if tracker is not None:
+            tracker.finish(str(e) or e.__class__.__name__)
+        if isinstance(e, ytdlp.DownloadCancelled):
+            print(f"Download cancelled: {e}")
+        raise e
+
+
+class CacheEntry:
+    """One finished file in the result cache."""
+
+    def __init__(self, key, path, name, size, created_at, last_access, hits, aliases):
+        self.key = key
+        self.path = path
+        self.name = name
+        self.size = size
+        self.created_at = created_at
+        self.last_access = last_access
+        self.hits = hits
+        self.aliases = aliases
+        self.pins = 0
+        self.pin_fd = None
+
+    def meta(self):
+        return {
+            'key': self.key,
+            'file': self.path.name,
+            'name': self.name,
+            'size': self.size,
+            'created_at': self.created_at,
+            'last_access': self.last_access,
+            'hits': self.hits,
+            'aliases': self.aliases,
+        }
+
+
+class CachedResult:
+    """A result served from the cache; pins its entry against eviction while in use."""
+
+    def __init__(self, cache, entry):
+        self._cache = cache
+        self.entry = entry
+        self.path = entry.path
+        self.name = entry.name
+
+    def retain(self, count=1):
+        self._cache.pin(self.entry, count)
+
+    def release(self):
+        self._cache.pin(self.entry, -1)
+
+
+class ResultCache:
+    """Content-addressed, size-bounded store of finished downloads.
+
+    Entries are keyed by (extractor, video id, format selector, merge and
+    postprocessor options). Files are published atomically (copy to a temp
+    name in the cache dir, then rename) next to a JSON sidecar, and the
+    index is rebuilt from the sidecars on startup. Requests for the same
+    URL and options are also remembered as aliases, so repeat hits skip
+    yt-dlp entirely. Entries and aliases are mirrored into the shared state
+    store so sibling workers can find them.
+
+    Worker processes may share the directory. Recovery and publishing
+    serialize on a lockfile, and while an entry is pinned its file holds a
+    shared flock, so a sibling's eviction skips files still being served.
+    """
+
+    def __init__(self, root, max_bytes, policy='lru', retention=None, min_free_bytes=0, state=None):
+        self.root = Path(root)
+        self.state = state or LocalState()
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.retention = retention
+        self.min_free_bytes = min_free_bytes
+        self.expirations = 0
+        self._entries = {}
+        self._aliases = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.enabled:
+            self.root.mkdir(parents=True, exist_ok=True)
+            self._recover()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def content_key(info, opts):
+        key = [
+            info.get('extractor_key'),
+            info.get('id'),
+            opts.get('format'),
+            opts.get('merge_output_format'),
+            opts.get('postprocessors', []),
+        ]
+        if clip_ranges(opts):
+            key += [clip_ranges(opts), bool(opts.get('force_keyframes_at_cuts'))]
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    @contextmanager
+    def _dir_lock(self):
+        """Exclusive lock on the cache directory, across worker processes."""
+        with open(self.root / '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _recover(self):
+        """Rebuild the index from sidecar files, dropping anything incomplete."""
+        with self._dir_lock():
+            self._load_sidecars()
+        print(f"Result cache: recovered {len(self._entries)} entries ({self._bytes} bytes)")
+
+    def _load_sidecars(self):
+        for leftover in self.root.glob('.tmp-*'):
+            if not self._in_flight(leftover):
+                leftover.unlink(missing_ok=True)
+        for meta_path in self.root.glob('*.json'):
+            try:
+                meta = json.loads(meta_path.read_text())
+                path = self.root / meta['file']
+                if path.stat().st_size != meta['size']:
+                    raise ValueError('size mismatch')
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Dropping cache entry {meta_path.name}: {e}")
+                meta_path.unlink(missing_ok=True)
+                continue
+            entry = CacheEntry(
+                meta['key'], path, meta['name'], meta['size'], meta['created_at'],
+                meta['last_access'], meta['hits'], meta.get('aliases', []))
+            self._entries[entry.key] = entry
+            self._bytes += entry.size
+            for alias in entry.aliases:
+                self._aliases[alias] = entry.key
+            self.state.put_artifact(entry.key, entry.path, entry.name, entry.size)
+            for alias in entry.aliases:
+                self.state.alias_artifact(alias, entry.key)
+        known = {e.path.name for e in self._entries.values()}
+        for path in self.root.iterdir():
+            if path.name.startswith('.') or path.suffix == '.json' or path.name in known:
+                continue
+            if not self._in_flight(path):
+                path.unlink(missing_ok=True)
+
+    def _in_flight(self, path):
+        """Whether a file may belong to a sibling that is publishing right now
+        (renamed into place, sidecar not written yet)."""
+        try:
+            return time.time() - path.stat().st_mtime < RESULT_TMP_GRACE
+        except OSError:
+            return True
+
+    def _sync_pin(self, entry):
+        """Mirror the pin count as a shared flock on the file (lock held).
+
+        Returns False when the file was evicted by a sibling meanwhile.
+        """
+        if entry.pins > 0 and entry.pin_fd is None:
+            try:
+                fd = os.open(entry.path, os.O_RDONLY)
+            except OSError:
+                return False
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            if os.fstat(fd).st_nlink == 0:
+                os.close(fd)
+                return False
+            entry.pin_fd = fd
+        elif entry.pins <= 0 and entry.pin_fd is not None:
+            os.close(entry.pin_fd)
+            entry.pin_fd = None
+        return True
+
+    def _unlink_unpinned(self, entry):
+        """Delete an entry's file unless a sibling worker has it pinned or a
+        proxy may still be sending it."""
+        try:
+            fd = os.open(entry.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return True
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            st = os.fstat(fd)
+            if (DELIVERY_BACKEND in ('x-accel', 'x-sendfile') and st.st_atime > st.st_mtime
+                    and time.time() - st.st_atime < RESULT_OFFLOAD_GRACE):
+                # Handed to the proxy recently (see offload_path)
+                return False
+        except BlockingIOError:
+            return False
         else:
-            # Video download - ALWAYS ensure audio is included
-            # This is the critical fix
-            if '+' in fmt:
-                # User manually selected video+audio
-                opts['format'] = fmt
-            elif 'bestvideo' in fmt or 'best' in fmt:
-                # Quick select options - already have proper format strings
-                opts['format'] = fmt
-            else:
-                # Single video format selected - FORCE audio addition
-                # Check if the format actually has audio
-                format_has_audio = _check_format_has_audio(url, fmt)
-                
-                if format_has_audio:
-                    # Format already includes audio
-                    opts['format'] = fmt
-                else:
-                    # Video-only format - MUST add audio
-                    opts['format'] = f"{fmt}+bestaudio/bestaudio*"
-                    print(f"Selected format {fmt} has no audio, adding bestaudio")
-            
-            # Always merge to mp4 for maximum compatibility
-            opts['merge_output_format'] = 'mp4'
-            
-            # Ensure proper merging and conversion
-            opts['postprocessors'] = [
-                {
-                    'key': 'FFmpegVideoRemuxer',
-                    'preferedformat': 'mp4',
-                },
-                {
-                    'key': 'FFmpegMetadata',
-                }
-            ]
-            
-            # Additional options for better quality
-            opts['prefer_ffmpeg'] = True
-            opts['keepvideo'] = False
+            entry.path.unlink(missing_ok=True)
+            return True
+        finally:
+            os.close(fd)
+
+    def _write_meta(self, entry):
+        tmp = self.root / f'.tmp-{uuid.uuid4().hex}.json'
+        tmp.write_text(json.dumps(entry.meta()))
+        os.replace(tmp, self.root / f'{entry.key}.json')
+
+    def checkout(self, key=None, alias=None):
+        """Return a pinned CachedResult for a key or alias, or None on a miss."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if key is None:
+                key = self._aliases.get(alias)
+            entry = self._entries.get(key)
+            if entry is not None and entry.pins == 0 and not entry.path.exists():
+                # Evicted by a sibling sharing the directory
+                self._remove(entry)
+                entry = None
+            if entry is None:
+                if alias is None or key is not None:
+                    self.misses += 1
+                return None
+            entry.pins += 1
+            if not self._sync_pin(entry):
+                entry.pins -= 1
+                self._remove(entry)
+                self.misses += 1
+                return None
+            entry.hits += 1
+            entry.last_access = time.time()
+            new_alias = alias is not None and alias not in entry.aliases
+            if new_alias:
+                entry.aliases.append(alias)
+                self._aliases[alias] = key
+            self.hits += 1
+        self._write_meta(entry)
+        if new_alias:
+            self.state.alias_artifact(alias, key)
+        return CachedResult(self, entry)
+
+    def publish(self, key, result, alias=None):
+        """Move a fresh DownloadResult into the cache; returns what callers should use."""
+        if not self.enabled or result.path.stat().st_size > self.max_bytes:
+            return result
+        path = self.root / f'{key}{result.path.suffix}'
+        tmp = self.root / f'.tmp-{uuid.uuid4().hex}'
+        try:
+            # Cheap rename when the temp dir is on the same filesystem
+            os.replace(result.path, tmp)
+        except OSError:
+            shutil.copyfile(result.path, tmp)
+        now = time.time()
+        with self._dir_lock():
+            os.replace(tmp, path)
+            entry = CacheEntry(key, path, result.name, path.stat().st_size, now, now, 0,
+                               [alias] if alias else [])
+            self._write_meta(entry)
+        self.state.put_artifact(key, path, entry.name, entry.size)
+        if alias:
+            self.state.alias_artifact(alias, key)
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None:
+                self._bytes -= old.size
+            entry.pins = 1
+            self._sync_pin(entry)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            if alias:
+                self._aliases[alias] = key
+            self._evict()
+        result.release()
+        return CachedResult(self, entry)
+
+    def adopt(self, row, alias=None):
+        """Index a sibling's file that already sits in our directory; pinned, or None."""
+        path = Path(row['path'])
+        try:
+            if path.parent.resolve() != self.root.resolve() or path.stat().st_size != row['size']:
+                return None
+        except OSError:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(row['key'])
+            if entry is None:
+                entry = CacheEntry(row['key'], path, row['name'], row['size'], row['created_at'],
+                                   now, 0, [])
+                self._entries[entry.key] = entry
+                self._bytes += entry.size
+            entry.pins += 1
+            if not self._sync_pin(entry):
+                entry.pins -= 1
+                self._remove(entry)
+                return None
+            entry.hits += 1
+            entry.last_access = now
+            if alias and alias not in entry.aliases:
+                entry.aliases.append(alias)
+                self._aliases[alias] = entry.key
+            self._evict()
+        if alias:
+            self.state.alias_artifact(alias, entry.key)
+        return CachedResult(self, entry)
+
+    def pin(self, entry, delta):
+        with self._lock:
+            entry.pins += delta
+            self._sync_pin(entry)
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def _evict(self, need_free=False):
+        """Drop unpinned entries until the cache fits its budget (lock held)."""
+        def over_budget():
+            if self._bytes > self.max_bytes:
+                return True
+            return need_free and shutil.disk_usage(self.root).free < self.min_free_bytes
         
-        print(f"Downloading with format: {opts['format']}")
-        print(f"Options: {opts}")
+        if not over_budget():
+            return
+        if self.policy == 'lfu':
+            order = lambda e: (e.hits, e.last_access)
+        else:
+            order = lambda e: e.last_access
+        for entry in sorted(self._entries.values(), key=order):
+            if not over_budget():
+                break
+            if entry.pins > 0 or not self._unlink_unpinned(entry):
+                continue
+            self._remove(entry)
+            self.evictions += 1
+
+    def _remove(self, entry):
+        del self._entries[entry.key]
+        self._bytes -= entry.size
+        for alias in entry.aliases:
+            self._aliases.pop(alias, None)
+        (self.root / f'{entry.key}.json').unlink(missing_ok=True)
+        self.state.remove_artifact(entry.key)
+
+    def sweep(self):
+        """Janitor pass: expire idle entries, then free disk if the volume runs low."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.retention:
+                cutoff = time.time() - self.retention
+                for entry in list(self._entries.values()):
+                    if entry.pins == 0 and entry.last_access < cutoff and self._unlink_unpinned(entry):
+                        self._remove(entry)
+                        self.expirations += 1
+            self._evict(need_free=bool(self.min_free_bytes))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_POLICY,
+                           RESULT_RETENTION, RESULT_MIN_FREE_BYTES, state_store)
+
+
+def artifact_url(result, download_name=None):
+    """Stable, resumable GET URL for a finished download (None if not retained)."""
+    entry = getattr(result, 'entry', None)
+    if entry is None:
+        return None
+    params = {'name': download_name} if download_name and download_name != entry.name else {}
+    return url_for('artifact', key=entry.key, **params)
+
+
+def fetch_artifact(row):
+    """Copy a sibling's artifact into a fresh scratch dir: from disk when the
+    path is visible here, otherwise from its node's /artifacts endpoint."""
+    scratch_dir = scratch.create(row['size'])
+    path = Path(scratch_dir.path) / Path(row['name']).name
+    try:
+        if os.path.isfile(row['path']):
+            shutil.copyfile(row['path'], path)
+        else:
+            with urllib.request.urlopen(f"{row['node_url']}/artifacts/{row['key']}", timeout=30) as src:
+                with open(path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+        if path.stat().st_size != row['size']:
+            raise ValueError(f"expected {row['size']} bytes, got {path.stat().st_size}")
+    except BaseException:
+        scratch_dir.remove()
+        raise
+    return DownloadResult(scratch_dir, path)
+
+
+def shared_artifact(key=None, alias=None):
+    """Pinned result another worker already produced, or None.
+
+    A file in our own (shared) cache directory is indexed in place; anything
+    else is copied from disk or from the producing node, which is still far
+    cheaper than downloading and postprocessing it again.
+    """
+    if not state_store.shared or not result_cache.enabled:
+        return None
+    for row in state_store.find_artifacts(key, alias):
+        if row['node'] == NODE_ID:
+            continue
+        try:
+            cached = result_cache.adopt(row, alias)
+            if cached is None and (row['node_url'] or os.path.isfile(row['path'])):
+                cached = result_cache.publish(row['key'], fetch_artifact(row), alias)
+        except Exception as e:
+            print(f"Could not take {row['name']} from {row['node']}: {e}")
+            continue
+        if cached is not None:
+            print(f"Shared artifact from {row['node']}: {cached.name}")
+            return cached
+    return None
+
+
+def peer_location(key):
+    """URL of a node holding an artifact whose file is not visible here, or None."""
+    for row in state_store.find_artifacts(key):
+        if row['node'] != NODE_ID and row['node_url'] and not os.path.isfile(row['path']):
+            return f"{row['node_url']}/artifacts/{key}"
+    return None
+
+
+def obtain_result(url, opts, tracker=None, plan=None, priority=0, cancel=None, scratch_wait=None):
+    """Finished file for a download, from the result cache or a fresh yt-dlp run.
+
+    ``cancel`` is the caller's CancelToken; the run is shared with identical
+    requests and only aborted when all of their tokens are cancelled.
+    ``scratch_wait`` bounds the wait for scratch space (SCRATCH_WAIT if None).
+    """
+    key = download_key(url, opts)
+    with timed('cache-lookup'):
+        cached = result_cache.checkout(alias=key) or shared_artifact(alias=key)
+        if cached is None and result_cache.enabled:
+            content_key = result_cache.content_key(get_probe(url), opts)
+            cached = result_cache.checkout(content_key, alias=key) or shared_artifact(content_key, key)
+    if cached is not None:
+        print(f"Result cache hit: {cached.name}")
+        if tracker is not None:
+            tracker.finish()
+        return cached
+    
+    def work():
+        result = run_download(url, opts, tracker, plan, priority,
+                              cancel.scope if cancel is not None else None, scratch_wait)
+        if not result_cache.enabled:
+            return result
+        with timed('publish'):
+            return result_cache.publish(content_key, result, alias=key)
+    
+    # Identical concurrent requests share one download and merge
+    while True:
+        try:
+            return download_flight.do(key, work)
+        except ytdlp.DownloadCancelled:
+            if cancel is None or cancel.cancelled:
+                raise
+            # We joined a run its other waiters were abandoning; start our own
+            print(f"Restarting abandoned download for {url}")
+
+
+class QueueFull(Exception):
+    """The job queue is at capacity."""
+
+
+class Job:
+    """A /download request executed by the background worker pool."""
+
+    def __init__(self, url, fmt, audio_format, filename_hint, is_audio_only,
+                 embed_metadata=False, priority=0, clip=None, precise_cuts=False):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.fmt = fmt
+        self.audio_format = audio_format
+        self.filename_hint = filename_hint
+        self.is_audio_only = is_audio_only
+        self.embed_metadata = embed_metadata
+        self.priority = priority
+        self.clip = clip
+        self.precise_cuts = precise_cuts
+        self.plan = None
+        self.state = 'queued'
+        self.error = None
+        self.result = None
+        self.out_name = None
+        self.artifact_key = None
+        self.size = None
+        self.tracker = None
+        self.cancel_requested = False
+        self.client = None
+        self.timer = None
+        self.timings = None
+        self.owner_url = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def run(self):
+        timer = self.timer = PhaseTimer()
+        set_timer(timer)
+        try:
+            self._run()
+        finally:
+            set_timer(None)
+            metrics.observe('job', timer)
+
+    def _run(self):
+        opts, is_audio, self.plan = build_download_opts(
+            self.url, self.fmt, self.audio_format, self.is_audio_only, self.embed_metadata,
+            self.clip, self.precise_cuts)
+        key = download_key(self.url, opts)
+        tracker = progress_registry.tracker(key)
+        progress_registry.alias(self.id, key)
+        self.tracker = tracker
+        with cancellation(key, self.id) as token:
+            if self.cancel_requested:
+                token.cancel()
+            result = obtain_result(self.url, opts, tracker, self.plan, self.priority, token,
+                                   SCRATCH_JOB_WAIT)
+            if token.cancelled:
+                # Other waiters kept the run going; we no longer want the file
+                result.release()
+                raise ytdlp.DownloadCancelled(token.scope.reason or 'cancelled by client')
+        self.result = result
+        self.out_name = output_name(
+            self.filename_hint, is_audio, self.audio_format, self.result.name)
+        entry = getattr(result, 'entry', None)
+        self.artifact_key = entry.key if entry is not None else None
+        self.size = result.path.stat().st_size
+
+    def params(self):
+        return {
+            'url': self.url,
+            'fmt': self.fmt,
+            'audio_format': self.audio_format,
+            'filename_hint': self.filename_hint,
+            'is_audio_only': self.is_audio_only,
+            'embed_metadata': self.embed_metadata,
+            'priority': self.priority,
+            'clip': self.clip,
+            'precise_cuts': self.precise_cuts,
+        }
+
+    def record(self):
+        """Row for the shared state store."""
+        return {
+            'id': self.id,
+            'state': self.state,
+            'priority': self.priority,
+            'params': self.params(),
+            'error': self.error,
+            'out_name': self.out_name,
+            'artifact_key': self.artifact_key,
+            'plan': self.plan,
+            'timings': dict(self.timer.phases) if self.timer else None,
+            'size': self.size,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        """Rebuild a job from the shared state store (one queued or run elsewhere)."""
+        params = dict(record['params'])
+        if params.get('clip'):
+            params['clip'] = tuple(params['clip'])
+        job = cls(**params)
+        job.id = record['id']
+        for field in ('state', 'error', 'out_name', 'artifact_key', 'plan', 'size',
+                      'created_at', 'started_at', 'finished_at'):
+            setattr(job, field, record[field])
+        job.timings = record['timings']
+        job.owner_url = record.get('owner_url')
+        return job
+
+    def file_location(self):
+        """Where a finished file can be fetched when this worker does not hold it."""
+        if self.artifact_key:
+            params = {'name': self.out_name} if self.out_name else {}
+            return url_for('artifact', key=self.artifact_key, **params)
+        if self.owner_url and self.owner_url != NODE_URL:
+            return f'{self.owner_url}/jobs/{self.id}/file'
+        return None
+
+    def to_dict(self):
+        if self.timer:
+            timings = dict(self.timer.phases)
+        else:
+            timings = self.timings
+        if self.result:
+            location = artifact_url(self.result, self.out_name)
+        else:
+            location = self.file_location() if self.state == 'finished' else None
+        return {
+            'id': self.id,
+            'state': self.state,
+            'error': self.error,
+            'filename': self.out_name,
+            'plan': self.plan,
+            'artifact_url': location,
+            'timings': {k: round(v, 4) for k, v in timings.items()} if timings else None,
+            'size': self.size,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobManager:
+    """Bounded queue of download jobs drained by a fixed pool of worker threads.
+
+    With a shared state store the queue lives there instead: workers on
+    every node claim jobs under a lease they keep renewing, so a job whose
+    worker dies is picked up again elsewhere. Status, cancellation and file
+    requests for jobs another worker holds are answered from its record.
+    """
+
+    TERMINAL = ('finished', 'failed', 'cancelled')
+
+    def __init__(self, workers, max_queue, retention, state=None):
+        self.workers = workers
+        self.retention = retention
+        self.state = state or LocalState()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._jobs = {}
+        self._executed = set()  # ids of jobs this process ran (shared mode)
+        self._lock = threading.Lock()
+        self._threads = []
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.cancelled = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            target = self._claimer if self.state.shared else self._worker
+            for i in range(self.workers):
+                t = threading.Thread(target=target, name=f'job-worker-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+            if self.state.shared:
+                t = threading.Thread(target=self._lease_keeper, name='job-lease', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, job):
+        self._ensure_started()
+        self.expire()
+        if self.state.shared:
+            try:
+                queued = self.state.put_job(job.record(), self._queue.maxsize)
+            except sqlite3.Error as e:
+                # Locked or unavailable store: turn the job away like a full queue
+                print(f"Job store error on submit: {e}")
+                queued = False
+            if not queued:
+                with self._lock:
+                    self.rejected += 1
+                raise QueueFull()
+            with self._lock:
+                self._jobs[job.id] = job
+            return job
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+                self.rejected += 1
+            raise QueueFull()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not self.state.shared or job_id in self._executed:
+                return job
+        # Queued, or held by another worker: its record is the truth
+        record = self.state.get_job(job_id)
+        return Job.from_record(record) if record is not None else job
+
+    def cancel(self, job_id):
+        """Withdraw a job; returns it, or None if unknown. Finished jobs are left alone."""
+        if self.state.shared:
+            return self._cancel_shared(job_id)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job.cancel_requested = True
+            withdrawn = job.state == 'queued'
+            if withdrawn:
+                # The worker skips it when it comes up
+                job.state = 'cancelled'
+                job.finished_at = time.time()
+                self.cancelled += 1
+            running = job.state == 'running'
+        if withdrawn:
+            # Outside the lock: releasing the client slot takes it again
+            self._done(job)
+        elif running:
+            cancel_registry.cancel(job.id)
+        return job
+
+    def _cancel_shared(self, job_id):
+        # Queued jobs are cancelled in the store; running ones are flagged
+        # there for their owner, which notices on its next lease renewal
+        record = self.state.cancel_job(job_id)
+        if record is None:
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+            local = job is not None and job_id in self._executed and job.state == 'running'
+            if local:
+                job.cancel_requested = True
+        if local:
+            cancel_registry.cancel(job_id)
+        return self.get(job_id)
+
+    def expire(self):
+        """Forget finished jobs older than the retention window."""
+        cutoff = time.time() - self.retention
+        with self._lock:
+            expired = [j for j in self._jobs.values()
+                       if j.finished_at is not None and j.finished_at < cutoff]
+            for job in expired:
+                del self._jobs[job.id]
+                self._executed.discard(job.id)
+        for job in expired:
+            if job.result is not None:
+                job.result.release()
+        if self.state.shared:
+            self.state.expire(cutoff)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                with self._lock:
+                    if job.state == 'cancelled':
+                        continue
+                    job.state = 'running'
+                self._execute(job)
+            finally:
+                self._queue.task_done()
+
+    def _claimer(self):
+        while True:
+            try:
+                record = self.state.claim_job(JOB_LEASE, JOB_MAX_ATTEMPTS)
+            except Exception as e:
+                print(f"Job claim failed: {e}")
+                record = None
+            if record is None:
+                time.sleep(JOB_POLL_INTERVAL)
+                continue
+            with self._lock:
+                # Our own submissions keep their client slot and trackers
+                job = self._jobs.get(record['id'])
+                if job is None:
+                    job = self._jobs[record['id']] = Job.from_record(record)
+                job.state = 'running'
+                job.cancel_requested = bool(record['cancel_requested'])
+                job.owner_url = NODE_URL
+                self._executed.add(job.id)
+            if record['attempts'] > 1:
+                print(f"Job {job.id} taken over (attempt {record['attempts']})")
+            self._execute(job)
+
+    def _execute(self, job):
+        job.started_at = time.time()
+        try:
+            job.run()
+            job.state = 'finished'
+            self.completed += 1
+        except ytdlp.DownloadCancelled as e:
+            job.state = 'cancelled'
+            job.error = str(e) or 'cancelled'
+            self.cancelled += 1
+        except NoFileProduced:
+            job.state = 'failed'
+            job.error = 'No file produced - download may have failed'
+            self.failed += 1
+        except Exception as e:
+            print(f"Job {job.id} failed: {str(e)}")
+            job.state = 'failed'
+            job.error = f'Download failed: {str(e)}'
+            self.failed += 1
+        finally:
+            job.finished_at = time.time()
+            self._done(job)
+
+    def _lease_keeper(self):
+        """Renew leases on jobs running here, and notice remote jobs we submitted finishing."""
+        while True:
+            time.sleep(JOB_LEASE / 3)
+            with self._lock:
+                mine = [j for j in self._jobs.values() if j.id in self._executed and j.state == 'running']
+                waiting = [j for j in self._jobs.values()
+                           if j.id not in self._executed and j.finished_at is None]
+            for job in mine:
+                try:
+                    owned, cancel = self.state.renew_job(job.id, JOB_LEASE)
+                except Exception as e:
+                    print(f"Lease renewal for job {job.id} failed: {e}")
+                    continue
+                if not owned:
+                    # Another worker took it over; let it finish the job
+                    print(f"Lost the lease on job {job.id}")
+                    with self._lock:
+                        self._executed.discard(job.id)
+                    cancel_registry.cancel(job.id)
+                elif cancel and not job.cancel_requested:
+                    job.cancel_requested = True
+                    cancel_registry.cancel(job.id)
+            for job in waiting:
+                try:
+                    record = self.state.get_job(job.id)
+                except Exception as e:
+                    print(f"Job lookup for {job.id} failed: {e}")
+                    continue
+                if record is None or record['state'] in self.TERMINAL:
+                    job.state = record['state'] if record else 'failed'
+                    job.finished_at = (record and record['finished_at']) or time.time()
+                    self._release(job)
+
+    def _release(self, job):
+        with self._lock:
+            client, job.client = job.client, None
+        if client is not None:
+            admission.release(client)
+
+    def _done(self, job):
+        self._release(job)
+        if self.state.shared and job.id in self._executed:
+            try:
+                self.state.finish_job(job.record())
+            except Exception as e:
+                print(f"Could not record job {job.id}: {e}")
+
+    def stats(self):
+        with self._lock:
+            states = [j.state for j in self._jobs.values()]
+        stats = {
+            'workers': self.workers,
+            'queue_depth': self._queue.qsize(),
+            'queue_max': self._queue.maxsize,
+            'running': states.count('running'),
+            'tracked': len(states),
+            'completed': self.completed,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+            'rejected': self.rejected,
+        }
+        if self.state.shared:
+            shared = self.state.job_states()
+            stats['queue_depth'] = shared.get('queued', 0)
+            stats['shared'] = shared
+        return stats
+
+
+job_manager = JobManager(JOB_WORKERS, JOB_QUEUE_MAX, JOB_RETENTION, state_store)
+
+if state_store.shared:
+    # Every worker claims from the shared queue, not only those taking submissions
+    job_manager._ensure_started()
+
+
+def run_janitor(interval):
+    """Periodic housekeeping: expire idle cache entries and finished jobs, so
+    both age out even while nothing new is submitted."""
+    while True:
+        time.sleep(interval)
+        for task in (result_cache.sweep, job_manager.expire):
+            try:
+                task()
+            except Exception as e:
+                print(f"Janitor error ({task.__qualname__}): {e}")
+
+
+threading.Thread(target=run_janitor, args=(RESULT_JANITOR_INTERVAL,),
+                 name='janitor', daemon=True).start()
+
+
+class ZipStream(io.RawIOBase):
+    """Write-only, unseekable sink that zipfile writes into and we drain.
+
+    Because it cannot seek, zipfile writes each member with a data
+    descriptor after its data, so no size has to be known up front.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def unique_name(name, used):
+    """Avoid duplicate member names inside an archive."""
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in used:
+        n += 1
+        candidate = f"{stem} ({n}){ext}"
+    used.add(candidate)
+    return candidate
+
+
+def bulk_items(data):
+    """Normalize a bulk request to a list of per-item download requests."""
+    if data.get('items'):
+        return data['items']
+    shared = {k: v for k, v in data.items() if k not in ('urls', 'filename')}
+    return [dict(shared, url=url) for url in data.get('urls') or []]
+
+
+def stream_bulk_zip(items, workers, abort=None):
+    """Download items in parallel and stream them as a STORED zip in completion order.
+
+    At most ``workers`` items are downloading or waiting to be archived at
+    once: the next item is handed to the shared bulk pool only after a
+    finished file has been written and released. Nothing starts until the
+    body is iterated, so a response closed before sending leaves no work behind.
+    Setting the ``abort`` event ends the archive while it waits for items,
+    for servers that learn of a disconnect before the next chunk is pulled.
+    """
+    backlog = deque(items)
+    lock = threading.Lock()
+    unsent = set()
+    tokens = set()
+    closed = False
+    
+    def fetch(item):
+        if closed:
+            raise RuntimeError('bulk download aborted')
+        opts, is_audio, plan = build_download_opts(
+            item['url'], item['format'], item.get('audio_format', 'mp3'),
+            item.get('is_audio_only', False), item.get('embed_metadata', False),
+            request_clip(item, item['url']), item.get('precise_cuts', False))
+        with cancellation(download_key(item['url'], opts)) as token:
+            with lock:
+                tokens.add(token)
+                if closed:
+                    token.cancel('client disconnected')
+            try:
+                result = obtain_result(item['url'], opts, plan=plan, cancel=token)
+            finally:
+                with lock:
+                    tokens.discard(token)
+        name = output_name((item.get('filename') or '').strip(), is_audio,
+                           item.get('audio_format', 'mp3'), result.name)
+        with lock:
+            if closed:
+                result.release()
+                raise RuntimeError('bulk download aborted')
+            unsent.add(result)
+        return result, name
+    
+    def body():
+        nonlocal closed
+        futures = {}
         
-        with YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+        def launch():
+            if backlog:
+                item = backlog.popleft()
+                futures[bulk_executor.submit(fetch, item)] = item
         
-        # Find the downloaded file
-        files = list(Path(tempdir).glob('*'))
-        if not files:
-            return 'No file produced - download may have failed', 500
+        sink = ZipStream()
+        complete = False
+        errors = []
+        used = set()
+        try:
+            for _ in range(workers):
+                launch()
+            with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+                while futures:
+                    done, _ = wait(futures, timeout=0.5 if abort is not None else None,
+                                   return_when=FIRST_COMPLETED)
+                    if abort is not None and abort.is_set():
+                        return
+                    if not done:
+                        continue
+                    future = done.pop()
+                    item = futures.pop(future)
+                    try:
+                        result, name = future.result()
+                    except Exception as e:
+                        errors.append(f"{item.get('url')}: {str(e)}")
+                        launch()
+                        continue
+                    with lock:
+                        unsent.discard(result)
+                    try:
+                        member = zipfile.ZipInfo(unique_name(name, used), time.localtime()[:6])
+                        member.compress_type = zipfile.ZIP_STORED
+                        with open(result.path, 'rb') as src, zf.open(member, 'w', force_zip64=True) as dest:
+                            while True:
+                                chunk = src.read(STREAM_CHUNK_SIZE)
+                                if not chunk:
+                                    break
+                                dest.write(chunk)
+                                yield sink.drain()
+                    finally:
+                        result.release()
+                    launch()
+                    yield sink.drain()
+                if errors:
+                    zf.writestr('errors.txt', '\n'.join(errors) + '\n')
+            yield sink.drain()
+            complete = True
+        finally:
+            with lock:
+                closed = True
+                leftovers = list(unsent)
+                unsent.clear()
+                pending = list(tokens)
+            for result in leftovers:
+                result.release()
+            for future in futures:
+                future.cancel()
+            metrics.served(sink.tell())
+            if not complete:
+                cancel_registry.record_stream_closed()
+            # Items still downloading are abandoned along with the archive
+            for token in pending:
+                token.cancel('client disconnected')
+    
+    return body()
+
+
+def prometheus_lines(prefix, value):
+    """Flatten numeric /stats values into untyped Prometheus samples."""
+    if isinstance(value, dict):
+        lines = []
+        for key, item in value.items():
+            lines += prometheus_lines(f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', str(key))}", item)
+        return lines
+    if isinstance(value, bool):
+        return [f'{prefix} {int(value)}']
+    if isinstance(value, (int, float)):
+        return [f'{prefix} {value}']
+    return []
+
+
+@app.before_request
+def start_timer():
+    set_timer(PhaseTimer())
+
+
+@app.after_request
+def add_server_timing(response):
+    if 'first_response' not in startup.marks:
+        startup.mark('first_response')
+    timer = current_timer()
+    if timer is not None and request.endpoint != 'metrics_endpoint':
+        response.headers['Server-Timing'] = timer.header()
+        metrics.observe(request.endpoint or 'unknown', timer)
+    return response
+
+
+@app.teardown_request
+def clear_timer(exc):
+    set_timer(None)
+
+
+@app.route('/')
+def index():
+    return index_page.response()
+
+
+@app.route('/assets/<name>')
+def asset(name):
+    found = ASSETS.get(name)
+    if found is None:
+        return 'Unknown asset', 404
+    return found.response(asset_cache_control(found, request.args.get('v')))
+
+
+def asset_cache_control(found, version):
+    """None (the asset's own long-lived policy) unless the link is stale."""
+    if version != found.digest[:12]:
+        # Unversioned or from an older page: serve it, but do not let it stick
+        return 'no-cache'
+    return None
+
+
+@app.route('/probe', methods=['GET', 'POST'])
+@rate_limited('probe')
+def probe():
+    if request.method == 'GET':
+        url = request.args.get('url')
+    else:
+        url = (request.get_json() or {}).get('url')
+    if not url:
+        return 'Missing url', 400
+    
+    try:
+        return cached_json_response(probe_payload(get_probe(url)))
+    except Exception as e:
+        return f'Probe failed: {str(e)}', 500
+
+
+@app.route('/probe/batch', methods=['POST'])
+@rate_limited('probe')
+def probe_batch():
+    urls = (request.get_json() or {}).get('urls') or []
+    if not urls or not isinstance(urls, list):
+        return 'Missing urls', 400
+    if len(urls) > BATCH_MAX_URLS:
+        return f'At most {BATCH_MAX_URLS} urls per batch', 400
+    
+    futures = {batch_executor.submit(get_probe, url): (i, url) for i, url in enumerate(urls)}
+    
+    def results():
+        try:
+            for future in as_completed(futures):
+                index, url = futures[future]
+                try:
+                    item = {'index': index, 'url': url, 'ok': True,
+                            'info': probe_payload(future.result())}
+                except Exception as e:
+                    item = {'index': index, 'url': url, 'ok': False, 'error': f'Probe failed: {str(e)}'}
+                yield ndjson_line(item)
+        finally:
+            # Client went away: drop whatever has not started yet
+            for future in futures:
+                future.cancel()
+    
+    return ndjson_response(results())
+
+
+@app.route('/probe/playlist', methods=['POST'])
+@rate_limited('probe')
+def probe_playlist():
+    data = request.get_json() or {}
+    url = data.get('url')
+    if not url:
+        return 'Missing url', 400
+    try:
+        page = max(1, int(data.get('page', 1)))
+        page_size = max(1, min(int(data.get('page_size', PLAYLIST_PAGE_SIZE)), BATCH_MAX_URLS))
+    except (TypeError, ValueError, OverflowError):
+        return 'page and page_size must be integers', 400
+    resolve = data.get('resolve', False)
+    
+    try:
+        listing = playlist_listing(url, page, page_size)
+    except Exception as e:
+        return f'Probe failed: {str(e)}', 500
+    
+    def results():
+        yield ndjson_line(listing)
+        if not resolve:
+            return
+        # Full formats for this page, streamed as each entry finishes
+        entries = [e for e in listing['entries'] if e.get('url')]
+        futures = {batch_executor.submit(get_probe, e['url']): e for e in entries}
+        try:
+            for future in as_completed(futures):
+                entry = futures[future]
+                try:
+                    item = {'type': 'entry', 'index': entry['index'], 'url': entry['url'],
+                            'ok': True, 'info': probe_payload(future.result())}
+                except Exception as e:
+                    item = {'type': 'entry', 'index': entry['index'], 'url': entry['url'],
+                            'ok': False, 'error': f'Probe failed: {str(e)}'}
+                yield ndjson_line(item)
+        finally:
+            for future in futures:
+                future.cancel()
+    
+    return ndjson_response(results())
+
+
+@app.route('/stats')
+def stats():
+    return jsonify(stats_snapshot())
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    lines = metrics.phases.render()
+    lines += [
+        '# TYPE ydl_bytes_downloaded_total counter',
+        f'ydl_bytes_downloaded_total {metrics.bytes_downloaded}',
+        '# TYPE ydl_bytes_served_total counter',
+        f'ydl_bytes_served_total {metrics.bytes_served}',
+        '# TYPE ydl_scratch_bytes gauge',
+        f'ydl_scratch_bytes {scratch.used()}',
+    ]
+    lines += prometheus_lines('ydl', stats_snapshot())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+# Extra /stats sections registered by other serving modes: name -> callable
+extra_stats = {}
+
+
+def stats_snapshot():
+    return {
+        'probe_cache': probe_cache.stats(),
+        'probe_flight': probe_flight.stats(),
+        'ydl_pool': ydl_pool.stats(),
+        'download_flight': download_flight.stats(),
+        'jobs': job_manager.stats(),
+        'result_cache': result_cache.stats(),
+        'ffmpeg': ffmpeg_scheduler.stats(),
+        'fragment_threads': fragment_budget.stats(),
+        'cancellation': cancel_registry.stats(),
+        'admission': admission.stats(),
+        'bandwidth': bandwidth_budget.stats(),
+        'scratch': scratch.stats(),
+        'state': state_store.stats(),
+        'startup': {**startup.stats(), 'import': ytdlp.stats()},
+        **{name: source() for name, source in extra_stats.items()},
+    }
+
+
+@app.route('/download', methods=['POST'])
+@rate_limited('download')
+def download():
+    data = request.get_json() or {}
+    url = data.get('url')
+    fmt = data.get('format')
+    audio_format = data.get('audio_format', 'mp3')
+    filename_hint = data.get('filename', '').strip()
+    is_audio_only = data.get('is_audio_only', False)
+    progress_id = data.get('progress_id')
+    stream = data.get('stream', False)
+
+    if not url or not fmt:
+        return 'Missing url or format', 400
+    try:
+        clip = request_clip(data, url)
+        priority = request_priority(data)
+    except ValueError as e:
+        return str(e), 400
+
+    client = client_id()
+    try:
+        admission.acquire(client)
+    except Rejected as e:
+        return e.response()
+    # A streamed response does its work while sending, so it keeps the slot until closed
+    hold_slot = False
+    result = None
+    try:
+        opts, is_audio, plan = build_download_opts(
+            url, fmt, audio_format, is_audio_only, data.get('embed_metadata', False),
+            clip, data.get('precise_cuts', False))
         
-        # Get the largest file (the actual download)
-        files_sorted = sorted(files, key=lambda p: p.stat().st_size, reverse=True)
-        chosen = files_sorted[0]
+        if stream:
+            try:
+                response = stream_download(url, opts, is_audio, audio_format, filename_hint)
+                hold_slot = True
+                return on_response_close(response, lambda: admission.release(client))
+            except NotStreamable as e:
+                print(f"Streaming unavailable ({e}), falling back to full download")
         
-        print(f"Downloaded file: {chosen.name} ({chosen.stat().st_size} bytes)")
+        print(f"Downloading with format: {opts['format']} ({describe_plan(plan)})")
         
-        # Determine output filename
-        if filename_hint:
-            # Add appropriate extension
-            if is_audio:
-                out_name = f"{filename_hint}.{audio_format}"
-            else:
-                out_name = f"{filename_hint}.mp4"
-        else:
-            out_name = chosen.name
+        key = download_key(url, opts)
+        tracker = progress_registry.tracker(key)
+        if progress_id:
+            progress_registry.alias(progress_id, key)
+        # Abandoned if the client hangs up or cancels progress_id while we wait
+        with cancellation(key, progress_id, request.environ) as token:
+            result = obtain_result(url, opts, tracker, plan, priority, token)
+            if token.cancelled:
+                raise ytdlp.DownloadCancelled(token.scope.reason or 'cancelled by client')
+        out_name = output_name(filename_hint, is_audio, audio_format, result.name)
         
-        return send_file(
-            str(chosen),
-            as_attachment=True,
-            download_name=out_name,
-            mimetype='application/octet-stream'
-        )
+        # Drop our reference once the file has been fully streamed
+        response = deliver_file(result, out_name)
+        response.headers['X-Postprocess-Plan'] = describe_plan(plan)
+        stable_url = artifact_url(result, out_name)
+        if stable_url:
+            # Same bytes, resumable with Range requests until the retention window ends
+            response.headers['Content-Location'] = stable_url
+        return response
         
+    except Rejected as e:
+        if result is not None:
+            result.release()
+        return e.response()
+    except ytdlp.DownloadCancelled:
+        if result is not None:
+            result.release()
+        return 'Download cancelled', 409
+    except NoFileProduced:
+        if result is not None:
+            result.release()
+        return 'No file produced - download may have failed', 500
     except Exception as e:
+        if result is not None:
+            result.release()
         print(f"Download error: {str(e)}")
         import traceback
         traceback.print_exc()
         return f'Download failed: {str(e)}', 500
     finally:
-        # Clean up in background
-        def cleanup(path):
-            try:
-                shutil.rmtree(path, ignore_errors=True)
-            except:
-                pass
-        threading.Thread(target=cleanup, args=(tempdir,), daemon=True).start()
+        if not hold_slot:
+            admission.release(client)
+
+
+@app.route('/download/bulk', methods=['POST'])
+@rate_limited('download')
+def download_bulk():
+    data = request.get_json() or {}
+    items = bulk_items(data)
+    if not items or any(not i.get('url') or not i.get('format') for i in items):
+        return 'Missing items (each needs url and format)', 400
+    if len(items) > BULK_MAX_ITEMS:
+        return f'At most {BULK_MAX_ITEMS} items per request', 400
+    
+    client = client_id()
+    try:
+        admission.acquire(client)
+    except Rejected as e:
+        return e.response()
+    
+    archive_name = f"{(data.get('filename') or 'downloads').strip()}.zip"
+    response = Response(
+        stream_bulk_zip(items, min(BULK_WORKERS, len(items))),
+        mimetype='application/zip',
+        headers={'Content-Disposition': content_disposition(archive_name)},
+    )
+    return on_response_close(response, lambda: admission.release(client))
+
+
+@app.route('/jobs', methods=['POST'])
+@rate_limited('download')
+def create_job():
+    data = request.get_json() or {}
+    url = data.get('url')
+    fmt = data.get('format')
+    if not url or not fmt:
+        return 'Missing url or format', 400
+    try:
+        clip = request_clip(data, url)
+        priority = request_priority(data)
+    except ValueError as e:
+        return str(e), 400
+    
+    job = Job(
+        url,
+        fmt,
+        data.get('audio_format', 'mp3'),
+        data.get('filename', '').strip(),
+        data.get('is_audio_only', False),
+        data.get('embed_metadata', False),
+        priority,
+        clip,
+        data.get('precise_cuts', False),
+    )
+    job.client = client_id()
+    try:
+        # Queued and running jobs both count against the client's slots
+        admission.acquire(job.client)
+    except Rejected as e:
+        return e.response()
+    try:
+        job_manager.submit(job)
+    except QueueFull:
+        admission.release(job.client)
+        return 'Download queue is full, try again later', 503, {'Retry-After': str(JOB_RETRY_AFTER)}
+    except BaseException:
+        admission.release(job.client)
+        raise
+    
+    status_url = url_for('job_status', job_id=job.id)
+    return jsonify({
+        'id': job.id,
+        'state': job.state,
+        'status_url': status_url,
+        'file_url': url_for('job_file', job_id=job.id),
+    }), 202, {'Location': status_url}
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return 'Unknown job', 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return 'Unknown job', 404
+    if job.state in ('finished', 'failed'):
+        return f'Job is {job.state}', 409
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/download/<progress_id>/cancel', methods=['POST'])
+def cancel_download(progress_id):
+    if not cancel_registry.cancel(progress_id):
+        return 'Unknown or finished download', 404
+    return '', 202
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    feed = job_feed(job_id)
+    if feed is None:
+        return 'Unknown job', 404
+    return sse_response(stream_progress(feed))
+
+
+@app.route('/progress/<progress_id>/events')
+def progress_events(progress_id):
+    feed = download_feed(progress_id)
+    if feed is None:
+        return sse_response([pending_progress()])
+    return sse_response(stream_progress(feed))
+
+
+@app.route('/jobs/<job_id>/file')
+def job_file(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return 'Unknown job', 404
+    if job.state != 'finished':
+        return f'Job is {job.state}', 409
+    if job.result is None:
+        # Finished by another worker
+        location = job.file_location()
+        if location is None:
+            return 'File is no longer available', 410
+        return redirect(location, 307)
+    
+    # Keep the file alive while it is being sent, even if the job expires
+    job.result.retain()
+    return deliver_file(job.result, job.out_name)
+
+
+@app.route('/artifacts/<key>')
+def artifact(key):
+    # Retained download: send_file handles Range, If-Range and conditional GETs
+    result = result_cache.checkout(key)
+    if result is None:
+        location = peer_location(key)
+        if location is not None:
+            # Produced on another node: send the client there rather than copy it
+            query = request.query_string.decode()
+            return redirect(f'{location}?{query}' if query else location, 307)
+        result = shared_artifact(key)
+    if result is None:
+        return 'Unknown or expired file', 404
+    response = deliver_file(
+        result,
+        request.args.get('name') or result.name,
+        conditional=True,
+        etag=True,
+        max_age=int(RESULT_RETENTION),
+    )
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
 
 
 def _check_format_has_audio(url, fmt_id):
     """Check if a specific format actually has audio."""
     try:
-        info = probe_info(url)
+        info = get_probe(url)
         for f in info.get('formats', []):
             if f.get('format_id') == str(fmt_id):
-                acodec = f.get('acodec', 'none')
-                has_audio = acodec and acodec != 'none'
-                print(f"Format {fmt_id}: acodec={acodec}, has_audio={has_audio}")
+                has_audio = f['has_audio']
+                print(f"Format {fmt_id}: acodec={f.get('acodec', 'none')}, has_audio={has_audio}")
                 return has_audio
     except Exception as e:
         print(f"Error checking format audio: {e}")
     return False
 
 
+_preloading = threading.Lock()
+# A child forked mid-warm would count pool instances nobody is building
+os.register_at_fork(before=_preloading.acquire, after_in_parent=_preloading.release,
+                    after_in_child=_preloading.release)
+
+
+def _preload():
+    with _preloading:
+        ytdlp.load()
+        if YDL_POOL_WARM:
+            ydl_pool.warm(YDL_PRELOAD_EXTRACTORS)
+
+
+startup.mark('ready')
+# yt-dlp is imported and the probe pool warmed only now, off the request
+# path, so a worker takes requests as soon as the app itself has loaded
+if YTDLP_PRELOAD:
+    threading.Thread(target=_preload, name='ytdlp-preload', daemon=True).start()
+
+
 if __name__ == '__main__':
     print("=" * 60)
     print("Universal Downloader Started")
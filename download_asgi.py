@@ -0,0 +1,720 @@
+"""
+download_asgi.py
+
+Asyncio serving mode for the downloader, as an ASGI application.
+
+Probe, download (single and bulk) and progress endpoints are handled
+natively: blocking yt-dlp work runs on bounded thread pools, streamed
+ffmpeg output is read from asyncio subprocesses, and files and events are
+sent from coroutines, so an idle SSE subscriber or a slow client costs a
+coroutine and a socket rather than a worker thread. Every other endpoint is answered by the Flask
+app from download.py on a thread pool. The sync mode (python download.py,
+or gunicorn download:app) is unchanged.
+
+Requirements:
+  - everything download.py needs
+  - pip install uvicorn
+
+Run:
+  uvicorn download_asgi:app --host 127.0.0.1 --port 5000
+  python download_asgi.py
+"""
+
+import os
+import re
+import io
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import download
+from download import (
+    ASSETS, BULK_MAX_ITEMS, BULK_WORKERS, CLIENT_KEY_HEADER, DELIVERY_BACKEND,
+    PROGRESS_INTERVAL, STREAM_CHUNK_SIZE, NoFileProduced, NotStreamable, PhaseTimer,
+    Rejected, admission, asset_cache_control, build_download_opts, bulk_items,
+    cancel_registry, cancellation, client_key, content_disposition, describe_plan,
+    download_feed, download_key, encode_json, ffmpeg_scheduler, get_probe, index_page,
+    job_feed, metrics, obtain_result, offload_path, output_name, pending_progress,
+    prepare_stream, probe_payload, progress_registry, relay_http, request_clip,
+    request_priority, set_timer, startup, stream_bulk_zip, stream_gate, ytdlp,
+)
+
+# Thread pools for blocking work; calls beyond the pending cap are answered 503
+ASYNC_PROBE_WORKERS = int(os.environ.get('ASYNC_PROBE_WORKERS', 16))
+ASYNC_DOWNLOAD_WORKERS = int(os.environ.get('ASYNC_DOWNLOAD_WORKERS', 8))
+ASYNC_WSGI_WORKERS = int(os.environ.get('ASYNC_WSGI_WORKERS', 8))
+ASYNC_MAX_PENDING = int(os.environ.get('ASYNC_MAX_PENDING', 256))
+ASYNC_RETRY_AFTER = int(os.environ.get('ASYNC_RETRY_AFTER', 5))
+# Short blocking calls (file reads, upstream socket reads) while sending
+ASYNC_IO_WORKERS = int(os.environ.get('ASYNC_IO_WORKERS', 32))
+
+
+class BoundedExecutor:
+    """Thread pool for blocking calls that turns work away beyond a pending cap.
+
+    A waiting request costs a coroutine, so without the cap a burst would
+    queue unbounded work behind the pool; with it the client gets a 503
+    and a Retry-After instead. ``max_pending=None`` never refuses, for
+    calls made mid-response where there is no one left to refuse.
+    """
+
+    def __init__(self, name, workers, max_pending=None):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'async-{name}')
+        self.pending = 0
+        self.peak = 0
+        self.rejected = 0
+
+    async def run(self, fn, *args, timer=None):
+        """Run ``fn(*args)`` on the pool, with ``timer`` as that thread's phase timer."""
+        if self.max_pending is not None and self.pending >= self.max_pending:
+            self.rejected += 1
+            raise Rejected('Server busy, try again later', ASYNC_RETRY_AFTER, 503)
+        self.pending += 1
+        self.peak = max(self.peak, self.pending)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, _call, timer, fn, args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'pending': self.pending,
+            'peak': self.peak,
+            'max_pending': self.max_pending,
+            'rejected': self.rejected,
+        }
+
+
+def _call(timer, fn, args):
+    if timer is None:
+        return fn(*args)
+    set_timer(timer)
+    try:
+        return fn(*args)
+    finally:
+        set_timer(None)
+
+
+probe_pool = BoundedExecutor('probe', ASYNC_PROBE_WORKERS, ASYNC_MAX_PENDING)
+download_pool = BoundedExecutor('download', ASYNC_DOWNLOAD_WORKERS, ASYNC_MAX_PENDING)
+wsgi_pool = BoundedExecutor('wsgi', ASYNC_WSGI_WORKERS, ASYNC_MAX_PENDING)
+io_pool = BoundedExecutor('io', ASYNC_IO_WORKERS)
+
+download.extra_stats['async'] = lambda: {
+    pool.name: pool.stats() for pool in (probe_pool, download_pool, wsgi_pool, io_pool)
+}
+
+
+class Exchange:
+    """One ASGI HTTP request and its response, with what the handlers need of it."""
+
+    def __init__(self, scope, receive, send, endpoint):
+        self.scope = scope
+        self.method = scope['method']
+        self.endpoint = endpoint
+        self.query = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        self.headers = {}
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').lower()
+            value = value.decode('latin-1')
+            self.headers[name] = f'{self.headers[name]}, {value}' if name in self.headers else value
+        self.timer = PhaseTimer()
+        self.started = False
+        self.disconnected = asyncio.Event()
+        self._receive = receive
+        self._send = send
+        self._body = None
+        self._listener = None
+        self._on_disconnect = []
+
+    @property
+    def client(self):
+        peer = (self.scope.get('client') or [None])[0]
+        forwarded = [a.strip() for a in self.headers.get('x-forwarded-for', '').split(',') if a.strip()]
+        return client_key(self.headers.get(CLIENT_KEY_HEADER.lower()), forwarded or [peer], peer)
+
+    @property
+    def if_none_match(self):
+        if self.method not in ('GET', 'HEAD'):
+            return ()
+        tags = (t.strip() for t in self.headers.get('if-none-match', '').split(','))
+        return {t.removeprefix('W/').strip('"') for t in tags if t}
+
+    async def body(self):
+        if self._body is None:
+            chunks = []
+            while True:
+                message = await self._receive()
+                if message['type'] == 'http.disconnect':
+                    self.disconnected.set()
+                    break
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            self._body = b''.join(chunks)
+        return self._body
+
+    async def json(self):
+        """The JSON object in the body; {} when there is none, like ``get_json() or {}``."""
+        body = await self.body()
+        if not body:
+            return {}
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise BadRequest('Invalid JSON body')
+        return data or {}
+
+    def listen(self, callback=None):
+        """Watch for the client hanging up once the body has been read."""
+        if callback is not None:
+            if self.disconnected.is_set():
+                callback()
+            else:
+                self._on_disconnect.append(callback)
+        if self._listener is None and not self.disconnected.is_set():
+            self._listener = asyncio.ensure_future(self._listen())
+
+    async def _listen(self):
+        while True:
+            message = await self._receive()
+            if message['type'] == 'http.disconnect':
+                break
+        self.disconnected.set()
+        for callback in self._on_disconnect:
+            callback()
+
+    def forget(self, callback):
+        if callback in self._on_disconnect:
+            self._on_disconnect.remove(callback)
+
+    async def wait_disconnect(self, timeout):
+        """Sleep up to ``timeout`` seconds, waking early if the client hangs up."""
+        try:
+            await asyncio.wait_for(self.disconnected.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def start(self, status, headers=None, content_type=None):
+        headers = dict(headers or {})
+        if content_type:
+            headers['Content-Type'] = content_type
+        headers['Server-Timing'] = self.timer.header()
+        self.started = True
+        if 'first_response' not in startup.marks:
+            startup.mark('first_response')
+        await self._send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in headers.items()],
+        })
+
+    async def write(self, chunk, more=True):
+        await self._send({'type': 'http.response.body', 'body': chunk, 'more_body': more})
+
+    async def respond(self, status, body=b'', headers=None, content_type='text/plain; charset=utf-8'):
+        if isinstance(body, str):
+            body = body.encode()
+        headers = dict(headers or {})
+        headers['Content-Length'] = str(len(body))
+        await self.start(status, headers, content_type if status != 304 else None)
+        await self.write(body if self.method != 'HEAD' else b'', more=False)
+
+    async def reject(self, error):
+        await self.respond(error.status, str(error),
+                           {'Retry-After': str(error.response()[2]['Retry-After'])})
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+        metrics.observe(self.endpoint, self.timer)
+
+
+class BadRequest(Exception):
+    """The request cannot be handled as sent (answered 400)."""
+
+
+ROUTES = []
+
+
+def route(pattern, methods=('GET',), endpoint=None):
+    """Register a native handler; ``<name>`` segments become keyword arguments.
+
+    ``endpoint`` names it in metrics, matching the Flask view it stands in for.
+    """
+    regex = re.compile('^' + re.sub(r'<(\w+)>', r'(?P<\1>[^/]+)', pattern) + '$')
+
+    def decorator(handler):
+        ROUTES.append((set(methods), regex, handler, endpoint or handler.__name__))
+        return handler
+    return decorator
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    for methods, regex, handler, endpoint in ROUTES:
+        match = regex.match(scope['path'])
+        if match and scope['method'] in methods:
+            break
+    else:
+        await wsgi_fallback(scope, receive, send)
+        return
+
+    exchange = Exchange(scope, receive, send, endpoint)
+    try:
+        await handler(exchange, **match.groupdict())
+    except Rejected as e:
+        await exchange.reject(e)
+    except BadRequest as e:
+        await exchange.respond(400, str(e))
+    except Exception as e:
+        traceback.print_exc()
+        if exchange.started:
+            raise
+        await exchange.respond(500, f'Internal error: {str(e)}')
+    finally:
+        exchange.close()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for pool in (probe_pool, download_pool, wsgi_pool, io_pool):
+                pool.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def artifact_location(result, download_name, root_path=''):
+    """Like download.artifact_url, without needing a Flask request."""
+    entry = getattr(result, 'entry', None)
+    if entry is None:
+        return None
+    values = {'key': entry.key}
+    if download_name and download_name != entry.name:
+        values['name'] = download_name
+    return download.app.url_map.bind('', script_name=root_path or '/').build('artifact', values)
+
+
+async def send_asset(ex, found, cache_control=None):
+    status, body, headers = found.negotiate(
+        ex.headers.get('accept-encoding', ''), ex.if_none_match, cache_control)
+    await ex.respond(status, body, headers, found.content_type)
+
+
+@route('/', methods=('GET', 'HEAD'))
+async def index(ex):
+    await send_asset(ex, index_page)
+
+
+@route('/assets/<name>', methods=('GET', 'HEAD'))
+async def asset(ex, name):
+    found = ASSETS.get(name)
+    if found is None:
+        await ex.respond(404, 'Unknown asset')
+        return
+    await send_asset(ex, found, asset_cache_control(found, ex.query.get('v')))
+
+
+@route('/probe', methods=('GET', 'POST'))
+async def probe(ex):
+    admission.check_rate(ex.client, 'probe')
+    url = ex.query.get('url') if ex.method == 'GET' else (await ex.json()).get('url')
+    if not url:
+        await ex.respond(400, 'Missing url')
+        return
+    try:
+        info = await probe_pool.run(get_probe, url, timer=ex.timer)
+    except Rejected:
+        raise
+    except Exception as e:
+        await ex.respond(500, f'Probe failed: {str(e)}')
+        return
+    status, body, headers = encode_json(
+        probe_payload(info), ex.headers.get('accept-encoding', ''), ex.if_none_match)
+    await ex.respond(status, body, headers, 'application/json')
+
+
+@route('/download', methods=('POST',), endpoint='download')
+async def download_file(ex):
+    admission.check_rate(ex.client, 'download')
+    data = await ex.json()
+    url = data.get('url')
+    fmt = data.get('format')
+    audio_format = data.get('audio_format', 'mp3')
+    filename_hint = data.get('filename', '').strip()
+    is_audio_only = data.get('is_audio_only', False)
+    progress_id = data.get('progress_id')
+
+    if not url or not fmt:
+        await ex.respond(400, 'Missing url or format')
+        return
+    try:
+        clip = await probe_pool.run(request_clip, data, url, timer=ex.timer)
+        priority = request_priority(data)
+    except ValueError as e:
+        await ex.respond(400, str(e))
+        return
+
+    client = ex.client
+    admission.acquire(client)
+    result = None
+    try:
+        opts, is_audio, plan = await probe_pool.run(
+            build_download_opts, url, fmt, audio_format, is_audio_only,
+            data.get('embed_metadata', False), clip, data.get('precise_cuts', False), timer=ex.timer)
+
+        if data.get('stream', False):
+            try:
+                await stream_media(ex, url, opts, is_audio, audio_format, filename_hint)
+                return
+            except NotStreamable as e:
+                print(f"Streaming unavailable ({e}), falling back to full download")
+
+        print(f"Downloading with format: {opts['format']} ({describe_plan(plan)})")
+
+        key = download_key(url, opts)
+        tracker = progress_registry.tracker(key)
+        if progress_id:
+            progress_registry.alias(progress_id, key)
+        with cancellation(key, progress_id) as token:
+            hang_up = lambda: token.cancel('client disconnected')
+            ex.listen(hang_up)
+            try:
+                result = await download_pool.run(
+                    obtain_result, url, opts, tracker, plan, priority, token,
+                    timer=ex.timer)
+            finally:
+                ex.forget(hang_up)
+            if token.cancelled:
+                raise ytdlp.DownloadCancelled(token.scope.reason or 'cancelled by client')
+        out_name = output_name(filename_hint, is_audio, audio_format, result.name)
+
+        headers = {'X-Postprocess-Plan': describe_plan(plan)}
+        stable_url = artifact_location(result, out_name, ex.scope.get('root_path', ''))
+        if stable_url:
+            headers['Content-Location'] = stable_url
+        sending, result = result, None
+        await send_result(ex, sending, out_name, headers)
+
+    except ytdlp.DownloadCancelled:
+        await ex.respond(409, 'Download cancelled')
+    except NoFileProduced:
+        await ex.respond(500, 'No file produced - download may have failed')
+    except Rejected:
+        raise
+    except Exception as e:
+        if ex.started:
+            raise
+        print(f"Download error: {str(e)}")
+        traceback.print_exc()
+        await ex.respond(500, f'Download failed: {str(e)}')
+    finally:
+        if result is not None:
+            result.release()
+        admission.release(client)
+
+
+@route('/download/bulk', methods=('POST',), endpoint='download_bulk')
+async def download_bulk(ex):
+    """ZIP of several downloads. The archive body blocks on its items, so it
+    is iterated on the download pool rather than the io pool."""
+    admission.check_rate(ex.client, 'download')
+    data = await ex.json()
+    items = bulk_items(data)
+    if not items or any(not i.get('url') or not i.get('format') for i in items):
+        await ex.respond(400, 'Missing items (each needs url and format)')
+        return
+    if len(items) > BULK_MAX_ITEMS:
+        await ex.respond(400, f'At most {BULK_MAX_ITEMS} items per request')
+        return
+
+    client = ex.client
+    admission.acquire(client)
+    try:
+        archive_name = f"{(data.get('filename') or 'downloads').strip()}.zip"
+        aborted = threading.Event()
+        chunks = stream_bulk_zip(items, min(BULK_WORKERS, len(items)), aborted)
+        ex.listen(aborted.set)
+        try:
+            # The first chunk is pulled before the headers so a busy pool still gets a 503
+            chunk = await download_pool.run(next, chunks, None)
+            await ex.start(200, {'Content-Disposition': content_disposition(archive_name)},
+                           'application/zip')
+            while chunk is not None:
+                if ex.disconnected.is_set():
+                    return
+                if chunk:
+                    await ex.write(chunk)
+                chunk = await download_pool.run(next, chunks, None)
+            await ex.write(b'', more=False)
+        finally:
+            ex.forget(aborted.set)
+            # Closing only cancels and releases, so it may use the io pool
+            await io_pool.run(chunks.close)
+    finally:
+        admission.release(client)
+
+
+async def send_result(ex, result, download_name, headers=None):
+    """Send a finished file, then release it.
+
+    Proxy hand-off and the ASGI pathsend extension leave the copying to the
+    server; otherwise the file is read in chunks off the event loop.
+    """
+    sent = 0
+    try:
+        headers = dict(headers or {})
+        headers['Content-Disposition'] = content_disposition(download_name)
+        target = offload_path(result.path)
+        if target is not None:
+            header = 'X-Accel-Redirect' if DELIVERY_BACKEND == 'x-accel' else 'X-Sendfile'
+            headers[header] = target
+            await ex.respond(200, b'', headers, 'application/octet-stream')
+            metrics.served(result.path.stat().st_size)
+            return
+
+        size = result.path.stat().st_size
+        headers['Content-Length'] = str(size)
+        with open(result.path, 'rb') as f:
+            await ex.start(200, headers, 'application/octet-stream')
+            sent_at = time.perf_counter()
+            if 'http.response.pathsend' in (ex.scope.get('extensions') or {}):
+                await ex._send({'type': 'http.response.pathsend', 'path': str(result.path)})
+                sent = size
+            else:
+                ex.listen()
+                while not ex.disconnected.is_set():
+                    chunk = await io_pool.run(f.read, STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    await ex.write(chunk)
+                    sent += len(chunk)
+                await ex.write(b'', more=False)
+        metrics.phases.observe((ex.endpoint, 'send'), time.perf_counter() - sent_at)
+    finally:
+        metrics.served(sent)
+        result.release()
+
+
+async def stream_media(ex, url, opts, is_audio, audio_format, filename_hint):
+    """Async counterpart of download.stream_download."""
+    ydl, out_name, fmt, cmd = await probe_pool.run(
+        prepare_stream, url, opts, is_audio, audio_format, filename_hint, timer=ex.timer)
+    try:
+        headers = {'Content-Disposition': content_disposition(out_name)}
+        print(f"Streaming {out_name} ({'passthrough' if fmt is not None else 'ffmpeg'})")
+        if fmt is not None:
+            await relay_upstream(ex, ydl, fmt, headers)
+        else:
+            await relay_process(ex, cmd, headers)
+    finally:
+        ydl.close()
+
+
+async def relay_upstream(ex, ydl, fmt, headers):
+    chunks, length = await download_pool.run(relay_http, ydl, fmt)
+    try:
+        if length:
+            headers['Content-Length'] = length
+        await ex.start(200, headers, 'application/octet-stream')
+        ex.listen()
+        while True:
+            chunk = await io_pool.run(next, chunks, None)
+            if chunk is None:
+                break
+            if ex.disconnected.is_set():
+                cancel_registry.record_stream_closed()
+                return
+            metrics.served(len(chunk))
+            await ex.write(chunk)
+        await ex.write(b'', more=False)
+    finally:
+        await io_pool.run(chunks.close)
+
+
+async def relay_process(ex, cmd, headers):
+    """Relay ffmpeg's stdout through an asyncio pipe; the process dies with the response.
+
+    Waiting for an ffmpeg scheduler slot blocks, so it happens on the download pool.
+    """
+    waiting = asyncio.ensure_future(
+        download_pool.run(ffmpeg_scheduler.hold, stream_gate(cmd), 'stream', timer=ex.timer))
+    try:
+        slot = await asyncio.shield(waiting)
+    except asyncio.CancelledError:
+        # The worker still gets its slot; hand it back once it does
+        waiting.add_done_callback(
+            lambda done: done.cancelled() or done.exception() or done.result().close())
+        raise
+    errlog = tempfile.TemporaryFile()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=errlog)
+    except BaseException:
+        errlog.close()
+        slot.close()
+        raise
+    try:
+        chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            await proc.wait()
+            errlog.seek(0)
+            message = errlog.read().decode('utf-8', 'replace').strip()
+            raise RuntimeError(f'ffmpeg exited with code {proc.returncode}: {message}')
+        await ex.start(200, headers, 'application/octet-stream')
+        ex.listen()
+        while chunk:
+            if ex.disconnected.is_set():
+                cancel_registry.record_stream_closed()
+                return
+            metrics.served(len(chunk))
+            await ex.write(chunk)
+            chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+        await ex.write(b'', more=False)
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+        errlog.close()
+        slot.close()
+
+
+async def send_feed(ex, feed):
+    """Server-Sent Events from a ProgressFeed, polled without a thread per subscriber.
+
+    Polls run on the io pool: job feeds read the shared state store.
+    """
+    await ex.start(200, {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}, 'text/event-stream')
+    ex.listen()
+    while not ex.disconnected.is_set():
+        for event in await io_pool.run(feed.poll):
+            await ex.write(event.encode())
+        if feed.done:
+            break
+        await ex.wait_disconnect(PROGRESS_INTERVAL)
+    await ex.write(b'', more=False)
+
+
+@route('/progress/<progress_id>/events')
+async def progress_events(ex, progress_id):
+    feed = download_feed(progress_id)
+    if feed is None:
+        await ex.respond(200, pending_progress(), {'Cache-Control': 'no-cache'}, 'text/event-stream')
+        return
+    await send_feed(ex, feed)
+
+
+@route('/jobs/<job_id>/events')
+async def job_events(ex, job_id):
+    feed = await io_pool.run(job_feed, job_id)
+    if feed is None:
+        await ex.respond(404, 'Unknown job')
+        return
+    await send_feed(ex, feed)
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def wsgi_fallback(scope, receive, send):
+    """Serve the request with the Flask app; the app and its body run on pool threads."""
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    environ = wsgi_environ(scope, b''.join(chunks))
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    def call():
+        body = download.app(environ, start_response)
+        return body, iter(body)
+
+    try:
+        body, chunks = await wsgi_pool.run(call)
+    except Rejected as e:
+        await send({'type': 'http.response.start', 'status': e.status, 'headers': [
+            (b'retry-after', str(max(1, e.retry_after)).encode()), (b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': str(e).encode()})
+        return
+    try:
+        await send({'type': 'http.response.start', 'status': started['status'],
+                    'headers': started['headers']})
+        while True:
+            chunk = await io_pool.run(next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(body, 'close'):
+            await io_pool.run(body.close)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    print("=" * 60)
+    print("Universal Downloader Started (asyncio mode)")
+    print("=" * 60)
+    print("Open http://127.0.0.1:5000 in your browser")
+    print("Press Ctrl+C to stop")
+    print("=" * 60)
+    uvicorn.run(app, host='127.0.0.1', port=5000)
@@ -0,0 +1,35 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pytest
+
+# download.py reads its configuration at import time: point every on-disk
+# location at a throwaway directory and skip the yt-dlp preload
+_root = tempfile.mkdtemp(prefix='ydl_tests_')
+os.environ.update({
+    'SCRATCH_DIR': os.path.join(_root, 'scratch'),
+    'RESULT_CACHE_DIR': os.path.join(_root, 'cache'),
+    'STATE_BACKEND': 'local',
+    'YTDLP_PRELOAD': '0',
+    'YDL_POOL_WARM': '0',
+})
+os.makedirs(os.environ['SCRATCH_DIR'], exist_ok=True)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def wait_until():
+    """Poll ``predicate`` until it holds, failing after ``timeout`` seconds."""
+    def wait(predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            assert time.monotonic() < deadline, 'timed out'
+            time.sleep(0.01)
+    return wait
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_root, ignore_errors=True)
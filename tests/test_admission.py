@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+import download
+from download import AdmissionControl, Rejected, TokenBucket, app, client_key
+
+
+def test_bucket_spends_its_burst_then_reports_the_wait():
+    bucket = TokenBucket(rate=2, burst=3)
+    now = bucket.updated
+    assert [bucket.take(now) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(now) == pytest.approx(0.5)
+    # Half a second later one token has come back
+    assert bucket.take(now + 0.5) == 0
+    # Idle time never refills past the burst
+    bucket.take(now + 100)
+    assert bucket.tokens == pytest.approx(2)
+
+
+def test_a_time_read_before_the_bucket_existed_does_not_drain_it():
+    before = time.monotonic()
+    bucket = TokenBucket(rate=1, burst=1)
+    assert bucket.take(before) == 0
+
+
+def test_rate_limit_is_per_client_and_per_kind():
+    admission = AdmissionControl({'probe': (1, 1), 'download': (0, 0)}, 0, 100)
+    admission.check_rate('a', 'probe')
+    with pytest.raises(Rejected) as refused:
+        admission.check_rate('a', 'probe')
+    assert refused.value.status == 429 and 0 < refused.value.retry_after <= 1
+    admission.check_rate('b', 'probe')
+    # A zero rate means no limit
+    for _ in range(5):
+        admission.check_rate('a', 'download')
+    stats = admission.stats()
+    assert (stats['admitted'], stats['rate_limited']) == (2, 1)
+
+
+def test_idle_buckets_are_forgotten_oldest_first():
+    admission = AdmissionControl({'probe': (1, 1)}, 0, 2)
+    for client in ('a', 'b', 'c'):
+        admission.check_rate(client, 'probe')
+    assert admission.stats()['tracked_buckets'] == 2
+    # 'a' starts over with a full bucket
+    admission.check_rate('a', 'probe')
+
+
+def test_concurrent_downloads_are_capped_per_client():
+    admission = AdmissionControl({}, 2, 100)
+    admission.acquire('a')
+    admission.acquire('a')
+    with pytest.raises(Rejected):
+        admission.acquire('a')
+    admission.acquire('b')
+    admission.release('a')
+    admission.acquire('a')
+    stats = admission.stats()
+    assert (stats['active_clients'], stats['active_downloads'], stats['concurrency_limited']) == (2, 3, 1)
+
+
+def test_retry_after_is_rounded_up_to_whole_seconds():
+    assert Rejected('slow down', 0.2).response()[2] == {'Retry-After': '1'}
+    assert Rejected('slow down', 2.1, 503).response()[1:] == (503, {'Retry-After': '3'})
+
+
+def test_clients_are_keyed_by_api_key_then_trusted_forwarding(monkeypatch):
+    assert client_key('secret', ['1.1.1.1'], '2.2.2.2') == client_key('secret', [], '3.3.3.3')
+    assert 'secret' not in client_key('secret', [], None)
+    monkeypatch.setattr(download, 'TRUST_FORWARDED_FOR', False)
+    assert client_key(None, ['1.1.1.1'], '2.2.2.2') == 'ip:2.2.2.2'
+    monkeypatch.setattr(download, 'TRUST_FORWARDED_FOR', True)
+    assert client_key(None, ['1.1.1.1'], '2.2.2.2') == 'ip:1.1.1.1'
+
+
+def test_rate_limited_route_answers_429_with_retry_after(monkeypatch):
+    monkeypatch.setattr(download, 'admission', AdmissionControl({'probe': (0.5, 1)}, 0, 100))
+    monkeypatch.setattr(download, 'get_probe', lambda url: {'title': 'clip', 'formats': []})
+    client = app.test_client()
+    assert client.get('/probe?url=https://example.com/v').status_code == 200
+    refused = client.get('/probe?url=https://example.com/v')
+    assert refused.status_code == 429
+    assert refused.headers['Retry-After'] == '2'
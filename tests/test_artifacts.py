@@ -0,0 +1,55 @@
+from pathlib import Path
+
+import pytest
+
+import download
+from download import DownloadResult, app, result_cache
+
+
+@pytest.fixture
+def artifact():
+    """A 1000-byte file published in the result cache; yields its key."""
+    scratch_dir = download.scratch.create(1000)
+    path = Path(scratch_dir.path) / 'clip.mp4'
+    path.write_bytes(bytes(range(250)) * 4)
+    key = f'artifact-{id(path)}'
+    result_cache.publish(key, DownloadResult(scratch_dir, path)).release()
+    yield key
+    entry = result_cache.get(key)
+    if entry is not None:
+        assert entry.pins == 0
+
+
+def fetch(key, headers=None):
+    response = app.test_client().get(f'/artifacts/{key}', headers=headers or {})
+    body = response.get_data()
+    response.close()
+    return response, body
+
+
+def test_range_request_gets_partial_content(artifact):
+    response, body = fetch(artifact, {'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert body == bytes(range(100, 200))
+    assert result_cache.get(artifact).pins == 0
+
+
+def test_unsatisfiable_range_releases_the_pin(artifact):
+    response, _ = fetch(artifact, {'Range': 'bytes=5000-'})
+    assert response.status_code == 416
+    entry = result_cache.get(artifact)
+    assert entry.pins == 0
+    assert entry.pin_fd is None
+
+
+def test_if_match_mismatch_is_refused_with_412(artifact):
+    etag = fetch(artifact)[0].headers['ETag']
+
+    response, body = fetch(artifact, {'If-Match': '"not-the-etag"'})
+    assert response.status_code == 412
+    assert len(body) < 1000
+    assert result_cache.get(artifact).pins == 0
+
+    response, body = fetch(artifact, {'If-Match': etag})
+    assert response.status_code == 200
+    assert len(body) == 1000
@@ -0,0 +1,95 @@
+import io
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+import pytest
+
+import download
+from download import DownloadResult, ZipStream, app, bulk_items, stream_bulk_zip, unique_name
+
+
+@pytest.fixture
+def fake_downloads(monkeypatch):
+    """Serve each item's URL as a small file instead of running yt-dlp.
+
+    URLs containing 'fail' raise, and 'slow' ones wait to be cancelled.
+    Returns the tokens the downloads were given.
+    """
+    tokens = []
+
+    def build_download_opts(url, fmt, *args):
+        return {'format': fmt}, False, {'path': 'copy'}
+
+    def obtain_result(url, opts, plan=None, cancel=None):
+        tokens.append(cancel)
+        if 'fail' in url:
+            raise RuntimeError('no such video')
+        if 'slow' in url:
+            while not cancel.scope.cancelled:
+                time.sleep(0.01)
+            raise download.ytdlp.DownloadCancelled('client disconnected')
+        scratch_dir = download.scratch.create(100)
+        path = Path(scratch_dir.path) / f"{url.rsplit('/', 1)[-1]}.mp4"
+        path.write_bytes(url.encode())
+        return DownloadResult(scratch_dir, path)
+
+    monkeypatch.setattr(download, 'build_download_opts', build_download_opts)
+    monkeypatch.setattr(download, 'obtain_result', obtain_result)
+    return tokens
+
+
+def test_zip_stream_drained_in_pieces_is_a_valid_archive():
+    sink = ZipStream()
+    out = io.BytesIO()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as zf:
+        with zf.open('a.bin', 'w') as member:
+            for _ in range(3):
+                member.write(b'x' * 1000)
+                out.write(sink.drain())
+    out.write(sink.drain())
+
+    assert sink.tell() == len(out.getvalue())
+    assert zipfile.ZipFile(out).read('a.bin') == b'x' * 3000
+
+
+def test_duplicate_member_names_are_numbered():
+    used = set()
+    assert [unique_name('a.mp4', used) for _ in range(3)] == ['a.mp4', 'a (2).mp4', 'a (3).mp4']
+
+
+def test_url_lists_share_the_request_options():
+    items = bulk_items({'urls': ['u1', 'u2'], 'format': 'best', 'filename': 'pack'})
+    assert items == [{'url': 'u1', 'format': 'best'}, {'url': 'u2', 'format': 'best'}]
+
+
+def test_failed_items_are_listed_in_errors_txt(fake_downloads):
+    items = bulk_items({'urls': ['https://a/one', 'https://a/fail', 'https://a/two'], 'format': 'best'})
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(stream_bulk_zip(items, 2))))
+
+    assert sorted(archive.namelist()) == ['errors.txt', 'one.mp4', 'two.mp4']
+    assert archive.read('one.mp4') == b'https://a/one'
+    assert 'https://a/fail: no such video' in archive.read('errors.txt').decode()
+    assert download.scratch.stats()['active'] == 0
+
+
+def test_abort_cancels_items_still_downloading(fake_downloads):
+    aborted = threading.Event()
+    body = stream_bulk_zip([{'url': 'https://a/slow', 'format': 'best'}], 1, aborted)
+    threading.Timer(0.2, aborted.set).start()
+
+    assert b''.join(body) == b''
+    assert fake_downloads[0].scope.cancelled
+
+
+def test_bulk_route_validates_and_names_the_archive(fake_downloads):
+    client = app.test_client()
+    assert client.post('/download/bulk', json={'urls': []}).status_code == 400
+
+    response = client.post('/download/bulk', json={'urls': ['https://a/one'], 'format': 'best',
+                                                    'filename': 'pack'})
+    assert response.mimetype == 'application/zip'
+    assert 'pack.zip' in response.headers['Content-Disposition']
+    assert zipfile.ZipFile(io.BytesIO(response.get_data())).namelist() == ['one.mp4']
+    response.close()
@@ -0,0 +1,81 @@
+import pytest
+
+import download
+from download import CancelRegistry
+
+
+@pytest.fixture
+def registry():
+    return CancelRegistry()
+
+
+def test_run_is_aborted_only_when_every_waiter_has_cancelled(registry):
+    first = registry.join('k')
+    second = registry.join('k')
+    scope = first.scope
+    assert second.scope is scope
+    killed = []
+    scope.on_cancel(lambda: killed.append('ffmpeg'))
+
+    first.cancel()
+    assert not scope.cancelled
+    scope.progress_hook({'filename': 'a.mp4', 'downloaded_bytes': 10})  # still running
+
+    second.cancel('client disconnected')
+    assert scope.cancelled and scope.reason == 'client disconnected'
+    assert killed == ['ffmpeg']
+    with pytest.raises(download.ytdlp.DownloadCancelled):
+        scope.progress_hook({'filename': 'a.mp4', 'downloaded_bytes': 20})
+    with pytest.raises(download.ytdlp.DownloadCancelled):
+        scope.postprocessor_hook({'status': 'started'})
+    stats = registry.stats()
+    assert (stats['cancelled_waiters'], stats['disconnects'], stats['aborted_runs']) == (2, 1, 1)
+
+
+def test_waiter_that_finishes_normally_never_aborts_the_run(registry):
+    token = registry.join('k')
+    token.close()
+    token.cancel()
+    assert not token.scope.cancelled
+    assert registry.stats()['in_flight'] == 0
+
+
+def test_abandoned_bytes_are_read_from_the_latest_progress(registry):
+    token = registry.join('k')
+    status = {'filename': 'v.mp4', 'downloaded_bytes': 100, 'total_bytes': 1000}
+    token.scope.progress_hook(status)
+    token.scope.progress_hook({'filename': 'a.m4a', 'downloaded_bytes': 50,
+                               'total_bytes_estimate': 150})
+    # The hook keeps yt-dlp's dict rather than copying it
+    status['downloaded_bytes'] = 400
+
+    token.cancel()
+    assert registry.stats()['bytes_avoided'] == 600 + 100
+
+
+def test_cancel_by_public_id_and_late_callbacks(registry):
+    token = registry.join('k', 'job-1')
+    assert registry.cancel('job-1')
+    assert not registry.cancel('job-unknown')
+    assert token.scope.cancelled
+
+    late = []
+    token.scope.on_cancel(lambda: late.append(True))
+    assert late == [True]
+
+
+def test_abandoned_scope_is_not_revived_by_a_new_waiter(registry):
+    old = registry.join('k')
+    old.cancel()
+    fresh = registry.join('k')
+    assert fresh.scope is not old.scope
+    assert not fresh.scope.cancelled
+
+
+def test_cancellation_context_closes_its_token(registry, monkeypatch):
+    monkeypatch.setattr(download, 'cancel_registry', registry)
+    with download.cancellation('k', 'progress-1') as token:
+        assert registry.stats()['in_flight'] == 1
+    assert token.closed
+    assert registry.stats()['in_flight'] == 0
+    assert not registry.cancel('progress-1')
@@ -0,0 +1,65 @@
+import math
+
+import pytest
+
+import download
+from download import clip_ranges, download_key, parse_timestamp, request_clip, ytdlp
+
+CHAPTERS = {'chapters': [
+    {'title': 'Intro', 'start_time': 0.0, 'end_time': 30.0},
+    {'title': 'Verse', 'start_time': 30.0, 'end_time': 95.5},
+    {'title': 'Outro', 'start_time': 95.5, 'end_time': 120.0},
+]}
+
+
+@pytest.mark.parametrize('value, seconds', [
+    (None, None), ('', None), (90, 90.0), (1.5, 1.5), ('45', 45.0), ('1:30', 90.0), ('01:02:03', 3723.0),
+])
+def test_timestamps_accept_seconds_and_clock_strings(value, seconds):
+    assert parse_timestamp(value) == seconds
+
+
+@pytest.mark.parametrize('value', ['abc', -1, True])
+def test_bad_timestamps_are_refused(value):
+    with pytest.raises(ValueError):
+        parse_timestamp(value)
+
+
+def test_window_defaults_to_the_whole_media():
+    assert request_clip({}, 'https://example.com/v') is None
+    assert request_clip({'start': 0}, 'https://example.com/v') is None
+    assert request_clip({'start': '1:00'}, 'https://example.com/v') == (60.0, math.inf)
+    assert request_clip({'end': 10}, 'https://example.com/v') == (0.0, 10.0)
+    with pytest.raises(ValueError):
+        request_clip({'start': 10, 'end': 10}, 'https://example.com/v')
+
+
+def test_chapters_span_first_to_last_and_explicit_bounds_win(monkeypatch):
+    monkeypatch.setattr(download, 'get_probe', lambda url: CHAPTERS)
+    assert request_clip({'chapters': ['outro', 'VERSE']}, 'u') == (30.0, 120.0)
+    assert request_clip({'chapters': 'Intro', 'end': 12}, 'u') == (0.0, 12.0)
+    with pytest.raises(ValueError, match='Unknown chapter: Bridge'):
+        request_clip({'chapters': ['Bridge']}, 'u')
+
+
+def test_chapters_of_an_unprobeable_url_are_a_bad_request(monkeypatch):
+    def get_probe(url):
+        raise RuntimeError('unsupported URL')
+    monkeypatch.setattr(download, 'get_probe', get_probe)
+    with pytest.raises(ValueError, match='Probe failed'):
+        request_clip({'chapters': ['Intro']}, 'u')
+
+
+def test_clips_get_their_own_cache_key():
+    def opts(clip=None, precise=False):
+        built = {'format': 'best'}
+        if clip:
+            built['download_ranges'] = ytdlp.download_range_func(None, [clip])
+            built['force_keyframes_at_cuts'] = precise
+        return built
+
+    assert clip_ranges(opts()) is None
+    assert clip_ranges(opts((5.0, math.inf))) == [[5.0, None]]
+    keys = {download_key('https://example.com/v', o)
+            for o in (opts(), opts((0.0, 10.0)), opts((0.0, 10.0), True), opts((5.0, 10.0)))}
+    assert len(keys) == 4
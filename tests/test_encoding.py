@@ -0,0 +1,53 @@
+import gzip
+import json
+
+import download
+from download import COMPRESS_MIN_BYTES, StaticAsset, app, encode_json
+
+LARGE = {'formats': [{'format_id': str(i), 'ext': 'mp4'} for i in range(COMPRESS_MIN_BYTES // 10)]}
+
+
+def test_small_payloads_are_sent_as_is():
+    status, body, headers = encode_json({'title': 'x'}, 'gzip, br')
+    assert status == 200 and json.loads(body) == {'title': 'x'}
+    assert 'Content-Encoding' not in headers
+    assert '-' not in headers['ETag']
+
+
+def test_large_payloads_get_gzip_and_an_encoding_specific_etag():
+    status, body, headers = encode_json(LARGE, 'gzip')
+    assert (status, headers['Content-Encoding'], headers['Vary']) == (200, 'gzip', 'Accept-Encoding')
+    assert headers['ETag'].endswith('-gzip"')
+    assert json.loads(gzip.decompress(body)) == LARGE
+
+    _, plain, identity = encode_json(LARGE, 'gzip;q=0, identity')
+    assert 'Content-Encoding' not in identity
+    assert json.loads(plain) == LARGE
+    assert identity['ETag'] == headers['ETag'].replace('-gzip', '')
+
+
+def test_any_representation_of_the_same_body_revalidates():
+    _, _, headers = encode_json(LARGE, 'gzip')
+    gzip_tag = headers['ETag'].strip('"')
+    assert encode_json(LARGE, '', {gzip_tag}) == (304, b'', encode_json(LARGE, '')[2])
+    assert encode_json(dict(LARGE, title='changed'), 'gzip', {gzip_tag})[0] == 200
+
+
+def test_static_asset_compresses_once_and_reuses_the_body():
+    asset = StaticAsset('a' * COMPRESS_MIN_BYTES * 2, 'text/css', 'max-age=60')
+    _, first, headers = asset.negotiate('gzip')
+    _, second, _ = asset.negotiate('gzip')
+    assert first is second
+    assert gzip.decompress(first) == asset.body
+    assert headers['ETag'] == f'"{asset.digest}-gzip"'
+    assert asset.negotiate('', {asset.digest})[0] == 304
+
+
+def test_probe_answers_conditional_requests_with_304(monkeypatch):
+    monkeypatch.setattr(download, 'get_probe', lambda url: {'title': 'clip', 'formats': []})
+    client = app.test_client()
+    first = client.get('/probe?url=https://example.com/v')
+    assert first.status_code == 200
+    again = client.get('/probe?url=https://example.com/v',
+                       headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304 and again.get_data() == b''
@@ -0,0 +1,47 @@
+import sys
+
+import pytest
+
+import download
+from download import FFmpegScheduler, relay_ffmpeg, stream_gate
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = FFmpegScheduler(1, 1)
+    monkeypatch.setattr(download, 'ffmpeg_scheduler', scheduler)
+    return scheduler
+
+
+def active(scheduler):
+    return {name: gate.active for name, gate in scheduler.gates.items()}
+
+
+def test_stream_gate_follows_codecs():
+    assert stream_gate(['ffmpeg', '-i', 'in', '-c', 'copy', '-f', 'mp4', 'pipe:1']) == 'copy'
+    assert stream_gate(['ffmpeg', '-i', 'in', '-vn', '-c:a', 'libmp3lame', '-f', 'mp3', 'pipe:1']) == 'transcode'
+
+
+def test_relay_holds_a_slot_until_the_process_exits(scheduler):
+    # No codec arguments: runs in the copy gate
+    chunks = relay_ffmpeg([sys.executable, '-m', 'this'])
+    assert active(scheduler) == {'copy': 1, 'transcode': 0}
+    assert b'Zen of Python' in b''.join(chunks)
+    assert active(scheduler) == {'copy': 0, 'transcode': 0}
+    assert scheduler.stats()['stages']['stream']['runs'] == 1
+
+
+def test_relay_releases_the_slot_when_ffmpeg_fails(scheduler):
+    with pytest.raises(RuntimeError):
+        relay_ffmpeg([sys.executable, '-c', 'raise SystemExit(3)'])
+    assert active(scheduler) == {'copy': 0, 'transcode': 0}
+
+
+def test_section_download_slot_passes_to_the_first_postprocessor(scheduler):
+    with scheduler.session({'path': 'copy'}) as session:
+        session.hold('download', 'transcode')
+        assert active(scheduler) == {'copy': 0, 'transcode': 1}
+        session.hook({'status': 'started', 'postprocessor': 'Merger'})
+        assert active(scheduler) == {'copy': 1, 'transcode': 0}
+    assert active(scheduler) == {'copy': 0, 'transcode': 0}
+    assert set(scheduler.stats()['stages']) == {'download', 'Merger'}
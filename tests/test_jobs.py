@@ -0,0 +1,75 @@
+import time
+
+import pytest
+
+import download
+from download import Job, JobManager, NoFileProduced, QueueFull
+
+
+class ScriptedJob(Job):
+    """A job whose run raises ``outcome`` (or succeeds) instead of downloading."""
+
+    def __init__(self, outcome=None):
+        super().__init__('https://example.com/v', 'best', 'mp3', '', False)
+        self.outcome = outcome
+
+    def run(self):
+        if self.outcome is not None:
+            raise self.outcome
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    manager = JobManager(1, 2, 3600)
+    # Jobs stay queued: the tests drive execution themselves
+    monkeypatch.setattr(manager, '_ensure_started', lambda: None)
+    return manager
+
+
+def test_submit_refuses_beyond_the_queue_limit(manager):
+    manager.submit(ScriptedJob())
+    manager.submit(ScriptedJob())
+    rejected = ScriptedJob()
+    with pytest.raises(QueueFull):
+        manager.submit(rejected)
+    assert manager.get(rejected.id) is None
+    stats = manager.stats()
+    assert (stats['queue_depth'], stats['tracked'], stats['rejected']) == (2, 2, 1)
+
+
+def test_cancelled_queued_job_is_finished_and_frees_its_client_slot(manager, monkeypatch):
+    released = []
+    monkeypatch.setattr(download.admission, 'release', released.append)
+    job = ScriptedJob()
+    job.client = 'client-a'
+    manager.submit(job)
+
+    assert manager.cancel(job.id) is job
+    assert job.state == 'cancelled' and job.finished_at is not None
+    assert released == ['client-a']
+    assert manager.cancel('unknown') is None
+
+
+@pytest.mark.parametrize('outcome, state, error', [
+    (None, 'finished', None),
+    (download.ytdlp.DownloadCancelled('client went away'), 'cancelled', 'client went away'),
+    (NoFileProduced(), 'failed', 'No file produced - download may have failed'),
+    (OSError('disk full'), 'failed', 'Download failed: disk full'),
+])
+def test_execution_outcome_sets_the_job_state(manager, outcome, state, error):
+    job = manager.submit(ScriptedJob(outcome))
+    manager._execute(job)
+    assert (job.state, job.error) == (state, error)
+    assert job.started_at <= job.finished_at
+
+
+def test_expire_forgets_old_finished_jobs_only(manager):
+    old = manager.submit(ScriptedJob())
+    recent = manager.submit(ScriptedJob())
+    manager._execute(old)
+    manager._execute(recent)
+    old.finished_at = time.time() - 7200
+
+    manager.expire()
+    assert manager.get(old.id) is None
+    assert manager.get(recent.id) is recent
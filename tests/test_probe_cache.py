@@ -0,0 +1,50 @@
+import download
+from download import ProbeCache, get_probe, normalize_url
+
+
+def test_least_recently_used_entry_is_evicted_first():
+    cache = ProbeCache(60, max_entries=2, max_bytes=10_000)
+    cache.put('a', {'title': 'a'})
+    cache.put('b', {'title': 'b'})
+    assert cache.get('a') == {'title': 'a'}
+    cache.put('c', {'title': 'c'})
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    stats = cache.stats()
+    assert (stats['entries'], stats['evictions'], stats['misses']) == (2, 1, 1)
+
+
+def test_byte_budget_evicts_and_oversized_values_are_not_cached():
+    cache = ProbeCache(60, max_entries=100, max_bytes=40)
+    cache.put('a', {'title': 'x' * 10})
+    cache.put('b', {'title': 'y' * 10})
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] <= 40
+
+    cache.put('huge', {'title': 'z' * 100})
+    assert cache.get('huge') is None
+    assert cache.get('b') is not None
+
+
+def test_expired_entries_are_dropped_on_read():
+    cache = ProbeCache(-1, max_entries=10, max_bytes=10_000)
+    cache.put('a', {'title': 'a'})
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert (stats['entries'], stats['bytes'], stats['expirations']) == (0, 0, 1)
+
+
+def test_tracking_parameters_do_not_split_the_cache_key():
+    assert (normalize_url('HTTPS://Example.com/watch?v=1&utm_source=x&t=2')
+            == normalize_url('https://example.com/watch?t=2&v=1#top'))
+
+
+def test_get_probe_answers_from_the_cache_without_probing(monkeypatch):
+    cache = ProbeCache(60, max_entries=10, max_bytes=10_000)
+    monkeypatch.setattr(download, 'probe_cache', cache)
+    record = {'title': 'cached', 'formats': []}
+    cache.put(normalize_url('https://example.com/v?utm_medium=feed'), record)
+
+    assert get_probe('https://example.com/v') == record
+    assert cache.stats()['hits'] == 1
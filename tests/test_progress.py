@@ -0,0 +1,26 @@
+import threading
+
+from download import PROGRESS_PENDING_RETRY_MS, app, progress_registry
+
+
+def events(progress_id):
+    response = app.test_client().get(f'/progress/{progress_id}/events')
+    body = response.get_data(as_text=True)
+    response.close()
+    return response, body
+
+
+def test_unregistered_id_gets_a_reconnect_hint():
+    response, body = events('progress-unknown')
+    assert response.mimetype == 'text/event-stream'
+    assert body == f'retry: {PROGRESS_PENDING_RETRY_MS}\ndata: {{"state": "pending"}}\n\n'
+
+
+def test_registered_id_streams_until_the_download_ends():
+    tracker = progress_registry.tracker('progress-key')
+    progress_registry.alias('progress-known', 'progress-key')
+    threading.Timer(0.3, tracker.finish).start()
+    _, body = events('progress-known')
+    assert 'retry:' not in body
+    last = body.rstrip('\n').rsplit('\n\n', 1)[-1]
+    assert last.startswith('event: done\n') and '"done": true' in last
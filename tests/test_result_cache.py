@@ -0,0 +1,152 @@
+import json
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+import download
+from download import DownloadResult, LocalState, ResultCache
+
+
+class SharedState(LocalState):
+    shared = True
+
+
+def fresh_result(name='clip.mp4', size=400):
+    scratch_dir = download.scratch.create(size)
+    path = Path(scratch_dir.path) / name
+    path.write_bytes(b'x' * size)
+    return DownloadResult(scratch_dir, path)
+
+
+def files(root):
+    return sorted(p.name for p in root.iterdir() if p.name != '.lock')
+
+
+def age(path, seconds):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+@pytest.fixture
+def root(tmp_path):
+    return tmp_path / 'cache'
+
+
+def test_publish_moves_the_file_and_releases_scratch(root):
+    cache = ResultCache(root, 10_000)
+    result = fresh_result()
+    cached = cache.publish('k1', result)
+
+    assert cached.path == root / 'k1.mp4'
+    assert not Path(result.scratch_dir.path).exists()
+    meta = json.loads((root / 'k1.json').read_text())
+    assert (meta['key'], meta['size'], meta['name']) == ('k1', 400, 'clip.mp4')
+    cached.release()
+    assert cache.get('k1').pins == 0
+
+
+def test_recovery_rebuilds_the_index_from_sidecars(root):
+    cache = ResultCache(root, 10_000)
+    cache.publish('k1', fresh_result(), alias='url-a').release()
+    cache.publish('k2', fresh_result()).release()
+
+    recovered = ResultCache(root, 10_000)
+    assert recovered.stats()['entries'] == 2
+    assert recovered.stats()['bytes'] == 800
+    hit = recovered.checkout(alias='url-a')
+    assert hit is not None and hit.entry.key == 'k1'
+    hit.release()
+
+
+def test_recovery_drops_incomplete_entries_and_stale_leftovers(root):
+    cache = ResultCache(root, 10_000)
+    cache.publish('k1', fresh_result()).release()
+    cache.publish('k2', fresh_result()).release()
+    # Truncated file, sidecar without a file, and old leftovers of a crash
+    (root / 'k1.mp4').write_bytes(b'x')
+    (root / 'k2.mp4').unlink()
+    for name in ('.tmp-old', 'orphan.mp4'):
+        (root / name).write_bytes(b'x')
+    for name in ('k1.mp4', '.tmp-old', 'orphan.mp4'):
+        age(root / name, download.RESULT_TMP_GRACE + 60)
+
+    recovered = ResultCache(root, 10_000)
+    assert recovered.stats()['entries'] == 0
+    assert files(root) == []
+
+
+def test_recovery_keeps_files_a_sibling_may_be_publishing(root):
+    root.mkdir()
+    (root / '.tmp-fresh').write_bytes(b'x')
+    (root / 'renamed-no-sidecar-yet.mp4').write_bytes(b'x')
+
+    for state in (LocalState(), SharedState()):
+        ResultCache(root, 10_000, state=state)
+        assert files(root) == ['.tmp-fresh', 'renamed-no-sidecar-yet.mp4']
+
+
+def test_lru_eviction_skips_pinned_entries(root):
+    cache = ResultCache(root, 1000)
+    pinned = cache.publish('k1', fresh_result())
+    cache.publish('k2', fresh_result()).release()
+    cache.publish('k3', fresh_result()).release()
+
+    # k1 is the least recently used but still in use, so k2 goes instead
+    assert cache.get('k1') is not None and cache.get('k2') is None
+    assert files(root) == ['k1.json', 'k1.mp4', 'k3.json', 'k3.mp4']
+    assert cache.stats()['evictions'] == 1
+    pinned.release()
+
+
+def test_lfu_eviction_prefers_rarely_hit_entries(root):
+    cache = ResultCache(root, 1000, policy='lfu')
+    cache.publish('k1', fresh_result()).release()
+    cache.publish('k2', fresh_result()).release()
+    for _ in range(3):
+        cache.checkout('k1').release()
+    cache.publish('k3', fresh_result()).release()
+
+    assert cache.get('k1') is not None and cache.get('k2') is None
+
+
+def test_sibling_pins_block_eviction(root):
+    mine, sibling = ResultCache(root, 1000), ResultCache(root, 1000)
+    published = mine.publish('k1', fresh_result())
+    row = {'key': 'k1', 'path': str(published.path), 'name': published.name,
+           'size': 400, 'created_at': time.time()}
+    serving = sibling.adopt(row)
+    published.release()
+
+    mine.publish('k2', fresh_result()).release()
+    mine.publish('k3', fresh_result()).release()
+    assert (root / 'k1.mp4').exists()
+    assert not (root / 'k2.mp4').exists()
+
+    serving.release()
+    mine.publish('k4', fresh_result()).release()
+    assert not (root / 'k1.mp4').exists()
+
+
+def test_checkout_misses_once_a_sibling_evicted_the_file(root):
+    cache = ResultCache(root, 10_000)
+    cache.publish('k1', fresh_result()).release()
+    (root / 'k1.mp4').unlink()
+
+    assert cache.checkout('k1') is None
+    assert cache.get('k1') is None
+
+
+def test_retention_sweep_expires_idle_entries(root):
+    cache = ResultCache(root, 10_000, retention=60)
+    cache.publish('k1', fresh_result()).release()
+    in_use = cache.publish('k2', fresh_result())
+    for key in ('k1', 'k2'):
+        cache.get(key).last_access -= 120
+
+    cache.sweep()
+    assert cache.get('k1') is None and not (root / 'k1.mp4').exists()
+    assert cache.get('k2') is not None
+    assert cache.stats()['expirations'] == 1
+    in_use.release()
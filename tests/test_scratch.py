@@ -0,0 +1,146 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import download
+from download import Rejected, ScratchSpace, process_start_ticks
+
+
+@pytest.fixture
+def space(tmp_path):
+    return ScratchSpace(str(tmp_path), max_bytes=1000, min_free_bytes=0,
+                        default_reserve=100, orphan_age=3600)
+
+
+def test_create_reserves_and_remove_releases(space):
+    first = space.create(600)
+    second = space.create()
+    assert os.path.isdir(first.path)
+    assert os.path.basename(first.path).startswith(f'ydl_{os.getpid()}.')
+    assert space.stats()['reserved_bytes'] == 700
+
+    first.remove()
+    second.remove()
+    assert not os.path.exists(first.path)
+    stats = space.stats()
+    assert (stats['reserved_bytes'], stats['active'], stats['admitted']) == (0, 0, 2)
+    assert stats['peak_reserved_bytes'] == 700
+
+
+def test_full_budget_waits_then_refuses_with_507(space):
+    held = space.create(800)
+    started = time.monotonic()
+    with pytest.raises(Rejected) as refused:
+        space.create(300, wait=0.2)
+    assert time.monotonic() - started >= 0.2
+    assert refused.value.status == 507
+    assert refused.value.retry_after == download.SCRATCH_RETRY_AFTER
+    assert space.stats()['rejected'] == 1
+    held.remove()
+
+
+def test_request_that_can_never_fit_is_refused_at_once(space):
+    started = time.monotonic()
+    with pytest.raises(Rejected) as refused:
+        space.create(5000, wait=10)
+    assert time.monotonic() - started < 1
+    assert refused.value.status == 507
+
+
+def test_free_space_floor_counts_unwritten_reservations(tmp_path):
+    free = download.shutil.disk_usage(tmp_path).free
+    space = ScratchSpace(str(tmp_path), 0, free - 1000, 100, 3600)
+    held = space.create(600)
+    # 600 reserved but not written leaves room for less than another 600
+    with pytest.raises(Rejected):
+        space.create(600, wait=0)
+    held.remove()
+
+
+def test_waiters_are_admitted_in_arrival_order(space, wait_until):
+    held = space.create(1000)
+    admitted = []
+
+    def wait_for(nbytes, label):
+        scratch_dir = space.create(nbytes, wait=5)
+        admitted.append(label)
+        scratch_dir.remove()
+
+    # The two do not fit together, so the second is only admitted once the
+    # first has recorded itself and let go
+    big = threading.Thread(target=wait_for, args=(900, 'big'))
+    big.start()
+    wait_until(lambda: space.stats()['waiting'] == 1)
+    small = threading.Thread(target=wait_for, args=(150, 'small'))
+    small.start()
+    wait_until(lambda: space.stats()['waiting'] == 2)
+
+    held.remove()
+    big.join(5)
+    small.join(5)
+    # The small request would have fitted first, but does not jump the queue
+    assert admitted == ['big', 'small']
+    assert space.stats()['waited'] == 2
+
+
+def test_used_is_measured_at_most_once_per_ttl(space, monkeypatch):
+    scratch_dir = space.create(500)
+    monkeypatch.setattr(download, 'SCRATCH_USAGE_TTL', 60)
+    with open(os.path.join(scratch_dir.path, 'part'), 'wb') as f:
+        f.write(b'x' * 300)
+    assert scratch_dir.used() == 300
+    with open(os.path.join(scratch_dir.path, 'more'), 'wb') as f:
+        f.write(b'x' * 100)
+    assert scratch_dir.used() == 300
+    monkeypatch.setattr(download, 'SCRATCH_USAGE_TTL', 0)
+    assert scratch_dir.used() == 400
+    scratch_dir.remove()
+
+
+def test_space_used_sums_live_dirs_without_walking_others(space, tmp_path):
+    scratch_dir = space.create(500)
+    with open(os.path.join(scratch_dir.path, 'part'), 'wb') as f:
+        f.write(b'x' * 300)
+    # A sibling worker's dir is not this process's usage
+    make_dir(str(tmp_path), 'ydl_1.1_siblings')
+    assert space.used() == 300
+    scratch_dir.remove()
+    assert space.used() == 0
+
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    return proc.pid
+
+
+def make_dir(root, name, age=0):
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    with open(os.path.join(path, 'part'), 'wb') as f:
+        f.write(b'x' * 10)
+    if age:
+        past = time.time() - age
+        os.utime(path, (past, past))
+    return path
+
+
+@pytest.mark.skipif(process_start_ticks() is None, reason='needs /proc to spot reused pids')
+def test_sweep_removes_only_dead_owners_and_old_unmarked_dirs(space, tmp_path):
+    root = str(tmp_path)
+    mine = make_dir(root, f'ydl_{os.getpid()}.{process_start_ticks() or 0}_abcdefgh')
+    dead = make_dir(root, f'ydl_{dead_pid()}.1_abcdefgh')
+    reused = make_dir(root, f'ydl_{os.getpid()}.1_ijklmnop')
+    old = make_dir(root, 'ydl_qrstuvwx', age=7200)
+    recent = make_dir(root, 'ydl_yz012345')
+    other = make_dir(root, 'not_ours', age=7200)
+
+    space.sweep()
+    remaining = {p for p in (mine, dead, reused, old, recent, other) if os.path.exists(p)}
+    assert remaining == {mine, recent, other}
+    assert space.stats()['swept_dirs'] == 3
+    assert space.stats()['swept_bytes'] == 30
@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+from download import SingleFlight
+
+
+class Counted:
+    def __init__(self):
+        self.refs = 1
+
+    def retain(self, count=1):
+        self.refs += count
+
+
+def run_concurrently(flight, key, fn, callers):
+    """Start ``callers`` threads on ``flight.do(key, fn)``; returns their outcomes."""
+    outcomes = [None] * callers
+
+    def call(i):
+        try:
+            outcomes[i] = ('ok', flight.do(key, fn))
+        except Exception as e:
+            outcomes[i] = ('error', e)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+    for t in threads:
+        t.start()
+    return threads, outcomes
+
+
+def test_concurrent_callers_share_one_execution(wait_until):
+    flight = SingleFlight()
+    release = threading.Event()
+    result = Counted()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return result
+
+    threads, outcomes = run_concurrently(flight, 'k', fn, 4)
+    wait_until(lambda: flight.stats()['coalesced'] == 3)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert calls == [1]
+    assert outcomes == [('ok', result)] * 4
+    # The leader's reference plus one retained per follower
+    assert result.refs == 4
+    assert flight.stats() == {'in_flight': 0, 'executions': 1, 'coalesced': 3}
+
+
+def test_followers_receive_the_leaders_exception(wait_until):
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise ValueError('boom')
+
+    threads, outcomes = run_concurrently(flight, 'k', fn, 3)
+    wait_until(lambda: flight.stats()['coalesced'] == 2)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert [kind for kind, _ in outcomes] == ['error'] * 3
+    assert all(str(e) == 'boom' for _, e in outcomes)
+
+
+def test_keys_run_independently_and_calls_do_not_linger():
+    flight = SingleFlight()
+    assert flight.do('a', lambda: 1) == 1
+    assert flight.do('b', lambda: 2) == 2
+    # A finished key starts a fresh execution
+    assert flight.do('a', lambda: 3) == 3
+    assert flight.stats() == {'in_flight': 0, 'executions': 3, 'coalesced': 0}
+
+
+def test_leader_error_is_raised_and_key_cleared():
+    flight = SingleFlight()
+
+    def fail():
+        raise RuntimeError('nope')
+
+    with pytest.raises(RuntimeError):
+        flight.do('k', fail)
+    assert flight.do('k', lambda: 'again') == 'again'
@@ -0,0 +1,153 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from download import Job, JobManager, QueueFull, SqliteState
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'state.db')
+
+
+def node(db_path, name):
+    return SqliteState(db_path, name, f'http://{name}')
+
+
+def queue_job(state, priority=0, max_queued=100):
+    job = Job('https://example.com/v', 'best', 'mp3', '', False, priority=priority)
+    assert state.put_job(job.record(), max_queued)
+    return job
+
+
+def test_put_job_refuses_beyond_the_shared_queue_limit(db_path):
+    state = node(db_path, 'a')
+    queue_job(state, max_queued=2)
+    queue_job(state, max_queued=2)
+    job = Job('https://example.com/v', 'best', 'mp3', '', False)
+    assert not state.put_job(job.record(), 2)
+    assert state.job_states() == {'queued': 2}
+
+
+def test_claims_follow_priority_then_age(db_path):
+    state = node(db_path, 'a')
+    low = queue_job(state, priority=0)
+    high = queue_job(state, priority=5)
+    later_low = queue_job(state, priority=0)
+
+    claimed = [state.claim_job(30, 3)['id'] for _ in range(3)]
+    assert claimed == [high.id, low.id, later_low.id]
+    assert state.claim_job(30, 3) is None
+
+
+def test_claimed_job_records_owner_and_lease(db_path):
+    state = node(db_path, 'a')
+    job = queue_job(state)
+    before = time.time()
+    record = state.claim_job(30, 3)
+
+    assert record['id'] == job.id
+    assert (record['state'], record['owner'], record['owner_url']) == ('running', 'a', 'http://a')
+    assert record['attempts'] == 1
+    assert record['lease_until'] >= before + 30
+    assert record['params']['url'] == 'https://example.com/v'
+
+
+def test_concurrent_workers_never_claim_the_same_job(db_path):
+    seed = node(db_path, 'seed')
+    jobs = {queue_job(seed).id for _ in range(20)}
+    claims = []
+    lock = threading.Lock()
+
+    def worker(name):
+        state = node(db_path, name)
+        while True:
+            record = state.claim_job(30, 3)
+            if record is None:
+                return
+            with lock:
+                claims.append(record['id'])
+
+    threads = [threading.Thread(target=worker, args=(f'w{i}',)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+
+    assert sorted(claims) == sorted(jobs)
+
+
+def test_expired_lease_is_taken_over_and_the_old_owner_fenced_off(db_path):
+    a, b = node(db_path, 'a'), node(db_path, 'b')
+    job = queue_job(a)
+    assert a.claim_job(0.05, 3)['id'] == job.id
+    assert a.renew_job(job.id, 0.05) == (True, False)
+
+    time.sleep(0.1)
+    record = b.claim_job(30, 3)
+    assert (record['id'], record['owner'], record['attempts']) == (job.id, 'b', 2)
+
+    # The lost owner can neither renew nor overwrite the outcome
+    assert a.renew_job(job.id, 30) == (False, False)
+    stale = dict(job.record(), state='failed', error='late', finished_at=time.time())
+    a.finish_job(stale)
+    assert b.get_job(job.id)['state'] == 'running'
+
+    done = dict(job.record(), state='finished', finished_at=time.time())
+    b.finish_job(done)
+    assert a.get_job(job.id)['state'] == 'finished'
+
+
+def test_job_fails_once_its_attempts_are_used_up(db_path):
+    state = node(db_path, 'a')
+    job = queue_job(state)
+    state.claim_job(0.01, 1)
+    time.sleep(0.05)
+
+    assert state.claim_job(30, 1) is None
+    record = state.get_job(job.id)
+    assert record['state'] == 'failed'
+    assert 'worker lost' in record['error']
+
+
+def test_cancel_queued_outright_and_flag_running_for_its_owner(db_path):
+    a, b = node(db_path, 'a'), node(db_path, 'b')
+    queued = queue_job(a, priority=0)
+    running = queue_job(a, priority=1)
+    assert a.claim_job(30, 3)['id'] == running.id
+
+    assert b.cancel_job(queued.id)['state'] == 'cancelled'
+    record = b.cancel_job(running.id)
+    assert (record['state'], record['cancel_requested']) == ('running', 1)
+    assert a.renew_job(running.id, 30) == (True, True)
+
+
+def test_expire_forgets_jobs_finished_before_the_cutoff(db_path):
+    state = node(db_path, 'a')
+    old, recent = queue_job(state), queue_job(state)
+    for job, finished_at in ((old, time.time() - 100), (recent, time.time())):
+        state.claim_job(30, 3)
+        state.finish_job(dict(job.record(), state='finished', finished_at=finished_at))
+
+    state.expire(time.time() - 50)
+    assert state.get_job(old.id) is None
+    assert state.get_job(recent.id) is not None
+
+
+class LockedStore(SqliteState):
+    def put_job(self, record, max_queued):
+        raise sqlite3.OperationalError('database is locked')
+
+
+def test_store_errors_on_submit_are_reported_as_a_full_queue(db_path, monkeypatch):
+    manager = JobManager(1, 4, 3600, LockedStore(db_path, 'a', 'http://a'))
+    # No claimer or lease threads: they would poll the temp DB after the test
+    monkeypatch.setattr(manager, '_ensure_started', lambda: None)
+    job = Job('https://example.com/v', 'best', 'mp3', '', False)
+
+    with pytest.raises(QueueFull):
+        manager.submit(job)
+    assert manager.get(job.id) is None
+    assert manager.stats()['rejected'] == 1